@@ -0,0 +1,137 @@
+"""Throughput of the conversation stores under the access pattern of the chat backend.
+
+Creates conversations, appends turns in batches the way the write-behind queue does, then reads
+whole conversations, history pages, per-user listings and a full export. Run from the chat-backend directory:
+    python -m benchmarks.bench_conversation_dao --stores segment_log memory
+    python -m benchmarks.bench_conversation_dao --stores segment_log mongo   # needs MONGO_CONNECTION_STRING
+"""
+import argparse
+import asyncio
+import json
+import os
+import shutil
+import tempfile
+import time
+import uuid
+from datetime import datetime, timezone
+from typing import Any, Dict, List
+
+from benchmarks.run_benchmark import RESULTS_DIR, git_commit
+
+
+async def open_store(store: str, latency_ms: float):
+    if store == "memory":
+        from benchmarks.memory_daos import InMemoryConversationDAO
+        return InMemoryConversationDAO(latency_ms), None
+    if store == "segment_log":
+        from daos.segment_log_dao import SegmentLogConversationDAO
+        directory = tempfile.mkdtemp(prefix="bench-segment-log-")
+        return SegmentLogConversationDAO(directory, 64 * 1024 * 1024), directory
+    from clients.mongo_client import connect_mongo_client
+    from daos.conversation_dao import ConversationDAO
+    os.environ.setdefault("MONGO_DATABASE", "chat-bot-benchmark")
+    conversation_dao = ConversationDAO(connect_mongo_client())
+    await conversation_dao.collection.drop()
+    await conversation_dao.ensure_indexes()
+    return conversation_dao, None
+
+
+async def close_store(store: str, conversation_dao, directory) -> None:
+    if store == "segment_log":
+        await conversation_dao.close()
+        shutil.rmtree(directory, ignore_errors=True)
+    elif store == "mongo":
+        from clients.mongo_client import close_mongo_client
+        await conversation_dao.collection.drop()
+        await close_mongo_client()
+
+
+async def timed(results: Dict[str, Any], name: str, operations: int, run) -> None:
+    started = time.perf_counter()
+    await run()
+    elapsed = time.perf_counter() - started
+    results[f"{name}_per_second"] = round(operations / elapsed, 1)
+
+
+async def bench_store(store: str, args: argparse.Namespace) -> Dict[str, Any]:
+    from models.models import ChatMessage, Conversation
+
+    conversation_dao, directory = await open_store(store, args.latency_ms)
+    results: Dict[str, Any] = {}
+    users = [f"benchuser{index}" for index in range(max(args.conversations // args.conversations_per_user, 1))]
+    conversation_ids: List[str] = []
+    reply = "word " * (args.reply_chars // 5)
+    try:
+        async def create() -> None:
+            for index in range(args.conversations):
+                conversation = Conversation(user_id=users[index % len(users)])
+                conversation_ids.append(await conversation_dao.create_conversation(conversation))
+
+        async def append() -> None:
+            for turn in range(args.turns):
+                for start in range(0, len(conversation_ids), args.batch_conversations):
+                    await conversation_dao.add_messages_to_conversations({
+                        conversation_id: [
+                            ChatMessage(role="user", content=f"question {turn} {uuid.uuid4()}"),
+                            ChatMessage(role="bot", content=reply),
+                        ]
+                        for conversation_id in conversation_ids[start:start + args.batch_conversations]
+                    })
+
+        async def read_conversations() -> None:
+            for conversation_id in conversation_ids:
+                await conversation_dao.get_conversation(conversation_id)
+
+        async def read_pages() -> None:
+            for conversation_id in conversation_ids:
+                await conversation_dao.get_conversation_messages(conversation_id, 50)
+
+        async def list_users() -> None:
+            for user_id in users:
+                await conversation_dao.get_conversations_by_user_id(user_id, 10)
+
+        async def export() -> None:
+            async for _ in conversation_dao.iter_conversations(batch_size=500):
+                pass
+
+        await timed(results, "create", len(conversation_ids) or args.conversations, create)
+        await timed(results, "appended_messages", 2 * args.turns * len(conversation_ids), append)
+        await timed(results, "get_conversation", len(conversation_ids), read_conversations)
+        await timed(results, "history_page", len(conversation_ids), read_pages)
+        await timed(results, "user_listing", len(users), list_users)
+        await timed(results, "exported_conversations", len(conversation_ids), export)
+        if store == "segment_log":
+            results["disk_bytes"] = conversation_dao.stats()["bytes"]
+    finally:
+        await close_store(store, conversation_dao, directory)
+    return results
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--stores", nargs="+", choices=["memory", "segment_log", "mongo"], default=["memory", "segment_log"])
+    parser.add_argument("--conversations", type=int, default=1000)
+    parser.add_argument("--conversations-per-user", type=int, default=10)
+    parser.add_argument("--turns", type=int, default=50, help="user and bot message pairs appended to each conversation")
+    parser.add_argument("--reply-chars", type=int, default=1000)
+    parser.add_argument("--batch-conversations", type=int, default=100, help="conversations per bulk append, like the write-behind queue")
+    parser.add_argument("--latency-ms", type=float, default=1, help="simulated round-trip of the in-memory store")
+    parser.add_argument("--output-dir", default=RESULTS_DIR)
+    args = parser.parse_args()
+
+    run = {
+        "timestamp": datetime.now(timezone.utc).isoformat(),
+        "git_commit": git_commit(),
+        "config": {key: value for key, value in vars(args).items() if key != "output_dir"},
+        "results": {store: asyncio.run(bench_store(store, args)) for store in args.stores},
+    }
+    print(json.dumps(run, indent=2))
+    os.makedirs(args.output_dir, exist_ok=True)
+    path = os.path.join(args.output_dir, f"dao-{datetime.now().strftime('%Y%m%d-%H%M%S')}-{run['git_commit'] or 'local'}.json")
+    with open(path, "w") as results_file:
+        json.dump(run, results_file, indent=2)
+    print(f"\nSaved results to {path}")
+
+
+if __name__ == "__main__":
+    main()
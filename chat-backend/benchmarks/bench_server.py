@@ -0,0 +1,69 @@
+"""Runs the chat backend against the local OpenAI stand-in and in-memory DAOs, with an event loop lag probe."""
+import asyncio
+import os
+import time
+from contextlib import asynccontextmanager
+from typing import Dict, List
+
+# how often the lag probe wakes up
+LAG_PROBE_INTERVAL = 0.01
+
+
+def run_bench_server(port: int, openai_port: int, dao_latency_ms: float, environment: Dict[str, str], conversation_store: str = "memory") -> None:
+    """conversation_store is "memory" for the in-memory stand-in, or a CONVERSATION_STORE the app opens itself."""
+    # settings are read at import time, so configure the environment before importing the app
+    os.environ.update(environment)
+    os.environ["OPENAI_BASE_URL"] = f"http://127.0.0.1:{openai_port}/v1"
+    os.environ["OPENAI_API_KEY"] = "bench"
+
+    import uvicorn
+    from benchmarks.memory_daos import InMemoryConversationDAO, InMemoryUserDAO
+    from clients.chat_client import close_openai_client, connect_openai_client
+    from daos.conversation_store import close_conversation_dao, get_conversation_dao, start_conversation_dao
+    from daos.user_dao import UserDAO
+    from main import app
+    from services.persistence_queue import message_queue
+    from services.search_index import search_indexes
+    from websocket_compression import DeflateWebSocketProtocol
+
+    conversation_dao = InMemoryConversationDAO(dao_latency_ms) if conversation_store == "memory" else None
+    user_dao = InMemoryUserDAO(dao_latency_ms)
+    if conversation_dao is not None:
+        app.dependency_overrides[get_conversation_dao] = lambda: conversation_dao
+    app.dependency_overrides[UserDAO] = lambda: user_dao
+    lag_samples: List[float] = []
+
+    async def probe_loop_lag() -> None:
+        while True:
+            expected = time.perf_counter() + LAG_PROBE_INTERVAL
+            await asyncio.sleep(LAG_PROBE_INTERVAL)
+            lag_samples.append(max(time.perf_counter() - expected, 0))
+
+    @asynccontextmanager
+    async def lifespan(_):
+        # same as main.lifespan, minus mongo
+        connect_openai_client()
+        message_queue.start(conversation_dao or start_conversation_dao())
+        search_indexes.start()
+        probe = asyncio.create_task(probe_loop_lag())
+        try:
+            yield
+        finally:
+            probe.cancel()
+            await message_queue.stop()
+            await search_indexes.stop()
+            await close_conversation_dao()
+            await close_openai_client()
+
+    app.router.lifespan_context = lifespan
+
+    @app.post("/bench/loop-lag/reset")
+    async def reset_loop_lag():
+        lag_samples.clear()
+        return {}
+
+    @app.get("/bench/loop-lag")
+    async def get_loop_lag():
+        return {"samples": lag_samples}
+
+    uvicorn.run(app, host="127.0.0.1", port=port, log_level="warning", ws_max_size=16 * 1024 * 1024, ws=DeflateWebSocketProtocol)
@@ -0,0 +1,75 @@
+"""Local stand-in for the OpenAI chat completions API with a configurable time to first token and token rate.
+
+The time to first token can differ per model, and a fraction of requests can be made slow to give it a heavy tail.
+"""
+import asyncio
+import json
+import random
+import time
+from typing import AsyncIterator, Dict, Optional
+
+from starlette.applications import Starlette
+from starlette.requests import Request
+from starlette.responses import JSONResponse, StreamingResponse
+from starlette.routing import Route
+
+
+def create_fake_openai_app(ttft_ms: float, ttft_jitter_ms: float, tokens_per_second: float, reply_tokens: int,
+                           ttft_tail_ratio: float = 0.0, ttft_tail_ms: float = 0.0, model_ttft_ms: Optional[Dict[str, float]] = None) -> Starlette:
+    model_ttft_ms = model_ttft_ms or {}
+
+    async def chat_completions(request: Request):
+        body = await request.json()
+        model = body.get("model", "gpt-4o")
+        prompt_tokens = sum(len(message.get("content", "")) // 4 + 4 for message in body.get("messages", []))
+        include_usage = (body.get("stream_options") or {}).get("include_usage", False)
+        # a markdown-ish reply of reply_tokens tokens, one token per chunk like the real api
+        tokens = [f"word{i % 97} " if i % 12 else "\n" for i in range(reply_tokens)]
+        ttft = max(model_ttft_ms.get(model, ttft_ms) + random.uniform(-ttft_jitter_ms, ttft_jitter_ms), 0) / 1000
+        if random.random() < ttft_tail_ratio:
+            ttft += ttft_tail_ms / 1000
+
+        if not body.get("stream"):
+            await asyncio.sleep(ttft + reply_tokens / tokens_per_second)
+            return JSONResponse({
+                "id": "chatcmpl-bench", "object": "chat.completion", "created": int(time.time()), "model": model,
+                "choices": [{"index": 0, "message": {"role": "assistant", "content": "".join(tokens)}, "finish_reason": "stop"}],
+                "usage": {"prompt_tokens": prompt_tokens, "completion_tokens": reply_tokens, "total_tokens": prompt_tokens + reply_tokens},
+            })
+
+        def event(choices, usage=None) -> str:
+            chunk = {"id": "chatcmpl-bench", "object": "chat.completion.chunk", "created": int(time.time()), "model": model, "choices": choices}
+            if usage is not None:
+                chunk["usage"] = usage
+            return f"data: {json.dumps(chunk)}\n\n"
+
+        async def stream() -> AsyncIterator[str]:
+            await asyncio.sleep(ttft)
+            interval = 1 / tokens_per_second
+            next_at = time.perf_counter()
+            for token in tokens:
+                yield event([{"index": 0, "delta": {"role": "assistant", "content": token}, "finish_reason": None}])
+                # pace against a schedule so slow sends don't stretch the stream
+                next_at += interval
+                await asyncio.sleep(max(next_at - time.perf_counter(), 0))
+            yield event([{"index": 0, "delta": {}, "finish_reason": "stop"}])
+            if include_usage:
+                yield event([], {"prompt_tokens": prompt_tokens, "completion_tokens": reply_tokens, "total_tokens": prompt_tokens + reply_tokens})
+            yield "data: [DONE]\n\n"
+
+        return StreamingResponse(stream(), media_type="text/event-stream")
+
+    async def models(request: Request):
+        return JSONResponse({"object": "list", "data": [{"id": "gpt-4o", "object": "model", "created": 0, "owned_by": "bench"}]})
+
+    return Starlette(routes=[
+        Route("/v1/chat/completions", chat_completions, methods=["POST"]),
+        Route("/v1/models", models, methods=["GET"]),
+    ])
+
+
+def run_fake_openai(port: int, ttft_ms: float, ttft_jitter_ms: float, tokens_per_second: float, reply_tokens: int,
+                    ttft_tail_ratio: float = 0.0, ttft_tail_ms: float = 0.0, model_ttft_ms: Optional[Dict[str, float]] = None) -> None:
+    import uvicorn
+    app = create_fake_openai_app(ttft_ms, ttft_jitter_ms, tokens_per_second, reply_tokens, ttft_tail_ratio, ttft_tail_ms, model_ttft_ms)
+    uvicorn.run(app, host="127.0.0.1", port=port, log_level="warning")
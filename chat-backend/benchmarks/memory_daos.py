@@ -0,0 +1,121 @@
+"""In-process stand-ins for ConversationDAO and UserDAO so benchmarks need no MongoDB.
+
+They keep documents in dicts and can add a fixed delay to every call to imitate a network round-trip.
+"""
+import asyncio
+from datetime import datetime, timezone
+from typing import Any, AsyncIterator, Dict, List, Optional, Tuple
+
+from models.models import ChatMessage, Conversation, User
+
+
+class InMemoryConversationDAO:
+    def __init__(self, latency_ms: float = 0):
+        self.latency = latency_ms / 1000
+        self.conversations: Dict[str, Conversation] = {}
+
+    async def _round_trip(self) -> None:
+        if self.latency:
+            await asyncio.sleep(self.latency)
+
+    def _copy(self, conversation: Conversation, messages: List[ChatMessage]) -> Conversation:
+        # callers own what they get back, like documents freshly decoded from mongo
+        return conversation.model_copy(update={"messages": list(messages)})
+
+    async def ensure_indexes(self) -> None:
+        pass
+
+    async def create_conversation(self, conversation: Conversation) -> str:
+        await self._round_trip()
+        self.conversations[conversation.conversation_id] = self._copy(conversation, conversation.messages)
+        return conversation.conversation_id
+
+    async def get_conversations_by_user_id(self, user_id: str, limit: int = 10, before_updated_at: Optional[datetime] = None, before_id: Optional[str] = None) -> List[Conversation]:
+        await self._round_trip()
+        conversations = sorted(
+            (conversation for conversation in self.conversations.values() if conversation.user_id == user_id),
+            key=lambda conversation: (conversation.updated_at, conversation.conversation_id),
+            reverse=True,
+        )
+        if before_updated_at is not None:
+            conversations = [conversation for conversation in conversations if (conversation.updated_at, conversation.conversation_id) < (before_updated_at, before_id)]
+        return [self._copy(conversation, conversation.messages[:1]) for conversation in conversations[:limit]]
+
+    async def iter_conversations(self, after_id: Optional[str] = None, batch_size: int = 1000, fields: Optional[List[str]] = None) -> AsyncIterator[List[Dict[str, Any]]]:
+        conversation_ids = sorted(conversation_id for conversation_id in self.conversations if after_id is None or conversation_id > after_id)
+        for start in range(0, len(conversation_ids), batch_size):
+            await self._round_trip()
+            yield [_project(self.conversations[conversation_id].model_dump(by_alias=True), fields) for conversation_id in conversation_ids[start:start + batch_size]]
+
+    async def get_conversation(self, conversation_id: str) -> Optional[Conversation]:
+        await self._round_trip()
+        conversation = self.conversations.get(conversation_id)
+        return self._copy(conversation, conversation.messages) if conversation else None
+
+    async def get_conversation_messages(self, conversation_id: str, limit: int, before: Optional[int] = None) -> Optional[Tuple[List[ChatMessage], int]]:
+        await self._round_trip()
+        conversation = self.conversations.get(conversation_id)
+        if conversation is None:
+            return None
+        end = len(conversation.messages) if before is None else min(before, len(conversation.messages))
+        return conversation.messages[max(end - limit, 0):end], len(conversation.messages)
+
+    async def add_messages_to_conversations(self, messages_by_conversation: Dict[str, List[ChatMessage]]) -> int:
+        await self._round_trip()
+        updated = 0
+        for conversation_id, messages in messages_by_conversation.items():
+            conversation = self.conversations.get(conversation_id)
+            if conversation is None or any(message.message_id == messages[0].message_id for message in conversation.messages):
+                continue
+            conversation.messages.extend(messages)
+            conversation.updated_at = datetime.now(timezone.utc)
+            updated += 1
+        return updated
+
+    async def add_message_to_conversation(self, conversation_id: str, message: ChatMessage) -> bool:
+        return await self.add_messages_to_conversations({conversation_id: [message]}) > 0
+
+    async def update_conversation_summary(self, conversation_id: str, summary: str, summary_message_count: int) -> bool:
+        await self._round_trip()
+        conversation = self.conversations.get(conversation_id)
+        if conversation is None:
+            return False
+        conversation.summary = summary
+        conversation.summary_message_count = summary_message_count
+        return True
+
+
+class InMemoryUserDAO:
+    def __init__(self, latency_ms: float = 0):
+        self.latency = latency_ms / 1000
+        self.users: Dict[str, User] = {}
+
+    async def _round_trip(self) -> None:
+        if self.latency:
+            await asyncio.sleep(self.latency)
+
+    async def create_user(self, user: User) -> str:
+        await self._round_trip()
+        self.users[user.user_id] = user
+        return user.user_id
+
+    async def ensure_user(self, user_id: str) -> bool:
+        await self._round_trip()
+        if user_id in self.users:
+            return False
+        self.users[user_id] = User(_id=user_id)
+        return True
+
+    async def get_user(self, user_id: str) -> Optional[User]:
+        await self._round_trip()
+        return self.users.get(user_id)
+
+    async def iter_users(self, after_id: Optional[str] = None, batch_size: int = 1000, fields: Optional[List[str]] = None) -> AsyncIterator[List[Dict[str, Any]]]:
+        user_ids = sorted(user_id for user_id in self.users if after_id is None or user_id > after_id)
+        for start in range(0, len(user_ids), batch_size):
+            await self._round_trip()
+            yield [_project(self.users[user_id].model_dump(by_alias=True), fields) for user_id in user_ids[start:start + batch_size]]
+
+
+def _project(document: Dict[str, Any], fields: Optional[List[str]]) -> Dict[str, Any]:
+    return document if fields is None else {key: value for key, value in document.items() if key == "_id" or key in fields}
@@ -0,0 +1,293 @@
+"""Load test for the chat websocket that needs no outside services.
+
+Starts a local OpenAI stand-in and the backend (with in-memory DAOs) in subprocesses, then drives
+concurrent websocket clients through connect -> history -> chat -> switch and reports throughput and
+latency. Results are saved as JSON so runs can be compared.
+
+Run from the chat-backend directory, for example:
+    python -m benchmarks.run_benchmark --clients 200 --turns 3
+    python -m benchmarks.run_benchmark --compare benchmarks/results/<earlier run>.json
+"""
+import argparse
+import asyncio
+import json
+import multiprocessing
+import os
+import socket
+import subprocess
+import tempfile
+import time
+import urllib.request
+from datetime import datetime, timezone
+from typing import Any, Dict, List, Optional
+
+import websockets
+
+from benchmarks.bench_server import run_bench_server
+from benchmarks.fake_openai import run_fake_openai
+
+RESULTS_DIR = os.path.join(os.path.dirname(__file__), "results")
+
+# metrics where a higher value is an improvement, used when comparing runs
+HIGHER_IS_BETTER = {"connects_per_second", "frames_per_second", "turns_per_second"}
+
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def wait_for_port(port: int, timeout: float = 20.0) -> None:
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        with socket.socket() as sock:
+            if sock.connect_ex(("127.0.0.1", port)) == 0:
+                return
+        time.sleep(0.05)
+    raise TimeoutError(f"Nothing listening on port {port}")
+
+
+def percentile(values: List[float], fraction: float) -> Optional[float]:
+    if not values:
+        return None
+    ordered = sorted(values)
+    index = min(int(round(fraction * (len(ordered) - 1))), len(ordered) - 1)
+    return ordered[index]
+
+
+class ClientStats:
+    def __init__(self):
+        self.connect_seconds: List[float] = []
+        self.reconnect_seconds: List[float] = []
+        self.ttft_seconds: List[float] = []
+        self.turn_seconds: List[float] = []
+        self.switch_seconds: List[float] = []
+        self.reply_bytes: List[int] = []
+        # bytes read off the socket per reply, smaller than reply_bytes when permessage-deflate is negotiated
+        self.reply_wire_bytes: List[int] = []
+        self.frames = 0
+        self.busy = 0
+        self.errors: List[str] = []
+
+
+async def read_listing(ws, user_id: str) -> List[str]:
+    """Reads the conversation listing sent on connect, returning the conversation ids."""
+    # ######CONVERSATIONS######, then each conversation id followed by its first message, if it has one
+    assert await ws.recv() == "######CONVERSATIONS######"
+    conversation_ids = []
+    while True:
+        frame = await ws.recv()
+        if frame == "######ALL_CONVERSATIONS######":
+            return conversation_ids
+        if frame.startswith(f"{user_id}-"):
+            conversation_ids.append(frame)
+
+
+def count_received_bytes(ws) -> List[int]:
+    """Counts the bytes the connection reads off its socket, in the returned one item list."""
+    received = [0]
+    data_received = ws.data_received
+
+    def counting_data_received(data: bytes) -> None:
+        received[0] += len(data)
+        data_received(data)
+
+    ws.data_received = counting_data_received
+    return received
+
+
+async def run_client(url: str, user_id: str, turns: int, stats: ClientStats) -> None:
+    try:
+        connect_start = time.perf_counter()
+        async with websockets.connect(url, max_size=None) as ws:
+            await read_listing(ws, user_id)
+            stats.connect_seconds.append(time.perf_counter() - connect_start)
+            received = count_received_bytes(ws)
+
+            for turn in range(turns):
+                turn_start = time.perf_counter()
+                received_before = received[0]
+                # unique per client and turn so the response cache can't short-circuit upstream
+                await ws.send(f"benchmark question {user_id}-{turn}: explain event loops")
+                assert await ws.recv() == "######START######"
+                first_frame_at = None
+                reply_bytes = 0
+                while True:
+                    frame = await ws.recv()
+                    if frame == "######END######":
+                        break
+                    if frame == "######BUSY######":
+                        stats.busy += 1
+                        continue
+                    if first_frame_at is None:
+                        first_frame_at = time.perf_counter()
+                    stats.frames += 1
+                    reply_bytes += len(frame.encode())
+                stats.turn_seconds.append(time.perf_counter() - turn_start)
+                if first_frame_at is not None:
+                    stats.ttft_seconds.append(first_frame_at - turn_start)
+                    stats.reply_bytes.append(reply_bytes)
+                    stats.reply_wire_bytes.append(received[0] - received_before)
+
+        # a new user's first conversation is only listed once it has messages, so come back to switch to it
+        reconnect_start = time.perf_counter()
+        async with websockets.connect(url, max_size=None) as ws:
+            conversation_ids = await read_listing(ws, user_id)
+            stats.reconnect_seconds.append(time.perf_counter() - reconnect_start)
+            if conversation_ids:
+                switch_start = time.perf_counter()
+                await ws.send("######SWITCH_CONVERSATION_PAGED######")
+                await ws.send(conversation_ids[0])
+                await ws.recv()
+                stats.switch_seconds.append(time.perf_counter() - switch_start)
+    except Exception as e:
+        stats.errors.append(f"{type(e).__name__}: {e}")
+
+
+async def drive_clients(port: int, clients: int, turns: int, stream_mode: str, ramp_seconds: float) -> Dict[str, Any]:
+    stats = ClientStats()
+    run_id = int(time.time())
+
+    async def start_client(index: int) -> None:
+        await asyncio.sleep(ramp_seconds * index / clients)
+        # no dashes in the user id, conversation ids are "<user_id>-<uuid>"
+        user_id = f"bench{run_id}x{index}"
+        await run_client(f"ws://127.0.0.1:{port}/chat/{user_id}?stream_mode={stream_mode}", user_id, turns, stats)
+
+    started = time.perf_counter()
+    await asyncio.gather(*(start_client(index) for index in range(clients)))
+    duration = time.perf_counter() - started
+
+    connect_window = max(stats.connect_seconds) + ramp_seconds if stats.connect_seconds else 0
+    return {
+        "duration_s": round(duration, 3),
+        "connects_per_second": round(len(stats.connect_seconds) / connect_window, 2) if connect_window else 0,
+        "connect_p50_ms": _ms(percentile(stats.connect_seconds, 0.5)),
+        "connect_p99_ms": _ms(percentile(stats.connect_seconds, 0.99)),
+        "reconnect_p50_ms": _ms(percentile(stats.reconnect_seconds, 0.5)),
+        "reconnect_p99_ms": _ms(percentile(stats.reconnect_seconds, 0.99)),
+        "ttft_p50_ms": _ms(percentile(stats.ttft_seconds, 0.5)),
+        "ttft_p99_ms": _ms(percentile(stats.ttft_seconds, 0.99)),
+        "turn_p50_ms": _ms(percentile(stats.turn_seconds, 0.5)),
+        "turn_p99_ms": _ms(percentile(stats.turn_seconds, 0.99)),
+        "switch_p50_ms": _ms(percentile(stats.switch_seconds, 0.5)),
+        "switch_p99_ms": _ms(percentile(stats.switch_seconds, 0.99)),
+        "turns_per_second": round(len(stats.turn_seconds) / duration, 2),
+        "frames_per_second": round(stats.frames / duration, 2),
+        "bytes_per_reply": round(sum(stats.reply_bytes) / len(stats.reply_bytes), 1) if stats.reply_bytes else 0,
+        "wire_bytes_per_reply": round(sum(stats.reply_wire_bytes) / len(stats.reply_wire_bytes), 1) if stats.reply_wire_bytes else 0,
+        "busy_replies": stats.busy,
+        "errors": len(stats.errors),
+        "error_samples": stats.errors[:5],
+    }
+
+
+def _ms(seconds: Optional[float]) -> Optional[float]:
+    return round(seconds * 1000, 2) if seconds is not None else None
+
+
+def fetch_json(url: str, method: str = "GET") -> Any:
+    request = urllib.request.Request(url, method=method)
+    with urllib.request.urlopen(request, timeout=10) as response:
+        return json.loads(response.read())
+
+
+def compare(previous: Dict[str, Any], current: Dict[str, Any]) -> None:
+    print(f"\nCompared with {previous.get('timestamp')} ({previous.get('git_commit')}):")
+    for name, value in current["results"].items():
+        old = previous.get("results", {}).get(name)
+        if not isinstance(value, (int, float)) or not isinstance(old, (int, float)) or old == 0:
+            continue
+        change = (value - old) / old * 100
+        better = change > 0 if name in HIGHER_IS_BETTER else change < 0
+        marker = "" if abs(change) < 5 else (" better" if better else " WORSE")
+        print(f"  {name:<22} {old:>12} -> {value:<12} ({change:+.1f}%){marker}")
+
+
+def git_commit() -> Optional[str]:
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--clients", type=int, default=100, help="concurrent websocket clients")
+    parser.add_argument("--turns", type=int, default=3, help="chat turns per client")
+    parser.add_argument("--ramp-seconds", type=float, default=1.0, help="spread client connects over this many seconds")
+    parser.add_argument("--stream-mode", choices=["cumulative", "delta"], default="delta")
+    parser.add_argument("--ttft-ms", type=float, default=300, help="fake OpenAI time to first token")
+    parser.add_argument("--ttft-jitter-ms", type=float, default=100, help="uniform jitter added to the time to first token")
+    parser.add_argument("--ttft-tail-ratio", type=float, default=0.0, help="fraction of fake OpenAI requests that are slow to start")
+    parser.add_argument("--ttft-tail-ms", type=float, default=0.0, help="extra time to first token of the slow requests")
+    parser.add_argument("--model-ttft", action="append", default=[], metavar="MODEL=MS", help="time to first token of one model, repeatable")
+    parser.add_argument("--tokens-per-second", type=float, default=80, help="fake OpenAI token rate per stream")
+    parser.add_argument("--reply-tokens", type=int, default=400, help="tokens per fake reply")
+    parser.add_argument("--conversation-store", choices=["memory", "segment_log"], default="memory",
+                        help="memory: in-memory stand-in for mongo; segment_log: the local segment log in a temporary directory")
+    parser.add_argument("--dao-latency-ms", type=float, default=1, help="simulated round-trip of every in-memory DAO call")
+    parser.add_argument("--env", action="append", default=[], metavar="NAME=VALUE", help="extra settings for the backend, repeatable")
+    parser.add_argument("--output-dir", default=RESULTS_DIR)
+    parser.add_argument("--compare", help="earlier result file to compare this run against")
+    args = parser.parse_args()
+
+    environment = {
+        # each prompt is unique anyway, keep the cache and pacing out of the measurement unless asked for
+        "RESPONSE_CACHE_ENABLED": "false",
+        "LLM_REQUESTS_PER_MINUTE": "1000000",
+        "LLM_TOKENS_PER_MINUTE": "1000000000",
+        # per-turn records would go to this terminal
+        "LOG_LEVEL": "WARNING",
+    }
+    if args.conversation_store != "memory":
+        environment["CONVERSATION_STORE"] = args.conversation_store
+        environment["SEGMENT_LOG_DIR"] = tempfile.mkdtemp(prefix="bench-segment-log-")
+    environment.update(item.split("=", 1) for item in args.env)
+
+    openai_port, server_port = free_port(), free_port()
+    context = multiprocessing.get_context("spawn")
+    processes = [
+        context.Process(target=run_fake_openai, args=(
+            openai_port, args.ttft_ms, args.ttft_jitter_ms, args.tokens_per_second, args.reply_tokens, args.ttft_tail_ratio, args.ttft_tail_ms,
+            {model: float(ms) for model, ms in (item.split("=", 1) for item in args.model_ttft)},
+        ), daemon=True),
+        context.Process(target=run_bench_server, args=(server_port, openai_port, args.dao_latency_ms, environment, args.conversation_store), daemon=True),
+    ]
+    for process in processes:
+        process.start()
+    try:
+        wait_for_port(openai_port)
+        wait_for_port(server_port)
+        fetch_json(f"http://127.0.0.1:{server_port}/bench/loop-lag/reset", method="POST")
+        results = asyncio.run(drive_clients(server_port, args.clients, args.turns, args.stream_mode, args.ramp_seconds))
+        lag = fetch_json(f"http://127.0.0.1:{server_port}/bench/loop-lag")["samples"]
+        results["loop_lag_p50_ms"] = _ms(percentile(lag, 0.5))
+        results["loop_lag_p99_ms"] = _ms(percentile(lag, 0.99))
+        results["loop_lag_max_ms"] = _ms(max(lag) if lag else None)
+        results["routing"] = fetch_json(f"http://127.0.0.1:{server_port}/stats/routing")
+    finally:
+        for process in processes:
+            process.terminate()
+            process.join(timeout=5)
+
+    run = {
+        "timestamp": datetime.now(timezone.utc).isoformat(),
+        "git_commit": git_commit(),
+        "config": {key: value for key, value in vars(args).items() if key not in ("output_dir", "compare")},
+        "results": results,
+    }
+    print(json.dumps(run, indent=2))
+    os.makedirs(args.output_dir, exist_ok=True)
+    path = os.path.join(args.output_dir, f"{datetime.now().strftime('%Y%m%d-%H%M%S')}-{run['git_commit'] or 'local'}.json")
+    with open(path, "w") as results_file:
+        json.dump(run, results_file, indent=2)
+    print(f"\nSaved results to {path}")
+    if args.compare:
+        with open(args.compare) as previous_file:
+            compare(json.load(previous_file), run)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,22 +1,57 @@
-import os
-from dotenv import load_dotenv
-from openai import AsyncOpenAI
-from pymongo import MongoClient
 import logging
-
-load_dotenv()
+from typing import Optional
+import httpx
+from openai import AsyncOpenAI, OpenAIError
+from config import settings
 
 logger = logging.getLogger(__name__)
 
+# one pooled client per worker process, owned by the app lifespan in main.py
+_openai_client: Optional[AsyncOpenAI] = None
+
+
+def connect_openai_client() -> AsyncOpenAI:
+    global _openai_client
+    if _openai_client is None:
+        http_client = httpx.AsyncClient(
+            limits=httpx.Limits(
+                max_connections=settings.OPENAI_MAX_CONNECTIONS,
+                max_keepalive_connections=settings.OPENAI_MAX_KEEPALIVE_CONNECTIONS,
+                keepalive_expiry=settings.OPENAI_KEEPALIVE_EXPIRY_S,
+            ),
+            timeout=httpx.Timeout(settings.OPENAI_READ_TIMEOUT_S, connect=settings.OPENAI_CONNECT_TIMEOUT_S),
+        )
+        _openai_client = AsyncOpenAI(
+            api_key=settings.OPENAI_API_KEY,
+            max_retries=settings.OPENAI_MAX_RETRIES,
+            http_client=http_client,
+        )
+        logger.info(f"Created OpenAI client pool (max_connections={settings.OPENAI_MAX_CONNECTIONS})")
+    return _openai_client
 
-async def get_openai_client():
-    gpt_client = AsyncOpenAI(api_key=os.environ.get('OPENAI_API_KEY'))
-    logger.info("Connected to OpenAI client")
+
+async def warm_up_openai_client() -> None:
+    if not settings.OPENAI_WARMUP:
+        return
+    # opens a keep-alive connection (and its TLS session) before the first chat request
     try:
-        yield gpt_client
-    finally:
-        await gpt_client.close()
-        logger.info("Disconnected from the OpenAI client")
+        await connect_openai_client().models.list()
+        logger.info("Connected to OpenAI client")
+    except OpenAIError as e:
+        logger.error(f"Failed to warm up OpenAI client: {e}")
 
 
+def openai_client_ready() -> bool:
+    return _openai_client is not None and not _openai_client.is_closed()
+
+
+async def close_openai_client() -> None:
+    global _openai_client
+    if _openai_client is not None:
+        await _openai_client.close()
+        _openai_client = None
+        logger.info("Disconnected from the OpenAI client")
+
 
+def get_openai_client() -> AsyncOpenAI:
+    return connect_openai_client()
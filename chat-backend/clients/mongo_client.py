@@ -1,21 +1,59 @@
-import os
-from dotenv import load_dotenv
-from pymongo import MongoClient
 import logging
-
-load_dotenv()
+from typing import Optional
+from pymongo import AsyncMongoClient
+from pymongo.errors import PyMongoError
+from config import settings
 
 logger = logging.getLogger(__name__)
 
+# one pooled client per worker process, owned by the app lifespan in main.py
+_mongo_client: Optional[AsyncMongoClient] = None
+
+
+def connect_mongo_client() -> AsyncMongoClient:
+    global _mongo_client
+    if _mongo_client is None:
+        _mongo_client = AsyncMongoClient(
+            settings.MONGO_CONNECTION_STRING,
+            maxPoolSize=settings.MONGO_MAX_POOL_SIZE,
+            minPoolSize=settings.MONGO_MIN_POOL_SIZE,
+            maxIdleTimeMS=settings.MONGO_MAX_IDLE_TIME_MS,
+            connectTimeoutMS=settings.MONGO_CONNECT_TIMEOUT_MS,
+            socketTimeoutMS=settings.MONGO_SOCKET_TIMEOUT_MS,
+            serverSelectionTimeoutMS=settings.MONGO_SERVER_SELECTION_TIMEOUT_MS,
+            waitQueueTimeoutMS=settings.MONGO_WAIT_QUEUE_TIMEOUT_MS,
+        )
+        logger.info(f"Created mongo client pool (maxPoolSize={settings.MONGO_MAX_POOL_SIZE})")
+    return _mongo_client
 
-async def get_mongo_client():
-    CONNECTION_STRING = os.environ.get("MONGO_CONNECTION_STRING")
-    client = MongoClient(CONNECTION_STRING)
-    logger.info("Connected to mongo")
+
+async def warm_up_mongo_client() -> None:
+    # forces server selection and opens the first pooled connection so the first request doesn't pay for it
     try:
-        yield client
-    finally:
-        client.close()
+        await connect_mongo_client().admin.command("ping")
+        logger.info("Connected to mongo")
+    except PyMongoError as e:
+        logger.error(f"Failed to warm up mongo client: {e}")
+
+
+async def ping_mongo() -> bool:
+    if _mongo_client is None:
+        return False
+    try:
+        await _mongo_client.admin.command("ping")
+        return True
+    except PyMongoError as e:
+        logger.error(f"Mongo health check failed: {e}")
+        return False
+
+
+async def close_mongo_client() -> None:
+    global _mongo_client
+    if _mongo_client is not None:
+        await _mongo_client.close()
+        _mongo_client = None
         logger.info("Disconnected from mongo")
 
 
+def get_mongo_client() -> AsyncMongoClient:
+    return connect_mongo_client()
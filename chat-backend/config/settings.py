@@ -0,0 +1,173 @@
+import os
+from dotenv import load_dotenv
+
+load_dotenv()
+
+
+def _int_env(name: str, default: int) -> int:
+    value = os.environ.get(name)
+    return int(value) if value not in (None, "") else default
+
+
+def _float_env(name: str, default: float) -> float:
+    value = os.environ.get(name)
+    return float(value) if value not in (None, "") else default
+
+
+def _bool_env(name: str, default: bool) -> bool:
+    value = os.environ.get(name)
+    if value in (None, ""):
+        return default
+    return value.strip().lower() in ("1", "true", "yes", "on")
+
+
+# mongo connection pool
+MONGO_CONNECTION_STRING = os.environ.get("MONGO_CONNECTION_STRING")
+MONGO_DATABASE = os.environ.get("MONGO_DATABASE", "chat-bot")
+MONGO_MAX_POOL_SIZE = _int_env("MONGO_MAX_POOL_SIZE", 100)
+MONGO_MIN_POOL_SIZE = _int_env("MONGO_MIN_POOL_SIZE", 5)
+MONGO_MAX_IDLE_TIME_MS = _int_env("MONGO_MAX_IDLE_TIME_MS", 300000)
+MONGO_CONNECT_TIMEOUT_MS = _int_env("MONGO_CONNECT_TIMEOUT_MS", 5000)
+MONGO_SOCKET_TIMEOUT_MS = _int_env("MONGO_SOCKET_TIMEOUT_MS", 20000)
+MONGO_SERVER_SELECTION_TIMEOUT_MS = _int_env("MONGO_SERVER_SELECTION_TIMEOUT_MS", 5000)
+MONGO_WAIT_QUEUE_TIMEOUT_MS = _int_env("MONGO_WAIT_QUEUE_TIMEOUT_MS", 10000)
+
+# where conversations are stored: "mongo", or "segment_log" for an append-only log on local disk (users stay in mongo)
+CONVERSATION_STORE = os.environ.get("CONVERSATION_STORE", "mongo")
+SEGMENT_LOG_DIR = os.environ.get("SEGMENT_LOG_DIR", "data/conversations")
+SEGMENT_LOG_MAX_SEGMENT_BYTES = _int_env("SEGMENT_LOG_MAX_SEGMENT_BYTES", 64 * 1024 * 1024)
+# fsync after every append; without it a crash of the machine (not just the process) can lose the last writes
+SEGMENT_LOG_FSYNC = _bool_env("SEGMENT_LOG_FSYNC", False)
+SEGMENT_LOG_COMPACTION_INTERVAL_S = _float_env("SEGMENT_LOG_COMPACTION_INTERVAL_S", 300.0)
+# compact once this share of the sealed segments is superseded records
+SEGMENT_LOG_COMPACTION_MIN_GARBAGE_RATIO = _float_env("SEGMENT_LOG_COMPACTION_MIN_GARBAGE_RATIO", 0.5)
+
+# compression of stored message content: "zlib", "zstd" (needs the zstandard package) or "none"; see content_codec.py
+MESSAGE_COMPRESSION = os.environ.get("MESSAGE_COMPRESSION", "zlib").lower()
+MESSAGE_COMPRESSION_MIN_CHARS = _int_env("MESSAGE_COMPRESSION_MIN_CHARS", 1024)
+MESSAGE_COMPRESSION_LEVEL = _int_env("MESSAGE_COMPRESSION_LEVEL", 6)
+
+# permessage-deflate on the chat websocket when started with `python main.py` (websocket_compression.py)
+WS_DEFLATE_ENABLED = _bool_env("WS_DEFLATE_ENABLED", True)
+WS_DEFLATE_LEVEL = _int_env("WS_DEFLATE_LEVEL", 6)
+# LZ77 window of 2**bits bytes (9 to 15); smaller windows keep less memory per connection
+WS_DEFLATE_WINDOW_BITS = _int_env("WS_DEFLATE_WINDOW_BITS", 12)
+
+# logging; records are written by a background thread, see structured_logging.py
+LOG_LEVEL = os.environ.get("LOG_LEVEL", "INFO").upper()
+# "json" for one JSON object per line, "text" for plain lines with key=value fields
+LOG_FORMAT = os.environ.get("LOG_FORMAT", "json")
+# share of DEBUG and INFO records kept; warnings and errors are always kept
+LOG_SAMPLE_RATE = _float_env("LOG_SAMPLE_RATE", 1.0)
+LOG_MAX_FIELD_CHARS = _int_env("LOG_MAX_FIELD_CHARS", 1000)
+# replace fields holding user content (messages, replies, summaries) with their size
+LOG_REDACT_CONTENT = _bool_env("LOG_REDACT_CONTENT", True)
+# records waiting for the writer thread; more are dropped rather than blocking the event loop
+LOG_QUEUE_SIZE = _int_env("LOG_QUEUE_SIZE", 10000)
+
+# openai http connection pool
+OPENAI_API_KEY = os.environ.get("OPENAI_API_KEY")
+OPENAI_MAX_CONNECTIONS = _int_env("OPENAI_MAX_CONNECTIONS", 100)
+OPENAI_MAX_KEEPALIVE_CONNECTIONS = _int_env("OPENAI_MAX_KEEPALIVE_CONNECTIONS", 20)
+OPENAI_KEEPALIVE_EXPIRY_S = _float_env("OPENAI_KEEPALIVE_EXPIRY_S", 30.0)
+OPENAI_CONNECT_TIMEOUT_S = _float_env("OPENAI_CONNECT_TIMEOUT_S", 5.0)
+OPENAI_READ_TIMEOUT_S = _float_env("OPENAI_READ_TIMEOUT_S", 60.0)
+OPENAI_MAX_RETRIES = _int_env("OPENAI_MAX_RETRIES", 2)
+# warming up the openai pool costs a (free) models.list call, so it is opt in
+OPENAI_WARMUP = _bool_env("OPENAI_WARMUP", False)
+
+# websocket response streaming; deltas are coalesced into one frame per interval or size budget
+STREAM_FLUSH_INTERVAL_MS = _int_env("STREAM_FLUSH_INTERVAL_MS", 30)
+STREAM_FLUSH_BYTES = _int_env("STREAM_FLUSH_BYTES", 256)
+# resumable replies (?resumable=true) keep generating this long after the client drops, waiting for a resume
+RESUME_GRACE_S = _float_env("RESUME_GRACE_S", 30.0)
+# and can be resumed this long after they finished
+RESUME_TTL_S = _float_env("RESUME_TTL_S", 120.0)
+RESUME_MAX_STREAMS = _int_env("RESUME_MAX_STREAMS", 10000)
+
+# process-wide conversation caches (LRU with a TTL)
+CACHE_TTL_S = _float_env("CACHE_TTL_S", 600.0)
+CONVERSATION_CACHE_MAX_ENTRIES = _int_env("CONVERSATION_CACHE_MAX_ENTRIES", 10000)
+CONVERSATION_CACHE_MAX_MESSAGES = _int_env("CONVERSATION_CACHE_MAX_MESSAGES", 200000)
+USER_CACHE_MAX_ENTRIES = _int_env("USER_CACHE_MAX_ENTRIES", 10000)
+USER_CACHE_MAX_CONVERSATIONS = _int_env("USER_CACHE_MAX_CONVERSATIONS", 100000)
+
+# write-behind message persistence
+PERSIST_FLUSH_INTERVAL_MS = _int_env("PERSIST_FLUSH_INTERVAL_MS", 100)
+PERSIST_MAX_BATCH_CONVERSATIONS = _int_env("PERSIST_MAX_BATCH_CONVERSATIONS", 500)
+PERSIST_MAX_PENDING_MESSAGES = _int_env("PERSIST_MAX_PENDING_MESSAGES", 10000)
+PERSIST_MAX_RETRIES = _int_env("PERSIST_MAX_RETRIES", 5)
+PERSIST_RETRY_BACKOFF_MS = _int_env("PERSIST_RETRY_BACKOFF_MS", 100)
+
+# prompt context window
+CHAT_MODEL = os.environ.get("CHAT_MODEL", "gpt-4o")
+# faster models for small prompts, tried in order: comma separated "model:max_message_tokens:max_history_messages",
+# e.g. "gpt-4o-mini:200:4"; prompts that fit no tier go to CHAT_MODEL
+CHAT_MODEL_TIERS = os.environ.get("CHAT_MODEL_TIERS", "")
+# hedged completions: a second identical request when the first has no token after the model's recent HEDGE_PERCENTILE
+# time to first token (HEDGE_INITIAL_DELAY_MS until HEDGE_MIN_SAMPLES are seen), for at most HEDGE_MAX_RATIO of requests
+HEDGE_ENABLED = _bool_env("HEDGE_ENABLED", False)
+HEDGE_PERCENTILE = _float_env("HEDGE_PERCENTILE", 0.95)
+HEDGE_INITIAL_DELAY_MS = _int_env("HEDGE_INITIAL_DELAY_MS", 2000)
+HEDGE_MIN_DELAY_MS = _int_env("HEDGE_MIN_DELAY_MS", 100)
+HEDGE_MIN_SAMPLES = _int_env("HEDGE_MIN_SAMPLES", 20)
+HEDGE_WINDOW = _int_env("HEDGE_WINDOW", 500)
+HEDGE_MAX_RATIO = _float_env("HEDGE_MAX_RATIO", 0.1)
+CONTEXT_TOKEN_BUDGET = _int_env("CONTEXT_TOKEN_BUDGET", 8000)
+# fold messages that no longer fit the budget into a rolling summary stored on the conversation
+CONTEXT_SUMMARY_ENABLED = _bool_env("CONTEXT_SUMMARY_ENABLED", False)
+CONTEXT_SUMMARY_MODEL = os.environ.get("CONTEXT_SUMMARY_MODEL", "gpt-4o-mini")
+CONTEXT_SUMMARY_MIN_MESSAGES = _int_env("CONTEXT_SUMMARY_MIN_MESSAGES", 6)
+CONTEXT_SUMMARY_MAX_TOKENS = _int_env("CONTEXT_SUMMARY_MAX_TOKENS", 400)
+# send the recent tail of history plus the earlier turns most similar to the new message, instead of only recent history
+CONTEXT_RELEVANCE_ENABLED = _bool_env("CONTEXT_RELEVANCE_ENABLED", False)
+CONTEXT_RELEVANCE_RECENT_MESSAGES = _int_env("CONTEXT_RELEVANCE_RECENT_MESSAGES", 6)
+CONTEXT_RELEVANCE_TOP_TURNS = _int_env("CONTEXT_RELEVANCE_TOP_TURNS", 4)
+CONTEXT_RELEVANCE_MIN_SIMILARITY = _float_env("CONTEXT_RELEVANCE_MIN_SIMILARITY", 0.1)
+# hashed vector size, a power of two; each cached message costs 4 bytes per dimension
+CONTEXT_RELEVANCE_DIMENSIONS = _int_env("CONTEXT_RELEVANCE_DIMENSIONS", 512)
+CONTEXT_RELEVANCE_MAX_CONVERSATIONS = _int_env("CONTEXT_RELEVANCE_MAX_CONVERSATIONS", 1000)
+CONTEXT_RELEVANCE_MAX_VECTORS = _int_env("CONTEXT_RELEVANCE_MAX_VECTORS", 50000)
+
+# cache of complete temperature 0 responses, keyed on the exact prompt
+RESPONSE_CACHE_ENABLED = _bool_env("RESPONSE_CACHE_ENABLED", True)
+RESPONSE_CACHE_MAX_ENTRIES = _int_env("RESPONSE_CACHE_MAX_ENTRIES", 5000)
+RESPONSE_CACHE_MAX_CHARS = _int_env("RESPONSE_CACHE_MAX_CHARS", 20000000)
+RESPONSE_CACHE_TTL_S = _int_env("RESPONSE_CACHE_TTL_S", 86400)
+RESPONSE_CACHE_MONGO_ENABLED = _bool_env("RESPONSE_CACHE_MONGO_ENABLED", False)
+# comma separated user ids whose requests never read or write the cache
+RESPONSE_CACHE_BYPASS_USERS = {user_id.strip() for user_id in os.environ.get("RESPONSE_CACHE_BYPASS_USERS", "").split(",") if user_id.strip()}
+RESPONSE_CACHE_REPLAY_CHUNK_CHARS = _int_env("RESPONSE_CACHE_REPLAY_CHUNK_CHARS", 64)
+
+# number of messages per history page sent when switching conversations
+HISTORY_PAGE_SIZE = _int_env("HISTORY_PAGE_SIZE", 50)
+# per-user full-text search over conversations, see services/search_index.py
+SEARCH_INDEX_DIR = os.environ.get("SEARCH_INDEX_DIR", "data/search")
+SEARCH_INDEX_MAX_USERS = _int_env("SEARCH_INDEX_MAX_USERS", 1000)
+SEARCH_INDEX_MAX_MESSAGES = _int_env("SEARCH_INDEX_MAX_MESSAGES", 500000)
+SEARCH_INDEX_FLUSH_INTERVAL_S = _float_env("SEARCH_INDEX_FLUSH_INTERVAL_S", 30.0)
+SEARCH_RESULTS_LIMIT = _int_env("SEARCH_RESULTS_LIMIT", 10)
+
+# NDJSON exports (GET /api/export/...) read every user's data, so they are off unless enabled; with a token set,
+# requests must send it as "Authorization: Bearer <token>"
+EXPORT_ENABLED = _bool_env("EXPORT_ENABLED", False)
+EXPORT_TOKEN = os.environ.get("EXPORT_TOKEN")
+# documents read per batch and gzip level when asked for
+EXPORT_BATCH_SIZE = _int_env("EXPORT_BATCH_SIZE", 500)
+EXPORT_GZIP_LEVEL = _int_env("EXPORT_GZIP_LEVEL", 6)
+
+# on connect, load the most recent conversation into the cache while the client reads the listing
+CONNECT_PREFETCH_HISTORY = _bool_env("CONNECT_PREFETCH_HISTORY", True)
+
+# admission control for upstream chat completions
+LLM_MAX_CONCURRENCY = _int_env("LLM_MAX_CONCURRENCY", 64)
+LLM_MAX_CONCURRENCY_PER_USER = _int_env("LLM_MAX_CONCURRENCY_PER_USER", 2)
+LLM_MAX_QUEUE = _int_env("LLM_MAX_QUEUE", 256)
+LLM_MAX_QUEUE_PER_USER = _int_env("LLM_MAX_QUEUE_PER_USER", 4)
+LLM_QUEUE_TIMEOUT_S = _float_env("LLM_QUEUE_TIMEOUT_S", 30.0)
+LLM_REQUESTS_PER_MINUTE = _int_env("LLM_REQUESTS_PER_MINUTE", 500)
+LLM_TOKENS_PER_MINUTE = _int_env("LLM_TOKENS_PER_MINUTE", 300000)
+# completion tokens reserved per request until the real usage is known
+LLM_EXPECTED_COMPLETION_TOKENS = _int_env("LLM_EXPECTED_COMPLETION_TOKENS", 500)
+LLM_BACKOFF_BASE_S = _float_env("LLM_BACKOFF_BASE_S", 1.0)
+LLM_BACKOFF_MAX_S = _float_env("LLM_BACKOFF_MAX_S", 30.0)
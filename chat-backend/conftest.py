@@ -0,0 +1 @@
+# makes the app's top level packages importable from tests/, as they are when running from this directory
@@ -0,0 +1,62 @@
+"""Transparent compression of stored message content.
+
+Content of at least MESSAGE_COMPRESSION_MIN_CHARS is compressed with MESSAGE_COMPRESSION when written, and
+stored together with the name of its encoding so it can be read back whatever the setting is later changed to.
+Shorter content stays as it is, since compressing it saves little and costs a copy on every read.
+"""
+import logging
+import zlib
+from typing import Optional, Tuple
+
+from config import settings
+
+logger = logging.getLogger(__name__)
+
+ENCODING_ZLIB = "zlib"
+ENCODING_ZSTD = "zstd"
+
+try:
+    import zstandard
+except ImportError:
+    # zstandard is optional; without it content is written with zlib and zstd content can't be read
+    zstandard = None
+
+if settings.MESSAGE_COMPRESSION == ENCODING_ZSTD and zstandard is None:
+    logger.warning("MESSAGE_COMPRESSION is zstd but zstandard isn't installed, compressing with zlib")
+    _encoding: Optional[str] = ENCODING_ZLIB
+elif settings.MESSAGE_COMPRESSION in (ENCODING_ZLIB, ENCODING_ZSTD):
+    _encoding = settings.MESSAGE_COMPRESSION
+else:
+    _encoding = None
+
+
+def compress(data: bytes) -> Optional[Tuple[str, bytes]]:
+    """Returns (encoding, compressed data), or None when compression is off or doesn't make data smaller."""
+    if _encoding == ENCODING_ZSTD:
+        compressed = zstandard.ZstdCompressor(level=settings.MESSAGE_COMPRESSION_LEVEL).compress(data)
+    elif _encoding == ENCODING_ZLIB:
+        compressed = zlib.compress(data, settings.MESSAGE_COMPRESSION_LEVEL)
+    else:
+        return None
+    return (_encoding, compressed) if len(compressed) < len(data) else None
+
+
+def decompress(encoding: str, data: bytes) -> bytes:
+    if encoding == ENCODING_ZLIB:
+        return zlib.decompress(data)
+    if encoding == ENCODING_ZSTD:
+        if zstandard is None:
+            raise RuntimeError("Stored content is zstd compressed but zstandard isn't installed")
+        return zstandard.ZstdDecompressor().decompress(data)
+    raise ValueError(f"Unknown content encoding {encoding}")
+
+
+def encode_content(content: str) -> Optional[Tuple[str, bytes]]:
+    """Returns (encoding, compressed content) for content long enough to compress, otherwise None."""
+    if len(content) < settings.MESSAGE_COMPRESSION_MIN_CHARS:
+        return None
+    return compress(content.encode())
+
+
+def decode_content(encoding: str, data: bytes) -> str:
+    return decompress(encoding, data).decode()
@@ -1,66 +1,158 @@
 import logging
-from pymongo import MongoClient
-from pymongo.errors import PyMongoError
-from typing import Annotated, List, Optional
+from datetime import datetime, timezone
+from bson import Binary
+from pymongo import ASCENDING, DESCENDING, AsyncMongoClient, UpdateOne
+from pymongo.errors import ConnectionFailure, ExecutionTimeout, PyMongoError, WTimeoutError
+from typing import Annotated, Any, AsyncIterator, Dict, List, Optional, Tuple, Union
 from fastapi import Depends
-from pymongo.database import Database
-from pymongo.collection import Collection
+from pymongo.asynchronous.database import AsyncDatabase
+from pymongo.asynchronous.collection import AsyncCollection
 from clients.mongo_client import get_mongo_client
-from models.models import ChatMessage, Conversation
-from exceptions.custom_exceptions import DatabaseError
+from config import settings
+from content_codec import encode_content
+from metrics import DAO_DURATION, instrument_dao
+from models.models import ChatMessage, Conversation, StoredMessage
+from exceptions.custom_exceptions import DatabaseError, TransientDatabaseError
 
 logger = logging.getLogger(__name__)
 
+
+def message_document(message: Union[ChatMessage, StoredMessage], compress: bool = True) -> Dict[str, Any]:
+    """Long content is stored compressed, as content_z with its encoding, unless compress is off."""
+    document = {"role": message.role, "message_id": message.message_id, "content": message.content, "token_count": message.token_count, "truncated": message.truncated}
+    encoded = encode_content(message.content) if compress else None
+    if encoded is not None:
+        del document["content"]
+        document["encoding"], document["content_z"] = encoded[0], Binary(encoded[1])
+    return document
+
+
+@instrument_dao
 class ConversationDAO:
-    def __init__(self, client: Annotated[MongoClient, Depends(get_mongo_client)]):
-        self.db = client.get_database("chat-bot")
-        self.collection: Collection = self.db['conversations']
+    def __init__(self, client: Annotated[AsyncMongoClient, Depends(get_mongo_client)]):
+        self.db: AsyncDatabase = client.get_database(settings.MONGO_DATABASE)
+        self.collection: AsyncCollection = self.db['conversations']
+
+    async def ensure_indexes(self) -> None:
+        try:
+            # serves the per-user listing sorted by most recently updated, including its keyset pagination
+            await self.collection.create_index([("user_id", ASCENDING), ("updated_at", DESCENDING), ("_id", DESCENDING)])
+        except PyMongoError as e:
+            logger.error(f"Failed to create conversation indexes: {e}")
+            raise DatabaseError("Failed to create conversation indexes")
 
-    def create_conversation(self, conversation: Conversation) -> str:
+    async def create_conversation(self, conversation: Conversation) -> str:
         try:
-            logger.info(f"Creating conversation: {conversation.conversation_id}")
-            result = self.collection.insert_one(conversation.model_dump(by_alias=True))
+            logger.debug("Creating conversation: %s", conversation.conversation_id)
+            result = await self.collection.insert_one(conversation.model_dump(by_alias=True))
             return str(result.inserted_id)
         except PyMongoError as e:
             logger.error(f"Failed to create conversation: {e}")
             raise DatabaseError("Failed to create conversation")
     
-    def get_conversations_by_user_id(self, user_id: str, skip: int = 0, limit: int = 10) -> List[Conversation]:
+    async def get_conversations_by_user_id(self, user_id: str, limit: int = 10, before_updated_at: Optional[datetime] = None, before_id: Optional[str] = None) -> List[Conversation]:
+        """Lists a user's conversations, most recently updated first, with only their first message.
+
+        Pass the updated_at and conversation_id of the last conversation of a page to get the next one.
+        """
+        query = {"user_id": user_id}
+        if before_updated_at is not None:
+            query["$or"] = [
+                {"updated_at": {"$lt": before_updated_at}},
+                {"updated_at": before_updated_at, "_id": {"$lt": before_id}},
+            ]
         try:
-            conversation_cursor = self.collection.find({"_id": {"$regex": f"^{user_id}-"}}).skip(skip).limit(limit)
-            conversations = [Conversation(**data, user_id=user_id) for data in conversation_cursor]
+            conversation_cursor = self.collection.find(
+                query,
+                {"user_id": 1, "updated_at": 1, "messages": {"$slice": 1}}
+            ).sort([("updated_at", DESCENDING), ("_id", DESCENDING)]).limit(limit)
+            conversations = [Conversation.from_document(data) async for data in conversation_cursor]
             return conversations
         except PyMongoError as e:
             logger.error(f"Failed to get conversations for user {user_id}: {e}")
             raise DatabaseError(f"Failed to get conversations for user {user_id}")
 
-    def get_conversation(self, conversation_id: str) -> Optional[Conversation]:
+    async def backfill_user_fields(self, batch_size: int = 1000) -> int:
+        """Sets user_id and updated_at on conversations stored before they existed, returning how many were updated."""
+        updated = 0
+        now = datetime.now(timezone.utc)
         try:
-            logger.info(f"Getting conversation {conversation_id}")
-            conversation_data = self.collection.find_one({"_id": conversation_id})
-            return Conversation(**conversation_data) if conversation_data else None
+            while True:
+                batch = await self.collection.find(
+                    {"$or": [{"user_id": {"$exists": False}}, {"user_id": None}, {"updated_at": {"$exists": False}}]},
+                    {"_id": 1}
+                ).limit(batch_size).to_list(length=batch_size)
+                if not batch:
+                    return updated
+                operations = [
+                    # conversation ids are prefixed with the id of the user that started them
+                    UpdateOne({"_id": data["_id"]}, [{"$set": {
+                        "user_id": {"$ifNull": ["$user_id", str(data["_id"]).split("-")[0]]},
+                        "updated_at": {"$ifNull": ["$updated_at", now]},
+                    }}])
+                    for data in batch
+                ]
+                result = await self.collection.bulk_write(operations, ordered=False)
+                updated += result.modified_count
+                logger.info(f"Backfilled {updated} conversations")
+        except PyMongoError as e:
+            logger.error(f"Failed to backfill conversations: {e}")
+            raise DatabaseError("Failed to backfill conversations")
+
+    async def get_conversation(self, conversation_id: str) -> Optional[Conversation]:
+        try:
+            logger.debug("Getting conversation %s", conversation_id)
+            conversation_data = await self.collection.find_one({"_id": conversation_id})
+            return Conversation.from_document(conversation_data) if conversation_data else None
         except PyMongoError as e:
             logger.error(f"Failed to get conversation {conversation_id}: {e}")
             raise DatabaseError(f"Failed to get conversation {conversation_id}")
 
-    def update_conversation(self, conversation_id: str, messages: List[ChatMessage]) -> bool:
+    async def get_conversation_messages(self, conversation_id: str, limit: int, before: Optional[int] = None) -> Optional[Tuple[List[StoredMessage], int]]:
+        """Reads one page of a conversation's messages without loading the rest of the document.
+
+        Returns the newest limit messages, or the limit messages before index before, together with the
+        total number of messages in the conversation.
+        """
+        if before is None:
+            messages_slice = ["$messages", -limit]
+        else:
+            start = max(before - limit, 0)
+            messages_slice = ["$messages", start, max(before - start, 1)]
         try:
-            logger.info(f"Updating conversation {conversation_id}")
-            result = self.collection.update_one(
+            logger.debug("Getting messages of conversation %s", conversation_id)
+            conversation_data = await self.collection.find_one(
                 {"_id": conversation_id},
-                {"$set": {"messages": [message.model_dump(by_alias=True) for message in messages]}}
+                {"messages": {"$slice": messages_slice}, "message_count": {"$size": {"$ifNull": ["$messages", []]}}}
+            )
+            if conversation_data is None:
+                return None
+            messages = [StoredMessage.from_document(message) for message in conversation_data.get("messages") or []]
+            if before is not None and before <= 0:
+                messages = []
+            return messages, conversation_data["message_count"]
+        except PyMongoError as e:
+            logger.error(f"Failed to get messages of conversation {conversation_id}: {e}")
+            raise DatabaseError(f"Failed to get messages of conversation {conversation_id}")
+
+    async def update_conversation(self, conversation_id: str, messages: List[Union[ChatMessage, StoredMessage]]) -> bool:
+        try:
+            logger.debug("Updating conversation %s", conversation_id)
+            result = await self.collection.update_one(
+                {"_id": conversation_id},
+                {"$set": {"messages": [message_document(message) for message in messages]}}
             )
             return result.matched_count > 0   
         except PyMongoError as e:
             logger.error(f"Failed to update conversation {conversation_id}: {e}")
             raise DatabaseError(f"Failed to update conversation {conversation_id}")
 
-    def add_message_to_conversation(self, conversation_id: str, message: ChatMessage) -> bool:
+    async def add_message_to_conversation(self, conversation_id: str, message: ChatMessage) -> bool:
         try:
-            logger.info(f"Adding message to conversation {conversation_id}")
-            result = self.collection.update_one(
+            logger.debug("Adding message to conversation %s", conversation_id)
+            result = await self.collection.update_one(
                 {"_id": conversation_id},
-                {"$push": {"messages": message.model_dump(by_alias=True)}}
+                {"$push": {"messages": message_document(message)}, "$set": {"updated_at": datetime.now(timezone.utc)}}
             )
 
             return result.matched_count > 0
@@ -68,10 +160,51 @@ class ConversationDAO:
             logger.error(f"Failed to add message to conversation {conversation_id}: {e}")
             raise DatabaseError(f"Failed to add message to conversation {conversation_id}")
     
-    def remove_message_from_conversation(self, conversation_id: str, message_id: str) -> bool:
+    async def add_messages_to_conversations(self, messages_by_conversation: Dict[str, List[ChatMessage]]) -> int:
+        """Appends messages to many conversations in one bulk write, returning the number of conversations updated.
+
+        Each append is skipped if its first message is already stored, so a batch can be retried safely.
+        """
+        if not messages_by_conversation:
+            return 0
+        updated_at = datetime.now(timezone.utc)
+        operations = [
+            UpdateOne(
+                {"_id": conversation_id, "messages.message_id": {"$ne": messages[0].message_id}},
+                {
+                    "$push": {"messages": {"$each": [message_document(message) for message in messages]}},
+                    "$set": {"updated_at": updated_at},
+                }
+            )
+            for conversation_id, messages in messages_by_conversation.items()
+        ]
+        try:
+            logger.debug("Adding messages to %s conversations", len(operations))
+            result = await self.collection.bulk_write(operations, ordered=False)
+            return result.modified_count
+        except (ConnectionFailure, ExecutionTimeout, WTimeoutError) as e:
+            logger.error(f"Transient failure adding messages to {len(operations)} conversations: {e}")
+            raise TransientDatabaseError(f"Failed to add messages to {len(operations)} conversations")
+        except PyMongoError as e:
+            logger.error(f"Failed to add messages to {len(operations)} conversations: {e}")
+            raise DatabaseError(f"Failed to add messages to {len(operations)} conversations")
+
+    async def update_conversation_summary(self, conversation_id: str, summary: str, summary_message_count: int) -> bool:
+        try:
+            logger.debug("Updating summary of conversation %s", conversation_id)
+            result = await self.collection.update_one(
+                {"_id": conversation_id},
+                {"$set": {"summary": summary, "summary_message_count": summary_message_count}}
+            )
+            return result.matched_count > 0
+        except PyMongoError as e:
+            logger.error(f"Failed to update summary of conversation {conversation_id}: {e}")
+            raise DatabaseError(f"Failed to update summary of conversation {conversation_id}")
+
+    async def remove_message_from_conversation(self, conversation_id: str, message_id: str) -> bool:
         try:
-            logger.info(f"Removing message {message_id} from conversation {conversation_id}")
-            result = self.collection.update_one(
+            logger.debug("Removing message %s from conversation %s", message_id, conversation_id)
+            result = await self.collection.update_one(
                 {"_id": conversation_id},
                 {"$pull": {"messages": {"_id": message_id}}}
             )
@@ -81,11 +214,35 @@ class ConversationDAO:
             raise DatabaseError(f"Failed to remove message from conversation {conversation_id}")
 
 
-    def list_conversations(self, skip: int = 0, limit: int = 10) -> List[Conversation]:
+    async def list_conversations(self, after_id: Optional[str] = None, limit: int = 10) -> List[Conversation]:
+        """Lists conversations in _id order; pass the conversation_id of the last conversation of a page to get the next one."""
+        query = {"_id": {"$gt": after_id}} if after_id is not None else {}
         try:
-            logger.info(f"Listing conversations")
-            conversations = self.collection.find().skip(skip).limit(limit)
-            return [Conversation(**conv) for conv in conversations]
+            logger.debug("Listing conversations")
+            conversations = self.collection.find(query).sort("_id", ASCENDING).limit(limit)
+            return [Conversation.from_document(conv) async for conv in conversations]
         except PyMongoError as e:
             logger.error(f"Failed to list conversations: {e}")
             raise DatabaseError("Failed to list conversations")
+
+    async def iter_conversations(self, after_id: Optional[str] = None, batch_size: int = 1000, fields: Optional[List[str]] = None) -> AsyncIterator[List[Dict[str, Any]]]:
+        """Yields the conversations after after_id in _id order, as batches of stored documents.
+
+        Each batch is a range query on _id, so late batches cost the same as early ones, and the _id of
+        the last document read is a cursor to resume from. fields limits the documents to those fields
+        and _id; messages are as stored, see StoredMessage.from_document.
+        """
+        projection = dict.fromkeys(fields, 1) if fields is not None else None
+        while True:
+            query = {"_id": {"$gt": after_id}} if after_id is not None else {}
+            try:
+                with DAO_DURATION.time(type(self).__name__, "iter_conversations"):
+                    batch = await self.collection.find(query, projection).sort("_id", ASCENDING).limit(batch_size).to_list(length=batch_size)
+            except PyMongoError as e:
+                logger.error(f"Failed to read conversations after {after_id}: {e}")
+                raise DatabaseError("Failed to read conversations")
+            if batch:
+                yield batch
+            if len(batch) < batch_size:
+                return
+            after_id = batch[-1]["_id"]
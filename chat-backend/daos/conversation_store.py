@@ -0,0 +1,51 @@
+import logging
+from typing import Any, Dict, Optional, Union
+
+from clients.mongo_client import connect_mongo_client
+from config import settings
+from daos.conversation_dao import ConversationDAO
+from daos.segment_log_dao import SegmentLogConversationDAO
+
+logger = logging.getLogger(__name__)
+
+STORE_MONGO = "mongo"
+STORE_SEGMENT_LOG = "segment_log"
+
+# the segment log owns its files and index, so there is one per worker process, opened by the app lifespan
+_segment_log_dao: Optional[SegmentLogConversationDAO] = None
+
+
+def connect_conversation_dao() -> Union[ConversationDAO, SegmentLogConversationDAO]:
+    """Returns the conversation DAO of the store selected by CONVERSATION_STORE."""
+    global _segment_log_dao
+    if settings.CONVERSATION_STORE == STORE_MONGO:
+        return ConversationDAO(connect_mongo_client())
+    if settings.CONVERSATION_STORE != STORE_SEGMENT_LOG:
+        raise ValueError(f"Unknown CONVERSATION_STORE {settings.CONVERSATION_STORE}")
+    if _segment_log_dao is None:
+        _segment_log_dao = SegmentLogConversationDAO(settings.SEGMENT_LOG_DIR, settings.SEGMENT_LOG_MAX_SEGMENT_BYTES, settings.SEGMENT_LOG_FSYNC)
+    return _segment_log_dao
+
+
+def start_conversation_dao() -> Union[ConversationDAO, SegmentLogConversationDAO]:
+    conversation_dao = connect_conversation_dao()
+    if isinstance(conversation_dao, SegmentLogConversationDAO):
+        conversation_dao.start(settings.SEGMENT_LOG_COMPACTION_INTERVAL_S, settings.SEGMENT_LOG_COMPACTION_MIN_GARBAGE_RATIO)
+    return conversation_dao
+
+
+async def close_conversation_dao() -> None:
+    global _segment_log_dao
+    if _segment_log_dao is not None:
+        await _segment_log_dao.close()
+        _segment_log_dao = None
+        logger.info("Closed segment log")
+
+
+def get_conversation_dao() -> Union[ConversationDAO, SegmentLogConversationDAO]:
+    return connect_conversation_dao()
+
+
+def conversation_store_stats() -> Dict[str, Any]:
+    # mongo keeps its own statistics
+    return _segment_log_dao.stats() if _segment_log_dao is not None else {}
@@ -0,0 +1,47 @@
+import logging
+from datetime import datetime, timezone
+from typing import Annotated, Optional
+from fastapi import Depends
+from pymongo import AsyncMongoClient
+from pymongo.errors import PyMongoError
+from pymongo.asynchronous.database import AsyncDatabase
+from pymongo.asynchronous.collection import AsyncCollection
+from clients.mongo_client import get_mongo_client
+from config import settings
+from metrics import instrument_dao
+from exceptions.custom_exceptions import DatabaseError
+
+logger = logging.getLogger(__name__)
+
+@instrument_dao
+class ResponseCacheDAO:
+    def __init__(self, client: Annotated[AsyncMongoClient, Depends(get_mongo_client)]):
+        self.db: AsyncDatabase = client.get_database(settings.MONGO_DATABASE)
+        self.collection: AsyncCollection = self.db['response_cache']
+
+    async def ensure_indexes(self, ttl_seconds: int) -> None:
+        try:
+            # mongo removes entries once created_at is older than the ttl
+            await self.collection.create_index("created_at", expireAfterSeconds=ttl_seconds)
+        except PyMongoError as e:
+            logger.error(f"Failed to create response cache indexes: {e}")
+            raise DatabaseError("Failed to create response cache indexes")
+
+    async def get_response(self, key: str) -> Optional[str]:
+        try:
+            document = await self.collection.find_one({"_id": key}, {"response": 1})
+            return document["response"] if document else None
+        except PyMongoError as e:
+            logger.error(f"Failed to get cached response {key}: {e}")
+            raise DatabaseError(f"Failed to get cached response {key}")
+
+    async def put_response(self, key: str, model: str, response: str) -> None:
+        try:
+            await self.collection.replace_one(
+                {"_id": key},
+                {"model": model, "response": response, "created_at": datetime.now(timezone.utc)},
+                upsert=True
+            )
+        except PyMongoError as e:
+            logger.error(f"Failed to cache response {key}: {e}")
+            raise DatabaseError(f"Failed to cache response {key}")
@@ -0,0 +1,607 @@
+import asyncio
+import functools
+import heapq
+import json
+import logging
+import mmap
+import os
+import struct
+import time
+import zlib
+from datetime import datetime, timezone
+from typing import Any, AsyncIterator, Dict, Iterator, List, Optional, Set, Tuple, Union
+
+from config import settings
+from content_codec import ENCODING_ZLIB, ENCODING_ZSTD, compress, decompress
+from daos.conversation_dao import message_document
+from exceptions.custom_exceptions import DatabaseError
+from metrics import instrument_dao
+from models.models import ChatMessage, Conversation, StoredMessage
+
+logger = logging.getLogger(__name__)
+
+# payload length, crc32 of the payload, sequence number, record kind
+HEADER = struct.Struct("<IIQB")
+
+# record kinds; payloads are JSON, compressed as a whole when long
+CONVERSATION = 1  # {"_id", "user_id", "t"}: a new conversation
+MESSAGE = 2       # {"c": conversation id, "t": unix time, "m": message}: one appended message
+SUMMARY = 3       # {"c", "summary", "count"}: replaces the summary of the conversation
+CLEAR = 4         # {"c"}: drops every earlier message of the conversation
+REMOVE = 5        # {"c", "message_id"}: drops one earlier message
+
+# the high bits of the kind byte say how a payload of at least MESSAGE_COMPRESSION_MIN_CHARS bytes is compressed
+KIND_MASK = 0x3F
+ENCODING_FLAGS = {ENCODING_ZLIB: 0x40, ENCODING_ZSTD: 0x80}
+FLAG_ENCODINGS = {flag: encoding for encoding, flag in ENCODING_FLAGS.items()}
+
+# a live record: sequence number, segment id, offset of its header, length including the header
+Ref = Tuple[int, int, int, int]
+
+
+def _now() -> float:
+    # whole microseconds, so timestamps survive the round trip through datetime used by listing cursors
+    return round(time.time(), 6)
+
+
+def _encode(seq: int, kind: int, payload: Dict[str, Any]) -> bytes:
+    data = json.dumps(payload, separators=(",", ":"), ensure_ascii=False).encode()
+    compressed = compress(data) if len(data) >= settings.MESSAGE_COMPRESSION_MIN_CHARS else None
+    if compressed is not None:
+        kind |= ENCODING_FLAGS[compressed[0]]
+        data = compressed[1]
+    return HEADER.pack(len(data), zlib.crc32(data), seq, kind) + data
+
+
+def _decode(kind: int, data: bytes) -> Tuple[int, Dict[str, Any]]:
+    """Returns the record kind without its compression flag, and the payload."""
+    encoding = FLAG_ENCODINGS.get(kind & ~KIND_MASK)
+    return kind & KIND_MASK, json.loads(decompress(encoding, data) if encoding is not None else data)
+
+
+class _Segment:
+    """One log file. Sealed segments never change; the active one is preallocated and mapped once."""
+    __slots__ = ("segment_id", "path", "size", "garbage", "_map")
+
+    def __init__(self, segment_id: int, path: str, size: int):
+        self.segment_id = segment_id
+        self.path = path
+        # bytes of valid records; the file may be longer while the segment is active
+        self.size = size
+        # bytes of records no longer referenced by the index, reclaimed by compaction
+        self.garbage = 0
+        self._map: Optional[mmap.mmap] = None
+
+    def read(self, offset: int, length: int) -> bytes:
+        if self._map is None or offset + length > len(self._map):
+            self.remap()
+        return self._map[offset:offset + length]
+
+    def remap(self) -> None:
+        self.close()
+        with open(self.path, "rb") as segment_file:
+            self._map = mmap.mmap(segment_file.fileno(), 0, access=mmap.ACCESS_READ)
+
+    def scan(self) -> Iterator[Tuple[int, int, int, int, bytes]]:
+        """Yields (offset, length, seq, kind, payload) of every valid record, stopping at the preallocated or torn tail."""
+        if os.path.getsize(self.path) == 0:
+            self.size = 0
+            return
+        self.remap()
+        offset = 0
+        with memoryview(self._map) as view:
+            while offset + HEADER.size <= len(view):
+                payload_length, crc, seq, kind = HEADER.unpack_from(view, offset)
+                if kind == 0:
+                    break
+                end = offset + HEADER.size + payload_length
+                if end > len(view) or zlib.crc32(view[offset + HEADER.size:end]) != crc:
+                    logger.warning(f"Ignoring torn record at {self.path}:{offset}")
+                    break
+                yield offset, end - offset, seq, kind, bytes(view[offset + HEADER.size:end])
+                offset = end
+        self.size = offset
+
+    def close(self) -> None:
+        if self._map is not None:
+            self._map.close()
+            self._map = None
+
+
+class _ConversationEntry:
+    __slots__ = ("user_id", "updated_at", "summary", "summary_message_count", "created", "summary_ref", "messages", "message_ids")
+
+    def __init__(self, user_id: str, updated_at: float, created: Ref):
+        self.user_id = user_id
+        self.updated_at = updated_at
+        self.summary: Optional[str] = None
+        self.summary_message_count = 0
+        self.created = created
+        self.summary_ref: Optional[Ref] = None
+        self.messages: List[Ref] = []
+        self.message_ids: List[str] = []
+
+
+@instrument_dao
+class SegmentLogConversationDAO:
+    """Stores conversations in an append-only log of segment files on local disk.
+
+    Every change is appended as a record; an in-memory index maps each conversation to the records
+    of its messages, which are read back through memory-mapped segments. The index is rebuilt by
+    replaying the log on open. Records carry a sequence number, so the log can be replayed in any
+    segment order and records copied by compaction keep their place. Compaction rewrites the live
+    records of the sealed segments into new ones once enough of them is garbage.
+    """
+
+    def __init__(self, directory: str, max_segment_bytes: int, fsync: bool = False):
+        self.directory = directory
+        self.max_segment_bytes = max_segment_bytes
+        self.fsync = fsync
+        self._segments: Dict[int, _Segment] = {}
+        self._conversations: Dict[str, _ConversationEntry] = {}
+        self._by_user: Dict[str, Set[str]] = {}
+        self._active: Optional[_Segment] = None
+        self._active_fd: Optional[int] = None
+        self._active_capacity = 0
+        self._next_segment_id = 1
+        self._next_seq = 1
+        # one write at a time, each at the end of the active segment
+        self._write_lock = asyncio.Lock()
+        self._compaction_task: Optional[asyncio.Task] = None
+        self._compacting = False
+        self.compactions = 0
+        self._open()
+
+    # -- lifecycle --
+
+    def _open(self) -> None:
+        os.makedirs(self.directory, exist_ok=True)
+        started = time.perf_counter()
+        segment_ids = sorted(int(name[:-4]) for name in os.listdir(self.directory) if name.endswith(".log") and name[:-4].isdigit())
+        for segment_id in segment_ids:
+            self._segments[segment_id] = _Segment(segment_id, self._segment_path(segment_id), 0)
+        self._replay()
+        for segment in list(self._segments.values()):
+            segment.close()
+            if segment.size == 0:
+                del self._segments[segment.segment_id]
+                os.remove(segment.path)
+            elif os.path.getsize(segment.path) != segment.size:
+                # drop the preallocated or torn tail of the segment that was active when the process stopped
+                os.truncate(segment.path, segment.size)
+        self._next_segment_id = max(segment_ids, default=0) + 1
+        self._roll()
+        messages = sum(len(entry.messages) for entry in self._conversations.values())
+        logger.info(f"Opened segment log {self.directory}: {len(self._conversations)} conversations, {messages} messages in {len(segment_ids)} segments ({time.perf_counter() - started:.2f}s)")
+
+    def start(self, compaction_interval: float, min_garbage_ratio: float) -> None:
+        if self._compaction_task is None:
+            self._compaction_task = asyncio.create_task(self._compact_periodically(compaction_interval, min_garbage_ratio))
+
+    async def close(self) -> None:
+        if self._compaction_task is not None:
+            self._compaction_task.cancel()
+            try:
+                await self._compaction_task
+            except asyncio.CancelledError:
+                pass
+            self._compaction_task = None
+        async with self._write_lock:
+            self._seal()
+        for segment in self._segments.values():
+            segment.close()
+
+    def _segment_path(self, segment_id: int) -> str:
+        return os.path.join(self.directory, f"{segment_id:08d}.log")
+
+    def _roll(self, min_bytes: int = 0) -> None:
+        """Seals the active segment and starts a new, preallocated one."""
+        self._seal()
+        segment_id = self._next_segment_id
+        self._next_segment_id += 1
+        path = self._segment_path(segment_id)
+        self._active_fd = os.open(path, os.O_RDWR | os.O_CREAT | os.O_TRUNC, 0o644)
+        # zeros past the last record mark the end of the log, and the mapping never has to grow
+        self._active_capacity = max(self.max_segment_bytes, min_bytes)
+        os.ftruncate(self._active_fd, self._active_capacity)
+        self._active = self._segments[segment_id] = _Segment(segment_id, path, 0)
+
+    def _seal(self) -> None:
+        if self._active_fd is None:
+            return
+        self._active.close()
+        os.ftruncate(self._active_fd, self._active.size)
+        os.close(self._active_fd)
+        self._active_fd = None
+
+    # -- replay --
+
+    def _replay(self) -> None:
+        # only what the index needs is kept from each record; message contents and summaries are read back through refs
+        records_by_conversation: Dict[str, List[Tuple[int, int, Ref, Any]]] = {}
+        for segment in self._segments.values():
+            for offset, length, seq, kind, payload in segment.scan():
+                kind, data = _decode(kind, payload)
+                if kind == CONVERSATION:
+                    conversation_id, fields = data["_id"], (data["user_id"], data["t"])
+                elif kind == MESSAGE:
+                    conversation_id, fields = data["c"], (data["m"]["message_id"], data["t"])
+                elif kind == SUMMARY:
+                    conversation_id, fields = data["c"], data["count"]
+                else:
+                    conversation_id, fields = data["c"], data.get("message_id")
+                records_by_conversation.setdefault(conversation_id, []).append((seq, kind, (seq, segment.segment_id, offset, length), fields))
+                self._next_seq = max(self._next_seq, seq + 1)
+        for conversation_id, records in records_by_conversation.items():
+            # compaction may have left copies of a record behind; they share its sequence number
+            records.sort(key=lambda record: record[0])
+            live: Set[Ref] = set()
+            entry = None
+            seen: Set[int] = set()
+            for seq, kind, ref, fields in records:
+                if seq in seen:
+                    continue
+                seen.add(seq)
+                if kind == CONVERSATION:
+                    entry = _ConversationEntry(fields[0], fields[1], ref)
+                    live.add(ref)
+                elif entry is None:
+                    continue
+                elif kind == MESSAGE:
+                    entry.messages.append(ref)
+                    entry.message_ids.append(fields[0])
+                    entry.updated_at = fields[1]
+                elif kind == SUMMARY:
+                    entry.summary_message_count, entry.summary_ref = fields, ref
+                elif kind == CLEAR:
+                    entry.messages, entry.message_ids = [], []
+                elif kind == REMOVE and fields in entry.message_ids:
+                    index = entry.message_ids.index(fields)
+                    del entry.messages[index], entry.message_ids[index]
+            if entry is not None:
+                live.update(entry.messages)
+                if entry.summary_ref is not None:
+                    live.add(entry.summary_ref)
+                    entry.summary = self._read(entry.summary_ref)["summary"]
+                self._index(conversation_id, entry)
+            for seq, kind, ref, fields in records:
+                if ref not in live:
+                    self._segments[ref[1]].garbage += ref[3]
+
+    def _index(self, conversation_id: str, entry: _ConversationEntry) -> None:
+        self._conversations[conversation_id] = entry
+        self._by_user.setdefault(entry.user_id, set()).add(conversation_id)
+
+    # -- writing and reading records --
+
+    def _append(self, records: List[Tuple[int, Dict[str, Any]]]) -> Tuple[List[Ref], bytes, int]:
+        """Lays records out at the end of the active segment, returning where each will land, their bytes and where they start."""
+        first_seq = self._next_seq
+        encoded = [_encode(first_seq + index, kind, payload) for index, (kind, payload) in enumerate(records)]
+        self._next_seq += len(encoded)
+        total = sum(len(record) for record in encoded)
+        if self._active.size + total > self._active_capacity:
+            self._roll(total)
+        refs = []
+        offset = self._active.size
+        for index, record in enumerate(encoded):
+            refs.append((first_seq + index, self._active.segment_id, offset, len(record)))
+            offset += len(record)
+        return refs, b"".join(encoded), self._active.size
+
+    def _write_at(self, fd: int, data: bytes, offset: int) -> None:
+        os.pwrite(fd, data, offset)
+        if self.fsync:
+            os.fsync(fd)
+
+    def _written(self, segment: _Segment, end: int, write: asyncio.Future) -> None:
+        if not write.cancelled() and write.exception() is None:
+            segment.size = end
+        self._write_lock.release()
+
+    async def _write(self, records: List[Tuple[int, Dict[str, Any]]]) -> List[Ref]:
+        """Writes records with one sequential write, off the event loop, returning where each landed."""
+        await self._write_lock.acquire()
+        try:
+            refs, data, offset = self._append(records)
+            write = asyncio.get_running_loop().run_in_executor(None, self._write_at, self._active_fd, data, offset)
+        except BaseException:
+            self._write_lock.release()
+            raise
+        # the lock is held until the write is done even if the caller stops waiting, so the segment can't be sealed under it
+        write.add_done_callback(functools.partial(self._written, self._active, offset + len(data)))
+        try:
+            await asyncio.shield(write)
+            return refs
+        except OSError as e:
+            logger.error(f"Failed to append to segment log: {e}")
+            raise DatabaseError("Failed to append to segment log")
+
+    def _read(self, ref: Ref) -> Dict[str, Any]:
+        _, segment_id, offset, length = ref
+        record = self._segments[segment_id].read(offset, length)
+        return _decode(record[HEADER.size - 1], record[HEADER.size:])[1]
+
+    def _discard(self, ref: Optional[Ref]) -> None:
+        if ref is not None and ref[1] in self._segments:
+            self._segments[ref[1]].garbage += ref[3]
+
+    def _document(self, conversation_id: str, entry: _ConversationEntry, message_refs: List[Ref]) -> Dict[str, Any]:
+        return {
+            "_id": conversation_id,
+            "user_id": entry.user_id,
+            "updated_at": datetime.fromtimestamp(entry.updated_at, timezone.utc),
+            "summary": entry.summary,
+            "summary_message_count": entry.summary_message_count,
+            "messages": [self._read(ref)["m"] for ref in message_refs],
+        }
+
+    # -- ConversationDAO --
+
+    async def ensure_indexes(self) -> None:
+        pass
+
+    async def create_conversation(self, conversation: Conversation) -> str:
+        conversation_id = conversation.conversation_id
+        if conversation_id in self._conversations:
+            logger.error(f"Failed to create conversation: {conversation_id} already exists")
+            raise DatabaseError("Failed to create conversation")
+        logger.debug("Creating conversation: %s", conversation_id)
+        now = _now()
+        records = [(CONVERSATION, {"_id": conversation_id, "user_id": conversation.user_id, "t": now})]
+        records.extend((MESSAGE, {"c": conversation_id, "t": now, "m": message_document(message, compress=False)}) for message in conversation.messages)
+        refs = await self._write(records)
+        entry = _ConversationEntry(conversation.user_id, now, refs[0])
+        entry.messages = refs[1:]
+        entry.message_ids = [message.message_id for message in conversation.messages]
+        self._index(conversation_id, entry)
+        return conversation_id
+
+    async def get_conversations_by_user_id(self, user_id: str, limit: int = 10, before_updated_at: Optional[datetime] = None, before_id: Optional[str] = None) -> List[Conversation]:
+        """Lists a user's conversations, most recently updated first, with only their first message."""
+        keys = sorted(
+            ((self._conversations[conversation_id].updated_at, conversation_id) for conversation_id in self._by_user.get(user_id, ())),
+            reverse=True,
+        )
+        if before_updated_at is not None:
+            keys = [key for key in keys if key < (before_updated_at.timestamp(), before_id)]
+        try:
+            return [
+                Conversation.from_document(self._document(conversation_id, self._conversations[conversation_id], self._conversations[conversation_id].messages[:1]))
+                for _, conversation_id in keys[:limit]
+            ]
+        except (OSError, ValueError) as e:
+            logger.error(f"Failed to get conversations for user {user_id}: {e}")
+            raise DatabaseError(f"Failed to get conversations for user {user_id}")
+
+    async def get_conversation(self, conversation_id: str) -> Optional[Conversation]:
+        logger.debug("Getting conversation %s", conversation_id)
+        entry = self._conversations.get(conversation_id)
+        if entry is None:
+            return None
+        try:
+            return Conversation.from_document(self._document(conversation_id, entry, entry.messages))
+        except (OSError, ValueError) as e:
+            logger.error(f"Failed to get conversation {conversation_id}: {e}")
+            raise DatabaseError(f"Failed to get conversation {conversation_id}")
+
+    async def get_conversation_messages(self, conversation_id: str, limit: int, before: Optional[int] = None) -> Optional[Tuple[List[StoredMessage], int]]:
+        """Reads one page of a conversation's messages, reading only the records of that page.
+
+        Returns the newest limit messages, or the limit messages before index before, together with the
+        total number of messages in the conversation.
+        """
+        entry = self._conversations.get(conversation_id)
+        if entry is None:
+            return None
+        total = len(entry.messages)
+        end = total if before is None else max(min(before, total), 0)
+        try:
+            return [StoredMessage.from_document(self._read(ref)["m"]) for ref in entry.messages[max(end - limit, 0):end]], total
+        except (OSError, ValueError) as e:
+            logger.error(f"Failed to get messages of conversation {conversation_id}: {e}")
+            raise DatabaseError(f"Failed to get messages of conversation {conversation_id}")
+
+    async def update_conversation(self, conversation_id: str, messages: List[Union[ChatMessage, StoredMessage]]) -> bool:
+        entry = self._conversations.get(conversation_id)
+        if entry is None:
+            return False
+        logger.debug("Updating conversation %s", conversation_id)
+        now = _now()
+        records = [(CLEAR, {"c": conversation_id})]
+        records.extend((MESSAGE, {"c": conversation_id, "t": now, "m": message_document(message, compress=False)}) for message in messages)
+        refs = await self._write(records)
+        for ref in entry.messages:
+            self._discard(ref)
+        # the clear marker is only needed until compaction drops the messages it hides
+        self._discard(refs[0])
+        entry.messages = refs[1:]
+        entry.message_ids = [message.message_id for message in messages]
+        entry.updated_at = now
+        return True
+
+    async def add_message_to_conversation(self, conversation_id: str, message: ChatMessage) -> bool:
+        return await self.add_messages_to_conversations({conversation_id: [message]}) > 0
+
+    async def add_messages_to_conversations(self, messages_by_conversation: Dict[str, List[ChatMessage]]) -> int:
+        """Appends messages to many conversations in one write, returning the number of conversations updated.
+
+        Each append is skipped if its first message is already stored, so a batch can be retried safely.
+        """
+        now = _now()
+        records = []
+        appends = []
+        for conversation_id, messages in messages_by_conversation.items():
+            entry = self._conversations.get(conversation_id)
+            # a retried batch is always the newest append to a conversation, so only its tail needs checking
+            if entry is None or not messages or messages[0].message_id in entry.message_ids[-len(messages):]:
+                continue
+            appends.append((entry, messages, len(records)))
+            records.extend((MESSAGE, {"c": conversation_id, "t": now, "m": message_document(message, compress=False)}) for message in messages)
+        if not records:
+            return 0
+        logger.debug("Adding messages to %s conversations", len(appends))
+        refs = await self._write(records)
+        for entry, messages, start in appends:
+            entry.messages.extend(refs[start:start + len(messages)])
+            entry.message_ids.extend(message.message_id for message in messages)
+            entry.updated_at = now
+        return len(appends)
+
+    async def update_conversation_summary(self, conversation_id: str, summary: str, summary_message_count: int) -> bool:
+        entry = self._conversations.get(conversation_id)
+        if entry is None:
+            return False
+        logger.debug("Updating summary of conversation %s", conversation_id)
+        refs = await self._write([(SUMMARY, {"c": conversation_id, "summary": summary, "count": summary_message_count})])
+        self._discard(entry.summary_ref)
+        entry.summary, entry.summary_message_count, entry.summary_ref = summary, summary_message_count, refs[0]
+        return True
+
+    async def remove_message_from_conversation(self, conversation_id: str, message_id: str) -> bool:
+        entry = self._conversations.get(conversation_id)
+        if entry is None:
+            return False
+        logger.debug("Removing message %s from conversation %s", message_id, conversation_id)
+        if message_id in entry.message_ids:
+            refs = await self._write([(REMOVE, {"c": conversation_id, "message_id": message_id})])
+            index = entry.message_ids.index(message_id)
+            self._discard(entry.messages[index])
+            self._discard(refs[0])
+            del entry.messages[index], entry.message_ids[index]
+        return True
+
+    async def list_conversations(self, after_id: Optional[str] = None, limit: int = 10) -> List[Conversation]:
+        logger.debug("Listing conversations")
+        conversation_ids = heapq.nsmallest(limit, self._ids_after(after_id))
+        return [Conversation.from_document(self._document(conversation_id, self._conversations[conversation_id], self._conversations[conversation_id].messages)) for conversation_id in conversation_ids]
+
+    async def iter_conversations(self, after_id: Optional[str] = None, batch_size: int = 1000, fields: Optional[List[str]] = None) -> AsyncIterator[List[Dict[str, Any]]]:
+        """Yields the conversations after after_id in _id order, as batches of documents limited to fields and _id.
+
+        The ids are sorted once, when iteration starts; conversations created later are left out. Messages
+        are only read from disk if they are among the fields.
+        """
+        conversation_ids = sorted(self._ids_after(after_id))
+        with_messages = fields is None or "messages" in fields
+        for start in range(0, len(conversation_ids), batch_size):
+            batch = []
+            for conversation_id in conversation_ids[start:start + batch_size]:
+                entry = self._conversations.get(conversation_id)
+                if entry is None:
+                    continue
+                try:
+                    document = self._document(conversation_id, entry, entry.messages if with_messages else [])
+                except (OSError, ValueError) as e:
+                    logger.error(f"Failed to read conversation {conversation_id}: {e}")
+                    raise DatabaseError("Failed to read conversations")
+                if fields is not None:
+                    document = {key: value for key, value in document.items() if key == "_id" or key in fields}
+                batch.append(document)
+            if batch:
+                yield batch
+
+    def _ids_after(self, after_id: Optional[str]) -> Iterator[str]:
+        return iter(self._conversations) if after_id is None else (conversation_id for conversation_id in self._conversations if conversation_id > after_id)
+
+    # -- compaction --
+
+    def garbage_ratio(self) -> float:
+        sealed = [segment for segment in self._segments.values() if segment is not self._active]
+        size = sum(segment.size for segment in sealed)
+        return sum(segment.garbage for segment in sealed) / size if size else 0.0
+
+    async def _compact_periodically(self, interval: float, min_garbage_ratio: float) -> None:
+        while True:
+            await asyncio.sleep(interval)
+            if self.garbage_ratio() >= min_garbage_ratio:
+                try:
+                    await self.compact()
+                except Exception as e:
+                    logger.exception(f"Segment log compaction failed: {e}")
+
+    async def compact(self) -> int:
+        """Rewrites the live records of all sealed segments into new segments and deletes the old ones.
+
+        The copying runs in a thread; appends keep going to the active segment meanwhile. Returns the
+        number of bytes reclaimed.
+        """
+        if self._compacting:
+            return 0
+        self._compacting = True
+        try:
+            sealed = {segment_id: segment for segment_id, segment in self._segments.items() if segment is not self._active}
+            if not sealed:
+                return 0
+            for segment in sealed.values():
+                # map them here, the thread only reads
+                if segment.size:
+                    segment.remap()
+            live = [
+                ref
+                for entry in self._conversations.values()
+                for ref in [entry.created, entry.summary_ref, *entry.messages]
+                if ref is not None and ref[1] in sealed
+            ]
+            live.sort()
+            # lay the copies out here, so the thread only moves bytes and the index can be patched afterwards
+            moves: Dict[Tuple[int, int], Ref] = {}
+            outputs: List[Tuple[_Segment, List[Tuple[Ref, int]]]] = []
+            for ref in live:
+                if not outputs or (outputs[-1][0].size and outputs[-1][0].size + ref[3] > self.max_segment_bytes):
+                    segment_id = self._next_segment_id
+                    self._next_segment_id += 1
+                    outputs.append((_Segment(segment_id, self._segment_path(segment_id), 0), []))
+                output, copies = outputs[-1]
+                copies.append((ref, output.size))
+                moves[ref[1], ref[2]] = (ref[0], output.segment_id, output.size, ref[3])
+                output.size += ref[3]
+            await asyncio.to_thread(self._copy_records, sealed, outputs)
+
+            copied = set()
+            for entry in self._conversations.values():
+                if entry.created[1] in sealed:
+                    entry.created = moves[entry.created[1], entry.created[2]]
+                    copied.add(entry.created)
+                if entry.summary_ref is not None and entry.summary_ref[1] in sealed:
+                    entry.summary_ref = moves[entry.summary_ref[1], entry.summary_ref[2]]
+                    copied.add(entry.summary_ref)
+                for index, ref in enumerate(entry.messages):
+                    if ref[1] in sealed:
+                        entry.messages[index] = moves[ref[1], ref[2]]
+                        copied.add(entry.messages[index])
+            for output, copies in outputs:
+                # records removed while the copy ran are garbage in their new segment
+                output.garbage = sum(ref[3] for ref, _ in copies if moves[ref[1], ref[2]] not in copied)
+                self._segments[output.segment_id] = output
+            reclaimed = sum(segment.size for segment in sealed.values()) - sum(output.size for output, _ in outputs)
+            for segment_id, segment in sealed.items():
+                del self._segments[segment_id]
+                segment.close()
+                os.remove(segment.path)
+            self.compactions += 1
+            logger.info(f"Compacted {len(sealed)} segments into {len(outputs)}, reclaimed {reclaimed} bytes")
+            return reclaimed
+        finally:
+            self._compacting = False
+
+    @staticmethod
+    def _copy_records(sealed: Dict[int, _Segment], outputs: List[Tuple[_Segment, List[Tuple[Ref, int]]]]) -> None:
+        for output, copies in outputs:
+            with open(output.path, "wb") as output_file:
+                for ref, _ in copies:
+                    _, segment_id, offset, length = ref
+                    # records are copied as they are, keeping their sequence numbers
+                    output_file.write(sealed[segment_id].read(offset, length))
+                output_file.flush()
+                os.fsync(output_file.fileno())
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "conversations": len(self._conversations),
+            "messages": sum(len(entry.messages) for entry in self._conversations.values()),
+            "segments": len(self._segments),
+            "bytes": sum(segment.size for segment in self._segments.values()),
+            "garbage_bytes": sum(segment.garbage for segment in self._segments.values()),
+            "compactions": self.compactions,
+        }
@@ -1,42 +1,58 @@
 import logging
-from typing import Annotated, List, Optional
+from typing import Annotated, Any, AsyncIterator, Dict, List, Optional
 from fastapi import Depends
-from pymongo import MongoClient
+from pymongo import ASCENDING, AsyncMongoClient
 from pymongo.errors import PyMongoError
-from pymongo.database import Database
-from pymongo.collection import Collection
+from pymongo.asynchronous.database import AsyncDatabase
+from pymongo.asynchronous.collection import AsyncCollection
 from clients.mongo_client import get_mongo_client
+from config import settings
+from metrics import DAO_DURATION, instrument_dao
 from models.models import User
 from exceptions.custom_exceptions import DatabaseError
 
 logger = logging.getLogger(__name__)
 
+@instrument_dao
 class UserDAO:
-    def __init__(self, client: Annotated[MongoClient, Depends(get_mongo_client)]):
-        self.db: Database = client.get_database("chat-bot")
-        self.collection: Collection = self.db['users']
+    def __init__(self, client: Annotated[AsyncMongoClient, Depends(get_mongo_client)]):
+        self.db: AsyncDatabase = client.get_database(settings.MONGO_DATABASE)
+        self.collection: AsyncCollection = self.db['users']
         logger.debug("Connected to user collection")
 
-    def create_user(self, user: User) -> str:
+    async def create_user(self, user: User) -> str:
         try:
-            result = self.collection.insert_one(user.model_dump(by_alias=True))
-            logger.info(f"User created with ID: {result.inserted_id}")
+            result = await self.collection.insert_one(user.model_dump(by_alias=True))
+            logger.debug("User created with ID: %s", result.inserted_id)
             return str(result.inserted_id)
         except PyMongoError as e:
             logger.error(f"Failed to create user: {e}")
             raise DatabaseError("Failed to create user")
 
-    def get_user(self, user_id: str) -> Optional[User]:
+    async def ensure_user(self, user_id: str) -> bool:
+        """Creates the user unless it exists, in one round-trip. Returns whether it was created."""
         try:
-            user_data = self.collection.find_one({"_id": user_id})
+            result = await self.collection.update_one(
+                {"_id": user_id},
+                {"$setOnInsert": User(_id=user_id).model_dump(by_alias=True)},
+                upsert=True,
+            )
+            return result.upserted_id is not None
+        except PyMongoError as e:
+            logger.error(f"Failed to upsert user {user_id}: {e}")
+            raise DatabaseError(f"Failed to upsert user {user_id}")
+
+    async def get_user(self, user_id: str) -> Optional[User]:
+        try:
+            user_data = await self.collection.find_one({"_id": user_id})
             return User(**user_data) if user_data else None
         except PyMongoError as e:
             logger.error(f"Failed to get user {user_id}: {e}")
             raise DatabaseError(f"Failed to get user {user_id}")
 
-    def update_user(self, user_id: str, user: User) -> bool:
+    async def update_user(self, user_id: str, user: User) -> bool:
         try:
-            result = self.collection.update_one(
+            result = await self.collection.update_one(
                 {"_id": user_id},
                 {"$set": user.model_dump()}
             )
@@ -45,25 +61,47 @@ class UserDAO:
             logger.error(f"Failed to update user {user_id}: {e}")
             raise DatabaseError(f"Failed to update user {user_id}")
 
-    def delete_user(self, user_id: str) -> bool:
+    async def delete_user(self, user_id: str) -> bool:
         try:
-            result = self.collection.delete_one({"user_id": user_id})
+            result = await self.collection.delete_one({"user_id": user_id})
             return result.deleted_count > 0
         except PyMongoError as e:
             logger.error(f"Failed to delete user {user_id}: {e}")
             raise DatabaseError(f"Failed to delete user {user_id}")
 
-    def list_users(self, skip: int = 0, limit: int = 10) -> List[User]:
+    async def list_users(self, after_id: Optional[str] = None, limit: int = 10) -> List[User]:
+        """Lists users in _id order; pass the user_id of the last user of a page to get the next one."""
+        query = {"_id": {"$gt": after_id}} if after_id is not None else {}
         try:
-            users = self.collection.find().skip(skip).limit(limit)
-            return [User(**user) for user in users]
+            users = self.collection.find(query).sort("_id", ASCENDING).limit(limit)
+            return [User(**user) async for user in users]
         except PyMongoError as e:
             logger.error(f"Failed to list users: {e}")
             raise DatabaseError("Failed to list users")
 
-    def add_conversation_to_user(self, user_id: str, conversation_id: str) -> bool:
+    async def iter_users(self, after_id: Optional[str] = None, batch_size: int = 1000, fields: Optional[List[str]] = None) -> AsyncIterator[List[Dict[str, Any]]]:
+        """Yields the users after after_id in _id order, as batches of stored documents limited to fields and _id.
+
+        Each batch is a range query on _id, so late batches cost the same as early ones.
+        """
+        projection = dict.fromkeys(fields, 1) if fields is not None else None
+        while True:
+            query = {"_id": {"$gt": after_id}} if after_id is not None else {}
+            try:
+                with DAO_DURATION.time(type(self).__name__, "iter_users"):
+                    batch = await self.collection.find(query, projection).sort("_id", ASCENDING).limit(batch_size).to_list(length=batch_size)
+            except PyMongoError as e:
+                logger.error(f"Failed to read users after {after_id}: {e}")
+                raise DatabaseError("Failed to read users")
+            if batch:
+                yield batch
+            if len(batch) < batch_size:
+                return
+            after_id = batch[-1]["_id"]
+
+    async def add_conversation_to_user(self, user_id: str, conversation_id: str) -> bool:
         try:
-            result = self.collection.update_one(
+            result = await self.collection.update_one(
                 {"user_id": user_id},
                 {"$push": {"conversations": conversation_id}}
             )
@@ -73,9 +111,9 @@ class UserDAO:
             logger.error(f"Failed to add conversation {conversation_id} to user {user_id}: {e}")
             raise DatabaseError(f"Failed to add conversation to user {user_id}")
 
-    def remove_conversation_from_user(self, user_id: str, conversation_id: str) -> bool:
+    async def remove_conversation_from_user(self, user_id: str, conversation_id: str) -> bool:
         try:
-            result = self.collection.update_one(
+            result = await self.collection.update_one(
                 {"user_id": user_id},
                 {"$pull": {"conversations": conversation_id}}
             )
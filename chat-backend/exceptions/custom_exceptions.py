@@ -4,6 +4,10 @@ class DatabaseError(Exception):
     """Exception raised for errors in database operations."""
     pass
 
+class TransientDatabaseError(DatabaseError):
+    """Exception raised for database errors that may succeed if retried, like network errors or timeouts."""
+    pass
+
 
 # service class exceptions
 class UserNotFoundError(Exception):
@@ -24,4 +28,8 @@ class BadRequestError(Exception):
 
 class ConversationNotFoundError(Exception):
     """Exception raised when a conversation is not found."""
-    pass
\ No newline at end of file
+    pass
+
+class SchedulerBusyError(Exception):
+    """Exception raised when a request can't be admitted to the language model because its queues are full."""
+    pass
@@ -1,15 +1,117 @@
+import os
+from contextlib import asynccontextmanager
 from fastapi import FastAPI, WebSocket
+from fastapi.responses import JSONResponse, PlainTextResponse
 
+from clients.chat_client import close_openai_client, connect_openai_client, openai_client_ready, warm_up_openai_client
+from clients.mongo_client import close_mongo_client, connect_mongo_client, ping_mongo, warm_up_mongo_client
+from config import settings
+from daos.conversation_store import close_conversation_dao, conversation_store_stats, start_conversation_dao
+from daos.response_cache_dao import ResponseCacheDAO
+from exceptions.custom_exceptions import DatabaseError
+from metrics import add_component_stats, registry
 from routers.chat_router import router as chat_router
+from routers.export_router import router as export_router
+from services.cache import cache_stats, conversation_cache, user_conversations_cache
+from services.llm_scheduler import llm_scheduler
+from services.model_router import model_router
+from services.persistence_queue import message_queue
+from services.response_cache import response_cache
+from services.history_relevance import history_relevance
+from services.reply_streams import reply_streams
+from services.search_index import search_indexes
+from structured_logging import configure_logging, logging_stats
+
+configure_logging()
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # a log config uvicorn applied after the import above replaces the root handlers, put the queue back
+    configure_logging()
+    # shared client pools for the lifetime of this worker
+    connect_mongo_client()
+    connect_openai_client()
+    await warm_up_mongo_client()
+    await warm_up_openai_client()
+    conversation_dao = start_conversation_dao()
+    try:
+        await conversation_dao.ensure_indexes()
+    except DatabaseError:
+        pass
+    message_queue.start(conversation_dao)
+    search_indexes.start()
+    if settings.RESPONSE_CACHE_MONGO_ENABLED:
+        await response_cache.start(ResponseCacheDAO(connect_mongo_client()), settings.RESPONSE_CACHE_TTL_S)
+    try:
+        yield
+    finally:
+        # flush queued messages before the mongo pool goes away
+        await message_queue.stop()
+        await search_indexes.stop()
+        await close_conversation_dao()
+        await close_openai_client()
+        await close_mongo_client()
+
 
 app = FastAPI(
-    root_path="/api"
+    root_path="/api",
+    lifespan=lifespan
 )
 
 
 app.include_router(chat_router)
+if settings.EXPORT_ENABLED:
+    app.include_router(export_router)
+
+add_component_stats("conversation_cache", conversation_cache.stats)
+add_component_stats("user_conversations_cache", user_conversations_cache.stats)
+add_component_stats("response_cache", response_cache.stats)
+add_component_stats("persistence_queue", message_queue.stats)
+add_component_stats("llm_scheduler", llm_scheduler.stats)
+add_component_stats("model_router", model_router.stats)
+add_component_stats("conversation_store", conversation_store_stats)
+add_component_stats("logging", logging_stats)
+add_component_stats("search_index", search_indexes.stats)
+add_component_stats("history_relevance", history_relevance.stats)
+add_component_stats("reply_streams", reply_streams.stats)
 
 @app.get("/")
 async def root():
     return {"message": "Hello World"}
 
+@app.get("/health")
+async def health():
+    checks = {"mongo": await ping_mongo(), "openai": openai_client_ready()}
+    status_code = 200 if all(checks.values()) else 503
+    return JSONResponse(status_code=status_code, content=checks)
+
+@app.get("/stats/cache")
+async def get_cache_stats():
+    return {**cache_stats(), "responses": response_cache.stats()}
+
+@app.get("/stats/persistence")
+async def get_persistence_stats():
+    return message_queue.stats()
+
+@app.get("/stats/scheduler")
+async def get_scheduler_stats():
+    return llm_scheduler.stats()
+
+@app.get("/stats/routing")
+async def get_routing_stats():
+    return model_router.stats()
+
+@app.get("/metrics", response_class=PlainTextResponse)
+async def metrics():
+    # prometheus text exposition format
+    return PlainTextResponse(registry.render(), media_type="text/plain; version=0.0.4")
+
+if __name__ == "__main__":
+    import uvicorn
+    from websocket_compression import DeflateWebSocketProtocol
+
+    # the uvicorn command line can't take a websocket protocol class, which tuned permessage-deflate needs;
+    # without a log config uvicorn's loggers propagate to the queue handler on the root logger
+    uvicorn.run("main:app", host=os.environ.get("HOST", "127.0.0.1"), port=int(os.environ.get("PORT", "8000")),
+                log_config=None, ws=DeflateWebSocketProtocol)
@@ -0,0 +1,200 @@
+import functools
+import inspect
+import math
+import time
+from contextlib import contextmanager
+from typing import Callable, Dict, Iterator, List, Optional, Sequence, Tuple
+
+# latency buckets in seconds, from a fast cache-backed DAO call to a long completion
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+LabelValues = Tuple[str, ...]
+
+
+def _format_labels(names: Sequence[str], values: Sequence[str], extra: Optional[Tuple[str, str]] = None) -> str:
+  pairs = list(zip(names, values))
+  if extra is not None:
+    pairs.append(extra)
+  if not pairs:
+    return ""
+  escaped = (str(value).replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n") for _, value in pairs)
+  return "{" + ",".join(f'{name}="{value}"' for (name, _), value in zip(pairs, escaped)) + "}"
+
+
+def _format_value(value: float) -> str:
+  if value == math.inf:
+    return "+Inf"
+  return repr(float(value)) if not float(value).is_integer() else str(int(value))
+
+
+class _Metric:
+  kind = ""
+
+  def __init__(self, name: str, help_text: str, label_names: Sequence[str] = ()):
+    self.name = name
+    self.help_text = help_text
+    self.label_names = tuple(label_names)
+
+  def header(self) -> List[str]:
+    return [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} {self.kind}"]
+
+
+class Counter(_Metric):
+  kind = "counter"
+
+  def __init__(self, name: str, help_text: str, label_names: Sequence[str] = ()):
+    super().__init__(name, help_text, label_names)
+    self._values: Dict[LabelValues, float] = {}
+
+  def inc(self, *label_values: str, amount: float = 1) -> None:
+    self._values[label_values] = self._values.get(label_values, 0) + amount
+
+  def render(self) -> List[str]:
+    return self.header() + [f"{self.name}{_format_labels(self.label_names, labels)} {_format_value(value)}" for labels, value in self._values.items()]
+
+
+class Gauge(_Metric):
+  kind = "gauge"
+
+  def __init__(self, name: str, help_text: str, label_names: Sequence[str] = ()):
+    super().__init__(name, help_text, label_names)
+    self._values: Dict[LabelValues, float] = {}
+
+  def set(self, value: float, *label_values: str) -> None:
+    self._values[label_values] = value
+
+  def inc(self, *label_values: str, amount: float = 1) -> None:
+    self._values[label_values] = self._values.get(label_values, 0) + amount
+
+  def dec(self, *label_values: str, amount: float = 1) -> None:
+    self.inc(*label_values, amount=-amount)
+
+  def render(self) -> List[str]:
+    return self.header() + [f"{self.name}{_format_labels(self.label_names, labels)} {_format_value(value)}" for labels, value in self._values.items()]
+
+
+class Histogram(_Metric):
+  kind = "histogram"
+
+  def __init__(self, name: str, help_text: str, label_names: Sequence[str] = (), buckets: Sequence[float] = DEFAULT_BUCKETS):
+    super().__init__(name, help_text, label_names)
+    self.buckets = tuple(sorted(buckets)) + (math.inf,)
+    # label values -> (per-bucket counts, sum, count)
+    self._values: Dict[LabelValues, Tuple[List[int], List[float]]] = {}
+
+  def observe(self, value: float, *label_values: str) -> None:
+    entry = self._values.get(label_values)
+    if entry is None:
+      entry = self._values[label_values] = ([0] * len(self.buckets), [0.0, 0])
+    counts, totals = entry
+    for i, bound in enumerate(self.buckets):
+      if value <= bound:
+        counts[i] += 1
+        break
+    totals[0] += value
+    totals[1] += 1
+
+  @contextmanager
+  def time(self, *label_values: str) -> Iterator[None]:
+    start = time.perf_counter()
+    try:
+      yield
+    finally:
+      self.observe(time.perf_counter() - start, *label_values)
+
+  def render(self) -> List[str]:
+    lines = self.header()
+    for labels, (counts, (total, count)) in self._values.items():
+      cumulative = 0
+      for bound, bucket_count in zip(self.buckets, counts):
+        cumulative += bucket_count
+        lines.append(f"{self.name}_bucket{_format_labels(self.label_names, labels, ('le', _format_value(bound)))} {cumulative}")
+      lines.append(f"{self.name}_sum{_format_labels(self.label_names, labels)} {_format_value(total)}")
+      lines.append(f"{self.name}_count{_format_labels(self.label_names, labels)} {int(count)}")
+    return lines
+
+
+class MetricsRegistry:
+  def __init__(self):
+    self._metrics: List[_Metric] = []
+    # called on every scrape to refresh gauges that mirror other components' counters
+    self._collectors: List[Callable[[], None]] = []
+
+  def register(self, metric: _Metric) -> _Metric:
+    self._metrics.append(metric)
+    return metric
+
+  def add_collector(self, collector: Callable[[], None]) -> None:
+    self._collectors.append(collector)
+
+  def render(self) -> str:
+    for collector in self._collectors:
+      collector()
+    lines: List[str] = []
+    for metric in self._metrics:
+      lines.extend(metric.render())
+    return "\n".join(lines) + "\n"
+
+
+registry = MetricsRegistry()
+
+TIME_TO_FIRST_TOKEN = registry.register(Histogram("chat_time_to_first_token_seconds", "Time from sending a completion request to its first token"))
+TOKENS_PER_SECOND = registry.register(Histogram(
+  "chat_stream_tokens_per_second", "Completion tokens per second of each stream after the first token",
+  buckets=(5, 10, 20, 30, 40, 50, 75, 100, 150, 200, 300, 500),
+))
+PROMPT_TOKENS = registry.register(Histogram(
+  "chat_prompt_tokens", "Tokens of each chat prompt, as estimated when it is built",
+  buckets=(250, 500, 1000, 2000, 4000, 8000, 16000, 32000, 64000, 128000),
+))
+TURN_DURATION = registry.register(Histogram("chat_turn_duration_seconds", "Time from receiving a chat message to sending END"))
+DAO_DURATION = registry.register(Histogram("dao_operation_duration_seconds", "Latency of DAO methods", ("dao", "method")))
+ACTIVE_WEBSOCKETS = registry.register(Gauge("chat_websockets_active", "Open chat websockets"))
+UPSTREAM_ERRORS = registry.register(Counter("chat_upstream_errors_total", "Errors returned by the OpenAI API", ("type",)))
+ACTIVE_WEBSOCKETS.set(0)
+CANCELLED_REPLIES = registry.register(Counter("chat_replies_cancelled_total", "Replies cut short by the client, by reason (stop, interrupt, disconnect)", ("reason",)))
+COMPONENT_STATS = registry.register(Gauge("chat_component_stat", "Counters and levels reported by caches, queues and the scheduler", ("component", "stat")))
+
+
+def instrument_dao(cls):
+  """Class decorator recording the latency of every public coroutine method in DAO_DURATION."""
+  for name, method in list(vars(cls).items()):
+    if name.startswith("_") or not inspect.iscoroutinefunction(method):
+      continue
+    setattr(cls, name, _timed(cls.__name__, name, method))
+  return cls
+
+
+def _timed(dao_name: str, method_name: str, method):
+  @functools.wraps(method)
+  async def wrapper(*args, **kwargs):
+    with DAO_DURATION.time(dao_name, method_name):
+      return await method(*args, **kwargs)
+  return wrapper
+
+
+def add_component_stats(component: str, stats: Callable[[], Dict]) -> None:
+  """Mirrors the numeric values of a component's stats() into COMPONENT_STATS on every scrape."""
+  def collect() -> None:
+    for stat, value in stats().items():
+      if isinstance(value, (int, float)) and not isinstance(value, bool):
+        COMPONENT_STATS.set(value, component, stat)
+  registry.add_collector(collect)
+
+
+class RequestTrace:
+  """Opt-in timing of the stages of one request, in milliseconds."""
+
+  def __init__(self):
+    self.stages: Dict[str, float] = {}
+
+  @contextmanager
+  def stage(self, name: str) -> Iterator[None]:
+    start = time.perf_counter()
+    try:
+      yield
+    finally:
+      self.record(name, time.perf_counter() - start)
+
+  def record(self, name: str, seconds: float) -> None:
+    self.stages[name] = round(self.stages.get(name, 0) + seconds * 1000, 3)
@@ -0,0 +1,26 @@
+"""Backfills user_id and updated_at on conversations stored before they were indexed fields.
+
+Run from the chat-backend directory with: python -m migrations.backfill_conversation_user_ids
+"""
+import asyncio
+import logging
+
+from clients.mongo_client import close_mongo_client, connect_mongo_client
+from daos.conversation_dao import ConversationDAO
+
+logger = logging.getLogger(__name__)
+
+
+async def main() -> None:
+    conversation_dao = ConversationDAO(connect_mongo_client())
+    try:
+        await conversation_dao.ensure_indexes()
+        updated = await conversation_dao.backfill_user_fields()
+        logger.info(f"Backfilled user_id and updated_at on {updated} conversations")
+    finally:
+        await close_mongo_client()
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    asyncio.run(main())
@@ -1,18 +1,60 @@
-from typing import List, Optional
+from datetime import datetime, timezone
+from typing import Any, Dict, List, Optional, Union
 import uuid
-from pydantic import BaseModel, Field, model_validator
+from pydantic import BaseModel, Field, GetCoreSchemaHandler, model_validator
+from pydantic_core import core_schema
+
+from content_codec import decode_content
 
 
 class ChatMessage(BaseModel):
   role: Optional[str] = Field(default="user", description="The role of the message")
-  message_id: Optional[str] = Field(default=str(uuid.uuid4()), description="The ID of the message")
+  message_id: Optional[str] = Field(default_factory=lambda: str(uuid.uuid4()), description="The ID of the message")
   content: str
+  # cached so history is only tokenized once per message
+  token_count: Optional[int] = Field(default=None, description="The number of prompt tokens the message uses")
+  truncated: bool = Field(default=False, description="Whether the reply was cut short because the client stopped or left")
+
+class StoredMessage:
+  """Compact, unvalidated stand-in for ChatMessage used for history read from our own database.
+
+  Has the same attributes as ChatMessage at a fraction of the memory and construction cost, which
+  matters for conversations with thousands of messages. Serializes like ChatMessage when a model holding
+  it is dumped.
+  """
+  __slots__ = ("role", "message_id", "content", "token_count", "truncated")
+
+  def __init__(self, role: Optional[str], message_id: Optional[str], content: str, token_count: Optional[int] = None, truncated: bool = False):
+    self.role = role
+    self.message_id = message_id
+    self.content = content
+    self.token_count = token_count
+    self.truncated = truncated
+
+  @classmethod
+  def from_document(cls, data: Dict[str, Any]) -> "StoredMessage":
+    message_id = data["message_id"] if "message_id" in data else str(uuid.uuid4())
+    # long content is stored compressed, see daos/conversation_dao.message_document
+    content = data["content"] if "content" in data else decode_content(data["encoding"], data["content_z"])
+    return cls(data.get("role", "user"), message_id, content, data.get("token_count"), data.get("truncated", False))
+
+  def to_dict(self) -> Dict[str, Any]:
+    return {"role": self.role, "message_id": self.message_id, "content": self.content, "token_count": self.token_count, "truncated": self.truncated}
+
+  @classmethod
+  def __get_pydantic_core_schema__(cls, source: Any, handler: GetCoreSchemaHandler) -> core_schema.CoreSchema:
+    # only ever set by from_document, anything else validates as a ChatMessage
+    return core_schema.is_instance_schema(cls, serialization=core_schema.plain_serializer_function_ser_schema(cls.to_dict))
 
 class Conversation(BaseModel):
-  user_id: Optional[str] = Field(exclude=True, description="The ID of the user")
+  # stored and indexed together with updated_at to list a user's conversations
+  user_id: Optional[str] = Field(default=None, description="The ID of the user")
   # The ID of the conversation; setting the alias to _id allows the field to be used as the MongoDB _id field
   conversation_id: Optional[str] = Field(default=None, description="The ID of the conversation", alias="_id")
-  messages: Optional[List[ChatMessage]] = Field(default=[], description="The messages in the conversation")
+  messages: Optional[List[Union[ChatMessage, StoredMessage]]] = Field(default=[], description="The messages in the conversation")
+  summary: Optional[str] = Field(default=None, description="Rolling summary of the older messages in the conversation")
+  summary_message_count: int = Field(default=0, description="The number of leading messages covered by the summary")
+  updated_at: Optional[datetime] = Field(default_factory=lambda: datetime.now(timezone.utc), description="When a message was last added to the conversation")
 
   # Allows us to set conversation_id if not already set and cluster by user_id
   @model_validator(mode='after')
@@ -25,6 +67,22 @@ class Conversation(BaseModel):
       raise ValueError("conversation_id or user_id must be set")
     return self
 
+  @classmethod
+  def from_document(cls, data: Dict[str, Any]) -> "Conversation":
+    """Builds a conversation from a stored document without validating it, holding its messages as StoredMessages."""
+    data = dict(data)
+    data["messages"] = [StoredMessage.from_document(message) for message in data.get("messages") or []]
+    conversation = cls.model_construct(**data)
+    if not conversation.user_id:
+      conversation.user_id = conversation.conversation_id.split("-")[0]
+    return conversation
+
+class SearchResult(BaseModel):
+  conversation_id: str = Field(description="The ID of the matching conversation")
+  message_id: str = Field(description="The ID of the best matching message in the conversation")
+  score: float = Field(description="BM25 score of the message")
+  snippet: str = Field(description="Text around the first match in the message")
+
 class User(BaseModel):
   user_id: str = Field(alias="_id")
   conversations: Optional[List[Conversation]] = Field(default=[], description="The conversations of the user")
@@ -1,11 +1,19 @@
+import asyncio
 import logging
-from typing import Annotated, List
-from fastapi import APIRouter, BackgroundTasks, Cookie, Depends, FastAPI, Path, Query, WebSocket, WebSocketException, status
+import time
+from typing import Annotated, List, Optional
+from fastapi import APIRouter, BackgroundTasks, Cookie, Depends, FastAPI, Path, Query, WebSocket, WebSocketDisconnect, WebSocketException, status
 from fastapi.websockets import WebSocketState
 
-from models.models import ChatMessage, Conversation, User
+from config import settings
+from exceptions.custom_exceptions import RateLimitError, SchedulerBusyError
+from metrics import ACTIVE_WEBSOCKETS, TURN_DURATION, RequestTrace
+from models.models import SearchResult
 from services.chat_service import ChatService
+from services.reply_streams import ReplyStream, reply_streams
 from services.user_service import UserService
+from structured_logging import log_fields
+from util import coalesce_deltas
 
 
 router = APIRouter(
@@ -15,78 +23,248 @@ router = APIRouter(
 
 logger = logging.getLogger(__name__)
 
+# each frame between START and END carries the whole reply so far (the original protocol)
+STREAM_MODE_CUMULATIVE = "cumulative"
+# each frame between START and END carries only the text to append to the reply
+STREAM_MODE_DELTA = "delta"
+
+# sent while a reply is streaming to cut it short; the partial reply is saved, marked truncated
+STOP_COMMAND = "######STOP######"
+
+# followed by a frame "<stream_id> <offset>": sends the rest of a resumable reply from offset characters, as deltas
+RESUME_COMMAND = "######RESUME######"
+
+
+async def send_history_page(websocket: WebSocket, chat_service: ChatService, conversation_id: str, before: Optional[int]) -> bool:
+    page = await chat_service.get_conversation_page(conversation_id, settings.HISTORY_PAGE_SIZE, before)
+    if page is None:
+        logger.error("Conversation %s not found", conversation_id)
+        await websocket.send_text("######CONVERSATION_NOT_FOUND######")
+        return False
+    messages, cursor = page
+    await websocket.send_json({
+        "type": "history",
+        "conversation_id": conversation_id,
+        "messages": [{"message_id": message.message_id, "role": message.role, "content": message.content, "truncated": message.truncated} for message in messages],
+        # send this back with ######LOAD_OLDER###### to get the page before; null once the oldest message was sent
+        "cursor": cursor,
+    })
+    return True
+
+
+async def send_reply(websocket: WebSocket, stream: ReplyStream, offset: int, stream_mode: str) -> None:
+    while True:
+        text, done = await stream.read(offset)
+        if text:
+            offset += len(text)
+            if stream_mode == STREAM_MODE_DELTA:
+                await websocket.send_text(text)
+            else:
+                await websocket.send_text(stream.text)
+        if done:
+            return
+
+
+async def follow_reply(websocket: WebSocket, stream: ReplyStream, offset: int, stream_mode: str, next_frame: asyncio.Future) -> bool:
+    """Sends the reply from offset until it's done and saved, while listening for the next frame.
+
+    STOP or a new message cancel the reply. Returns False if the connection was lost, in which case the reply
+    is cancelled, or for a resumable one kept running for RESUME_GRACE_S.
+    """
+    sending = asyncio.create_task(send_reply(websocket, stream, offset, stream_mode))
+    try:
+        await asyncio.wait({sending, next_frame}, return_when=asyncio.FIRST_COMPLETED)
+        if not sending.done():
+            if next_frame.exception() is not None:
+                return False
+            stream.cancel("stop" if next_frame.result() == STOP_COMMAND else "interrupt")
+            # the cut reply is saved, truncated, before it's done
+            await asyncio.wait({sending})
+        return sending.exception() is None
+    finally:
+        sending.cancel()
+        stream.detach()
+
+
+async def end_reply(websocket: WebSocket, stream: ReplyStream) -> None:
+    if isinstance(stream.error, (SchedulerBusyError, RateLimitError)):
+        # the turn isn't saved, the client can send the message again later
+        logger.warning("Chat for user %s shed: %s", stream.user_id, stream.error)
+        await websocket.send_text("######BUSY######")
+    elif stream.error is not None:
+        raise stream.error
+    await websocket.send_text("######END######")
+
+
+@router.get("/{user_id}/search", response_model=List[SearchResult])
+async def search_conversations(chat_service: Annotated[ChatService, Depends(ChatService)],
+                               user_id: Annotated[str, Path()],
+                               q: Annotated[str, Query(min_length=1, max_length=500)],
+                               limit: Annotated[int, Query(ge=1, le=100)] = settings.SEARCH_RESULTS_LIMIT):
+    return await chat_service.search_conversations(user_id, q, limit)
+
 
 @router.websocket("/{user_id}")
 async def websocket(websocket: WebSocket, 
                     chat_service: Annotated[ChatService, Depends(ChatService)], 
                     user_service: Annotated[UserService, Depends(UserService)],
-                    user_id: Annotated[str, Path()]):
+                    user_id: Annotated[str, Path()],
+                    stream_mode: Annotated[str, Query()] = STREAM_MODE_CUMULATIVE,
+                    resumable: Annotated[bool, Query()] = False,
+                    trace: Annotated[bool, Query()] = False):
+    ACTIVE_WEBSOCKETS.inc()
+    connect_start = time.perf_counter()
+    # a frame that arrived while a reply was streaming, handled as the next command
+    next_frame: Optional[asyncio.Future] = None
+    user_ready: Optional[asyncio.Task] = None
     try:
-        cur_user = user_service.get_user(user_id)
-        if cur_user == None:
-            logger.info(f"User {user_id} not found, creating...")
-            user = User(_id=user_id)
-            cur_user = await user_service.create_user(user)
-        
-        # Check if conversation exists, if not create it
-        conversations = chat_service.get_conversations_by_user(user_id)
-        if len(conversations) == 0:
-            conversation = chat_service.create_conversation(user_id)
-        else:
-            conversation = conversations[0]
+        if stream_mode not in (STREAM_MODE_CUMULATIVE, STREAM_MODE_DELTA):
+            raise WebSocketException(code=status.WS_1008_POLICY_VIOLATION, reason=f"Unknown stream_mode {stream_mode}")
+        # accept right away and create the user (one upsert) while its conversations are listed
         await websocket.accept()
+        user_ready = asyncio.create_task(user_service.ensure_user(user_id))
+        conversations = await chat_service.get_conversations_by_user(user_id)
+        conversation_id = conversations[0].conversation_id if conversations else None
+        if conversation_id is not None:
+            # chat turns load the whole conversation, the listing only holds its first message
+            chat_service.schedule_history_prefetch(conversation_id)
         await websocket.send_text("######CONVERSATIONS######")
-        if len(conversations) > 5:
-            for past_convo in conversations[-5:]:
-                # send the conversation id
-                await websocket.send_text(past_convo.conversation_id)
-                # send the first message in the conversation
-                if len(past_convo.messages) > 0:
-                    await websocket.send_text(past_convo.messages[0].content)
-        else:
-            for past_convo in conversations:
-                # send the conversation id
-                await websocket.send_text(past_convo.conversation_id)
-                # send the first message in the conversation
-                if len(past_convo.messages) > 0:
-                    await websocket.send_text(past_convo.messages[0].content)        
+        for past_convo in conversations[:5]:
+            # send the conversation id
+            await websocket.send_text(past_convo.conversation_id)
+            # send the first message in the conversation
+            if len(past_convo.messages) > 0:
+                await websocket.send_text(past_convo.messages[0].content)
+        if len(conversations) <= 5:
             await websocket.send_text("######ALL_CONVERSATIONS######")
+        await user_ready
+        if conversation_id is None:
+            conversation_id = (await chat_service.create_conversation(user_id, verify_user=False)).conversation_id
+        if trace:
+            connect_trace = RequestTrace()
+            connect_trace.record("connect", time.perf_counter() - connect_start)
+            await websocket.send_json({"type": "trace", "stages": connect_trace.stages})
         #begin the chat loop
         while True:
-            data = await websocket.receive_text()
+            if next_frame is None:
+                data = await websocket.receive_text()
+            else:
+                data, next_frame = await next_frame, None
+            if data == STOP_COMMAND:
+                # nothing is streaming anymore
+                continue
+            turn_start = time.perf_counter()
+            turn_trace = RequestTrace()
             # Switch conversations if the client sends the switch command
             if data == "#####SWITCH_CONVERSATION######":
-                conversation_id = await websocket.receive_text()
-                conversation = chat_service.get_conversation_by_id(conversation_id)
+                switch_id = await websocket.receive_text()
+                conversation = await chat_service.get_conversation_by_id(switch_id)
                 if conversation == None:
-                  logger.error(f"Conversation {conversation_id} not found")
+                  logger.error("Conversation %s not found", switch_id)
                   await websocket.send_text("######CONVERSATION_NOT_FOUND######")
                   continue
+                conversation_id = switch_id
                 await websocket.send_text("######CONVERSATION_FOUND######")
                 for message in conversation.messages:
                   await websocket.send_text(message.content)
                 await websocket.send_text("######CONVERSATION_SWITCHED######")
                 continue
+            # Switch conversations, sending only the newest page of history as one frame
+            if data == "######SWITCH_CONVERSATION_PAGED######":
+                switch_id = await websocket.receive_text()
+                if await send_history_page(websocket, chat_service, switch_id, None):
+                    conversation_id = switch_id
+                continue
+            # Send the page of history before the cursor of the last page sent
+            if data == "######LOAD_OLDER######":
+                cursor = await websocket.receive_text()
+                if not cursor.isdigit():
+                    await websocket.send_text("######INVALID_CURSOR######")
+                    continue
+                await send_history_page(websocket, chat_service, conversation_id, int(cursor))
+                continue
 
+            # Find conversations by their content
+            if data == "######SEARCH######":
+                query = await websocket.receive_text()
+                results = await chat_service.search_conversations(user_id, query)
+                await websocket.send_json({"type": "search", "query": query, "results": [result.model_dump() for result in results]})
+                continue
+
+            # Pick up a reply that was streaming when the client lost its previous connection
+            if data == RESUME_COMMAND:
+                resume_args = (await websocket.receive_text()).split()
+                stream = None
+                if len(resume_args) == 2 and resume_args[1].isdigit():
+                    stream = reply_streams.resume(user_id, resume_args[0], int(resume_args[1]))
+                if stream is None:
+                    await websocket.send_text("######RESUME_FAILED######")
+                    continue
+                conversation_id = stream.conversation_id
+                await websocket.send_text("######START######")
+                next_frame = asyncio.ensure_future(websocket.receive_text())
+                if not await follow_reply(websocket, stream, int(resume_args[1]), STREAM_MODE_DELTA, next_frame):
+                    return
+                await end_reply(websocket, stream)
+                continue
+
+            # Load the full conversation, usually from the shared cache
+            with turn_trace.stage("history_load"):
+                conversation = await chat_service.get_conversation_by_id(conversation_id)
+            if conversation == None:
+                logger.error("Conversation %s not found", conversation_id)
+                await websocket.send_text("######CONVERSATION_NOT_FOUND######")
+                continue
             # Send the message to the chatbot and get the response
-            chats = chat_service.chat(data, conversation_history=conversation.messages)
-            full_message = ""
-            chunks = []
-            await websocket.send_text("######START######")
-            async for chat in chats:
-                await websocket.send_text(chat)
-                full_message = chat
-            user_message = ChatMessage(role="user", content=data)
-            bot_reply = ChatMessage(role="bot", content=full_message)
-            conversation.messages.append(user_message)
-            conversation.messages.append(bot_reply)
-            chat_service.add_message_to_conversation(conversation.conversation_id, user_message)
-            chat_service.add_message_to_conversation(conversation.conversation_id, bot_reply)
-            await websocket.send_text("######END######")
+            chats = coalesce_deltas(
+                chat_service.chat(
+                    data,
+                    conversation_history=conversation.messages[conversation.summary_message_count:],
+                    summary=conversation.summary,
+                    user_id=user_id,
+                    trace=turn_trace,
+                    conversation_id=conversation_id,
+                    history_start=conversation.summary_message_count,
+                ),
+                settings.STREAM_FLUSH_INTERVAL_MS / 1000,
+                settings.STREAM_FLUSH_BYTES,
+            )
+            # the reply is read by a task of its own, which saves the turn when it's done
+            stream = reply_streams.start(user_id, conversation_id, data, chats, chat_service, conversation, turn_trace, resumable)
+            next_frame = asyncio.ensure_future(websocket.receive_text())
+            try:
+                if resumable:
+                    await websocket.send_json({"type": "stream", "stream_id": stream.stream_id})
+                await websocket.send_text("######START######")
+            except BaseException:
+                stream.detach()
+                raise
+            # keep listening while the reply streams, so STOP, a new message or a disconnect cancel it
+            if not await follow_reply(websocket, stream, 0, stream_mode, next_frame):
+                return
+            await end_reply(websocket, stream)
+            if stream.error is not None:
+                continue
+            turn_duration = time.perf_counter() - turn_start
+            TURN_DURATION.observe(turn_duration)
+            logger.info("Chat turn finished", extra=log_fields(
+                user_id=user_id, conversation_id=conversation_id, duration_ms=round(turn_duration * 1000, 1), reply_chars=stream.length,
+            ))
+            if trace:
+                turn_trace.record("total", time.perf_counter() - turn_start)
+                await websocket.send_json({"type": "trace", "stages": turn_trace.stages})
+    except WebSocketDisconnect:
+        logger.info("User %s disconnected", user_id)
     except WebSocketException as e:
-        logger.error(f"WebSocketException: {e}")
+        logger.error("WebSocketException: %s", e)
         await websocket.close(code=status.WS_1008_POLICY_VIOLATION)
     except Exception as e:
-        logger.error(f"Exception: {e}")
+        logger.error("Exception: %s", e)
         await websocket.close(code=status.WS_1011_INTERNAL_ERROR)
+    finally:
+        if next_frame is not None:
+            next_frame.cancel()
+        if user_ready is not None:
+            user_ready.cancel()
+        ACTIVE_WEBSOCKETS.dec()
         
\ No newline at end of file
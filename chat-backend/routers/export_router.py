@@ -0,0 +1,57 @@
+import secrets
+from typing import Annotated, AsyncIterator, List, Optional, Sequence
+from fastapi import APIRouter, Depends, Header, HTTPException, Query
+from fastapi.responses import StreamingResponse
+
+from config import settings
+from services.export_service import CONVERSATION_FIELDS, USER_FIELDS, ExportService
+
+
+def check_export_token(authorization: Annotated[Optional[str], Header()] = None) -> None:
+    if not settings.EXPORT_TOKEN:
+        return
+    if authorization is None or not secrets.compare_digest(authorization.encode(), f"Bearer {settings.EXPORT_TOKEN}".encode()):
+        raise HTTPException(status_code=401, detail="Export requires a valid bearer token", headers={"WWW-Authenticate": "Bearer"})
+
+
+router = APIRouter(
+    prefix="/export",
+    tags=["export"],
+    dependencies=[Depends(check_export_token)],
+)
+
+
+def parse_fields(fields: Optional[str], allowed: Sequence[str]) -> Optional[List[str]]:
+    if fields is None:
+        return None
+    requested = [field.strip() for field in fields.split(",") if field.strip()]
+    unknown = [field for field in requested if field not in allowed]
+    if unknown:
+        raise HTTPException(status_code=400, detail=f"Unknown fields {', '.join(unknown)}, expected some of {', '.join(allowed)}")
+    return requested
+
+
+def ndjson_response(chunks: AsyncIterator[bytes], gzip: bool) -> StreamingResponse:
+    return StreamingResponse(chunks, media_type="application/x-ndjson", headers={"Content-Encoding": "gzip"} if gzip else None)
+
+
+@router.get("/conversations")
+async def export_conversations(export_service: Annotated[ExportService, Depends(ExportService)],
+                               after: Annotated[Optional[str], Query(description="Only conversations whose _id sorts after this one, to resume an export")] = None,
+                               fields: Annotated[Optional[str], Query(description="Comma separated fields to include besides _id")] = None,
+                               batch_size: Annotated[int, Query(ge=1, le=10000)] = settings.EXPORT_BATCH_SIZE,
+                               gzip: Annotated[bool, Query()] = False):
+    """Streams every conversation, in _id order, as one JSON document per line."""
+    chunks = export_service.export_conversations(after, batch_size, parse_fields(fields, CONVERSATION_FIELDS), gzip)
+    return ndjson_response(chunks, gzip)
+
+
+@router.get("/users")
+async def export_users(export_service: Annotated[ExportService, Depends(ExportService)],
+                       after: Annotated[Optional[str], Query(description="Only users whose _id sorts after this one, to resume an export")] = None,
+                       fields: Annotated[Optional[str], Query(description="Comma separated fields to include besides _id")] = None,
+                       batch_size: Annotated[int, Query(ge=1, le=10000)] = settings.EXPORT_BATCH_SIZE,
+                       gzip: Annotated[bool, Query()] = False):
+    """Streams every user, in _id order, as one JSON document per line."""
+    chunks = export_service.export_users(after, batch_size, parse_fields(fields, USER_FIELDS), gzip)
+    return ndjson_response(chunks, gzip)
@@ -0,0 +1,153 @@
+import asyncio
+import logging
+import time
+from collections import OrderedDict
+from typing import Any, Awaitable, Callable, Dict, Generic, Hashable, Optional, Tuple, TypeVar
+
+from config import settings
+
+logger = logging.getLogger(__name__)
+
+V = TypeVar("V")
+
+
+class LRUTTLCache(Generic[V]):
+  """Process-wide LRU cache with a time to live, bounded by entry count and total weight.
+
+  Concurrent misses for the same key in get_or_load share a single call to the loader.
+  """
+
+  def __init__(self, name: str, max_entries: int, max_weight: int, ttl_seconds: float, weigher: Callable[[V], int] = lambda value: 1):
+    self.name = name
+    self.max_entries = max_entries
+    self.max_weight = max_weight
+    self.ttl_seconds = ttl_seconds
+    self.weigher = weigher
+    # key -> (value, weight, expires_at), least recently used first
+    self._entries: "OrderedDict[Hashable, Tuple[V, int, float]]" = OrderedDict()
+    self._inflight: Dict[Hashable, asyncio.Future] = {}
+    self._weight = 0
+    self.hits = 0
+    self.misses = 0
+    self.evictions = 0
+    self.expirations = 0
+    self.loads = 0
+    self.coalesced_loads = 0
+
+  def __len__(self) -> int:
+    return len(self._entries)
+
+  def get(self, key: Hashable) -> Optional[V]:
+    value = self.peek(key)
+    if value is None:
+      self.misses += 1
+    else:
+      self.hits += 1
+    return value
+
+  def peek(self, key: Hashable) -> Optional[V]:
+    entry = self._entries.get(key)
+    if entry is None:
+      return None
+    value, _, expires_at = entry
+    if expires_at <= time.monotonic():
+      self._remove(key)
+      self.expirations += 1
+      return None
+    self._entries.move_to_end(key)
+    return value
+
+  def set(self, key: Hashable, value: V) -> None:
+    if key in self._entries:
+      self._remove(key)
+    weight = self.weigher(value)
+    if weight > self.max_weight:
+      # would evict everything else and still not fit
+      return
+    self._entries[key] = (value, weight, time.monotonic() + self.ttl_seconds)
+    self._weight += weight
+    while len(self._entries) > self.max_entries or self._weight > self.max_weight:
+      oldest_key = next(iter(self._entries))
+      self._remove(oldest_key)
+      self.evictions += 1
+
+  def invalidate(self, key: Hashable) -> None:
+    if key in self._entries:
+      self._remove(key)
+
+  def clear(self) -> None:
+    self._entries.clear()
+    self._weight = 0
+
+  async def get_or_load(self, key: Hashable, loader: Callable[[], Awaitable[Optional[V]]]) -> Optional[V]:
+    value = self.get(key)
+    if value is not None:
+      return value
+    load = self._inflight.get(key)
+    if load is None:
+      self.loads += 1
+      # the load runs in its own task, so whichever caller started it can be cancelled without failing the others
+      load = self._inflight[key] = asyncio.ensure_future(self._load(key, loader))
+      load.add_done_callback(self._load_done)
+    else:
+      self.coalesced_loads += 1
+    # shield so a caller being cancelled only stops its own wait
+    return await asyncio.shield(load)
+
+  async def _load(self, key: Hashable, loader: Callable[[], Awaitable[Optional[V]]]) -> Optional[V]:
+    try:
+      value = await loader()
+      if value is not None:
+        self.set(key, value)
+      return value
+    finally:
+      self._inflight.pop(key, None)
+
+  @staticmethod
+  def _load_done(load: asyncio.Future) -> None:
+    # the callers (if any are left) see the exception, don't warn about it being unretrieved
+    if not load.cancelled():
+      load.exception()
+
+  def stats(self) -> Dict[str, Any]:
+    lookups = self.hits + self.misses
+    return {
+      "entries": len(self._entries),
+      "weight": self._weight,
+      "max_entries": self.max_entries,
+      "max_weight": self.max_weight,
+      "hits": self.hits,
+      "misses": self.misses,
+      "hit_rate": self.hits / lookups if lookups else 0.0,
+      "evictions": self.evictions,
+      "expirations": self.expirations,
+      "loads": self.loads,
+      "coalesced_loads": self.coalesced_loads,
+    }
+
+  def _remove(self, key: Hashable) -> None:
+    _, weight, _ = self._entries.pop(key)
+    self._weight -= weight
+
+
+# conversation_id -> Conversation, weighed by number of messages
+conversation_cache: LRUTTLCache = LRUTTLCache(
+  "conversations",
+  max_entries=settings.CONVERSATION_CACHE_MAX_ENTRIES,
+  max_weight=settings.CONVERSATION_CACHE_MAX_MESSAGES,
+  ttl_seconds=settings.CACHE_TTL_S,
+  weigher=lambda conversation: len(conversation.messages) + 1,
+)
+
+# user_id -> the user's first page of conversations
+user_conversations_cache: LRUTTLCache = LRUTTLCache(
+  "user_conversations",
+  max_entries=settings.USER_CACHE_MAX_ENTRIES,
+  max_weight=settings.USER_CACHE_MAX_CONVERSATIONS,
+  ttl_seconds=settings.CACHE_TTL_S,
+  weigher=lambda conversations: len(conversations) + 1,
+)
+
+
+def cache_stats() -> Dict[str, Dict[str, Any]]:
+  return {cache.name: cache.stats() for cache in (conversation_cache, user_conversations_cache)}
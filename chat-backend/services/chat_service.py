@@ -1,13 +1,31 @@
+import asyncio
 import logging
 import os
-from typing import Annotated, AsyncGenerator, Dict, Generator, List, Optional
+import time
+from datetime import datetime, timezone
+from typing import Annotated, Any, AsyncGenerator, AsyncIterator, Dict, Generator, List, Optional, Set, Tuple
 from fastapi import Depends, HTTPException
-from openai import AsyncOpenAI, OpenAI, RateLimitError, InternalServerError, BadRequestError
+import openai
+from openai import AsyncOpenAI, AsyncStream, OpenAIError
+from openai.types import CompletionUsage
+from openai.types.chat import ChatCompletionChunk
 from clients.chat_client import get_openai_client
+from config import settings
+from metrics import PROMPT_TOKENS, TIME_TO_FIRST_TOKEN, TOKENS_PER_SECOND, UPSTREAM_ERRORS, RequestTrace
 from daos.conversation_dao import ConversationDAO
+from daos.conversation_store import get_conversation_dao
 from daos.user_dao import UserDAO
-from exceptions.custom_exceptions import ConversationNotFoundError, UserNotFoundError
-from models.models import ChatMessage, Conversation, User
+from exceptions.custom_exceptions import BadRequestError, ConversationNotFoundError, DatabaseError, InternalServerError, RateLimitError, SchedulerBusyError, UserNotFoundError
+from models.models import ChatMessage, Conversation, SearchResult, User
+from services.cache import conversation_cache, user_conversations_cache
+from services.llm_scheduler import llm_scheduler
+from services.model_router import model_router
+from services.context_builder import SYSTEM_PROMPT, build_messages, count_tokens, history_token_budget, history_window_start, message_tokens
+from services.persistence_queue import message_queue
+from services.response_cache import response_cache
+from services.history_relevance import history_relevance
+from services.search_index import search_indexes
+from structured_logging import log_fields
 from util import value_from_validation_error
 from dotenv import load_dotenv
 from pydantic import ValidationError
@@ -15,114 +33,353 @@ load_dotenv()
 
 logger = logging.getLogger(__name__)
 
+# keeps background summary tasks referenced until they finish
+_summary_tasks: Set[asyncio.Task] = set()
+# conversations with a summary update in flight, so two quick turns don't fold the same messages
+_summarizing: Set[str] = set()
+# keeps history prefetches referenced until they finish
+_prefetch_tasks: Set[asyncio.Task] = set()
+
+# scheduler queue shared by all summary updates, so they take turns with users and together never hold
+# more than one user's share of upstream slots
+SUMMARY_SCHEDULER_USER = "background:summaries"
+# number of conversations listed on connect, and the only page that is cached
+USER_CONVERSATIONS_PAGE_SIZE = 10
+
+
+def retry_after_seconds(error: openai.APIStatusError) -> Optional[float]:
+  try:
+    return float(error.response.headers.get("retry-after"))
+  except (TypeError, ValueError):
+    return None
+
+
+async def chain_chunks(first_chunks: List[ChatCompletionChunk], rest: AsyncIterator[ChatCompletionChunk]) -> AsyncGenerator[ChatCompletionChunk, None]:
+  for chunk in first_chunks:
+    yield chunk
+  async for chunk in rest:
+    yield chunk
+
+
 class ChatService:
-  def __init__(self, conversation_dao: Annotated[ConversationDAO, Depends(ConversationDAO)], user_dao: Annotated[UserDAO, Depends(UserDAO)], openai_client: Annotated[OpenAI, Depends(get_openai_client)]):
+  def __init__(self, conversation_dao: Annotated[ConversationDAO, Depends(get_conversation_dao)], user_dao: Annotated[UserDAO, Depends(UserDAO)], openai_client: Annotated[AsyncOpenAI, Depends(get_openai_client)]):
     self.conversation_dao: ConversationDAO = conversation_dao
     self.user_dao: UserDAO = user_dao
     self.openai_client: AsyncOpenAI = openai_client
-    # map of the user_id to the conversation
-    self.user_cache: Dict[str, List[Conversation]] = {}
-    self.rate_limit_error_count = 0
 
-  async def chat(self, message: str, conversation_history: List[ChatMessage]) -> AsyncGenerator[str, None]:
+  async def chat(self, message: str, conversation_history: List[ChatMessage], summary: Optional[str] = None, user_id: Optional[str] = None, trace: Optional[RequestTrace] = None, conversation_id: Optional[str] = None, history_start: int = 0) -> AsyncGenerator[str, None]:
+    """Streams the reply to message. history_start is the position of the first message of conversation_history in the conversation."""
+    trace = trace or RequestTrace()
     try:
-      messages = []
-      num_history_messages = 0
-      if len(conversation_history) > 10:
-        conversation_history = conversation_history[-10:]
-      for past_message in conversation_history:
-        if past_message.role == "bot":
-          messages.append({"role": "system", "content": past_message.content})
-        else:
-          messages.append({"role": "user", "content": past_message.content})
-        num_history_messages += 1
-      messages.append({"role": "system", "content": f"You are a helpful chat assistant that only responds in markdown. Format the response as markdown. This means coding blocks should be formatted with ``````. Make sure to use the correct syntax for the language, closing all tags. You must respond in proper markdown. The user does not need to know that you are responding in markdown, they only need to read the formatted response. Do not tell them the format is markdown or the answer is formatted in any way. Use the previous conversation history to answer the user's question, as this is a follow up to the conversation."})
-      messages.append({"role": "user", "content": message})
-      logger.info(f"Messages: {messages}")
-      response = await self.openai_client.chat.completions.create(
-        model="gpt-4o",
-        messages=messages,
-        temperature=0,
-        stream=True
-        )
-      all_content = ""
-      async for chunk in response:
-          content = chunk.choices[0].delta.content
-          if content is not None:
-              all_content += content
-              yield all_content
-    except RateLimitError as e:
-      self.rate_limit_error_count += 1
-      logger.error(f"Error in chat: {e}")
+      with trace.stage("prompt_build"):
+        if settings.CONTEXT_RELEVANCE_ENABLED and conversation_id is not None:
+          history_budget = history_token_budget(message, settings.CONTEXT_TOKEN_BUDGET, summary)
+          conversation_history = await history_relevance.select(conversation_id, message, conversation_history, history_budget, history_start)
+        messages, prompt_tokens = build_messages(message, conversation_history, settings.CONTEXT_TOKEN_BUDGET, summary)
+      PROMPT_TOKENS.observe(prompt_tokens)
+      logger.debug("Prompt built", extra=log_fields(
+        user_id=user_id, prompt_tokens=prompt_tokens, context_messages=len(messages) - 2, history_messages=len(conversation_history), messages=messages,
+      ))
+      params = {"model": model_router.choose(count_tokens(message), len(conversation_history)), "temperature": 0}
+      cache_key = response_cache.key(messages, **params) if response_cache.should_use(user_id) else None
+      if cache_key is not None:
+        cached_response = await response_cache.get(cache_key)
+        if cached_response is not None:
+          logger.debug("Replaying cached response %s", cache_key)
+          # replay in chunks so cached answers go through the same streaming path as live ones
+          for i in range(0, len(cached_response), settings.RESPONSE_CACHE_REPLAY_CHUNK_CHARS):
+            yield cached_response[i:i + settings.RESPONSE_CACHE_REPLAY_CHUNK_CHARS]
+          return
+      estimated_tokens = prompt_tokens + settings.LLM_EXPECTED_COMPLETION_TOKENS
+      # holds an upstream slot until the stream is finished or the caller stops reading it
+      admission_start = time.perf_counter()
+      async with llm_scheduler.slot(user_id, estimated_tokens):
+        upstream_start = time.perf_counter()
+        trace.record("admission", upstream_start - admission_start)
+        first_token_at = None
+        usage: Optional[CompletionUsage] = None
+        response, first_chunks, rest = await self._open_stream(messages, params, estimated_tokens)
+        chunks: List[str] = []
+        finish_reason = None
+        try:
+          # yield only the new text of each chunk; callers decide how to frame and assemble it
+          async for chunk in chain_chunks(first_chunks, rest):
+              if chunk.usage is not None:
+                  usage = chunk.usage
+                  logger.debug("Upstream usage", extra=log_fields(user_id=user_id, prompt_tokens=chunk.usage.prompt_tokens, completion_tokens=chunk.usage.completion_tokens))
+                  llm_scheduler.record_usage(estimated_tokens, chunk.usage.total_tokens)
+              if not chunk.choices:
+                  continue
+              finish_reason = chunk.choices[0].finish_reason or finish_reason
+              content = chunk.choices[0].delta.content
+              if content:
+                  if first_token_at is None:
+                    first_token_at = time.perf_counter()
+                    TIME_TO_FIRST_TOKEN.observe(first_token_at - upstream_start)
+                  chunks.append(content)
+                  yield content
+        except (asyncio.CancelledError, GeneratorExit):
+          logger.info("Chat cancelled, closing the upstream stream", extra=log_fields(user_id=user_id, chunks=len(chunks)))
+          raise
+        finally:
+          # a no-op once the stream was read to the end; otherwise dropping the connection stops generation upstream
+          await response.close()
+        upstream_end = time.perf_counter()
+        trace.record("upstream", upstream_end - upstream_start)
+        llm_scheduler.report_success()
+        if first_token_at is not None and upstream_end > first_token_at:
+          completion_tokens = usage.completion_tokens if usage is not None else len(chunks)
+          TOKENS_PER_SECOND.observe(completion_tokens / (upstream_end - first_token_at))
+      # only complete answers are worth replaying
+      if cache_key is not None and finish_reason == "stop":
+        response_cache.put(cache_key, params["model"], "".join(chunks))
+    except openai.RateLimitError as e:
+      UPSTREAM_ERRORS.inc("RateLimitError")
+      llm_scheduler.report_rate_limited(retry_after_seconds(e))
+      logger.error("Error in chat: %s", e)
       raise RateLimitError(f"Rate limit exceeded")
-    except InternalServerError as e:
-      logger.error(f"Error in chat: {e}")
+    except openai.InternalServerError as e:
+      UPSTREAM_ERRORS.inc("InternalServerError")
+      logger.error("Error in chat: %s", e)
       raise InternalServerError(f"Internal server error")
-    except BadRequestError as e:
-      logger.error(f"Error in chat: {e}")
+    except openai.BadRequestError as e:
+      UPSTREAM_ERRORS.inc("BadRequestError")
+      logger.error("Error in chat: %s", e)
       raise BadRequestError(f"Bad request")
-    
-  def get_conversation_by_id(self, conversation_id: str) -> Optional[Conversation]:
-    return self.conversation_dao.get_conversation(conversation_id)
+
+
+  async def _open_stream(self, messages: List[Dict[str, str]], params: Dict[str, Any], estimated_tokens: int) -> Tuple[AsyncStream, List[ChatCompletionChunk], AsyncIterator[ChatCompletionChunk]]:
+    """Starts a completion stream and reads it up to its first token, hedging it if that's slow.
+
+    Returns the stream that got there first, the chunks read from it so far and the iterator of the rest.
+    The other request, if any, is cancelled.
+    """
+    model = params["model"]
+    start = time.perf_counter()
+    attempts = [asyncio.create_task(self._read_to_first_token(messages, params))]
+    winner: Optional[asyncio.Task] = None
+    try:
+      delay = model_router.hedge_delay(model)
+      if delay is not None:
+        await asyncio.wait(attempts, timeout=delay)
+        if not attempts[0].done() and model_router.take_hedge() and llm_scheduler.admit_hedge(estimated_tokens):
+          logger.debug("Hedging completion request", extra=log_fields(model=model, delay_ms=round(delay * 1000, 1)))
+          attempts.append(asyncio.create_task(self._read_to_first_token(messages, params)))
+      pending = set(attempts)
+      while pending and winner is None:
+        done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+        # the first request wins a tie
+        winner = next((attempt for attempt in attempts if attempt in done and attempt.exception() is None), None)
+      if winner is None:
+        # every request failed, report the first one's error
+        return attempts[0].result()
+      model_router.record_first_token(model, time.perf_counter() - start, hedge_won=winner is not attempts[0])
+      return winner.result()
+    finally:
+      for attempt in attempts:
+        if attempt is winner:
+          continue
+        if not attempt.done():
+          attempt.cancel()
+        elif not attempt.cancelled() and attempt.exception() is None:
+          # finished at the same time as the winner
+          await attempt.result()[0].close()
+
+  async def _read_to_first_token(self, messages: List[Dict[str, str]], params: Dict[str, Any]) -> Tuple[AsyncStream, List[ChatCompletionChunk], AsyncIterator[ChatCompletionChunk]]:
+    response = await self.openai_client.chat.completions.create(
+      messages=messages,
+      stream=True,
+      stream_options={"include_usage": True},
+      **params
+      )
+    rest = response.__aiter__()
+    first_chunks: List[ChatCompletionChunk] = []
+    try:
+      async for chunk in rest:
+        first_chunks.append(chunk)
+        if chunk.choices and chunk.choices[0].delta.content:
+          break
+    except BaseException:
+      await response.close()
+      raise
+    return response, first_chunks, rest
+
+  async def get_conversation_by_id(self, conversation_id: str) -> Optional[Conversation]:
+    async def load_conversation() -> Optional[Conversation]:
+      conversation = await self.conversation_dao.get_conversation(conversation_id)
+      if conversation is not None:
+        # include appends that are still waiting in the write-behind queue
+        stored_ids = {message.message_id for message in conversation.messages}
+        conversation.messages.extend(message for message in message_queue.pending_messages(conversation_id) if message.message_id not in stored_ids)
+      return conversation
+    return await conversation_cache.get_or_load(conversation_id, load_conversation)
   
-  def create_conversation(self, user_id: str) -> Conversation:
+  async def get_conversation_page(self, conversation_id: str, limit: int, before: Optional[int] = None) -> Optional[Tuple[List[ChatMessage], Optional[int]]]:
+    """Returns the newest limit messages (or the limit messages before index before) and the cursor for the page before them.
+
+    The cursor is None once the oldest message has been returned.
+    """
+    conversation = conversation_cache.peek(conversation_id)
+    if conversation is not None:
+      messages, total = conversation.messages, len(conversation.messages)
+      end = total if before is None else min(before, total)
+      start = max(end - limit, 0)
+      return messages[start:end], start or None
+    page = await self.conversation_dao.get_conversation_messages(conversation_id, limit, before)
+    if page is None:
+      return None
+    messages, total = page
+    end = total if before is None else min(before, total)
+    start = end - len(messages)
+    if before is None:
+      # include appends that are still waiting in the write-behind queue
+      stored_ids = {message.message_id for message in messages}
+      messages = messages + [message for message in message_queue.pending_messages(conversation_id) if message.message_id not in stored_ids]
+      if len(messages) > limit:
+        start += len(messages) - limit
+        messages = messages[-limit:]
+    return messages, start or None
+
+  def schedule_history_prefetch(self, conversation_id: str) -> None:
+    """Loads the conversation into the cache in the background, so the first chat turn doesn't wait on the database."""
+    if not settings.CONNECT_PREFETCH_HISTORY or conversation_cache.peek(conversation_id) is not None:
+      return
+    task = asyncio.create_task(self.prefetch_conversation(conversation_id))
+    _prefetch_tasks.add(task)
+    task.add_done_callback(_prefetch_tasks.discard)
+
+  async def prefetch_conversation(self, conversation_id: str) -> None:
+    # not cancelled when the client leaves: a turn of another connection may be waiting on the same load
+    try:
+      await self.get_conversation_by_id(conversation_id)
+    except DatabaseError as e:
+      # the first turn loads it again and reports the error
+      logger.warning("History prefetch of conversation %s failed: %s", conversation_id, e)
+
+  async def create_conversation(self, user_id: str, verify_user: bool = True) -> Conversation:
+    """Creates an empty conversation. Pass verify_user=False when the user is known to exist, to save a round-trip."""
     conversation = Conversation(user_id=user_id)
-    user = self.user_dao.get_user(user_id)
-    if not user:
-      raise UserNotFoundError(f"User {user_id} not found")
-    conversation_id = self.conversation_dao.create_conversation(conversation)
+    if verify_user:
+      user = await self.user_dao.get_user(user_id)
+      if not user:
+        raise UserNotFoundError(f"User {user_id} not found")
+    conversation_id = await self.conversation_dao.create_conversation(conversation)
     conversation.conversation_id = conversation_id
-    self.user_cache[user_id] = [conversation]
+    conversation_cache.set(conversation_id, conversation)
+    user_conversations_cache.invalidate(user_id)
     return conversation
   
-  def get_conversations_by_user(self, user_id: str, skip: int = 0, limit: int = 10) -> List[Conversation]:
-    if user_id not in self.user_cache:
-      logger.info(f"User {user_id} not found in cache, getting from database...")
-      conversations = self.conversation_dao.get_conversations_by_user_id(user_id, skip, limit)
-      if conversations is None or len(conversations) == 0:
-        raise UserNotFoundError(f"No conversations for user {user_id} found in cache or database")
-      self.user_cache[user_id] = conversations
-      return conversations
-    else:
-      return self.user_cache[user_id]
-
-  def get_recent_conversation_by_user(self, user_id: str) -> Conversation:
-    if self.user_cache.get(user_id,-1) == -1:
-      logger.info(f"User {user_id} not found in cache, getting from database...")
-      conversations: List[Conversation] = self.conversation_dao.get_conversations_by_user_id(user_id)
-      if conversations is None or len(conversations) == 0:
-        raise UserNotFoundError(f"No conversations for user {user_id} found in cache or database")
-      return conversations[0]
-    else:
-      if len(self.user_cache.get(user_id,[])) == 0:
-        return self.user_cache[user_id][0]
-      logger.info(f"No conversations for user {user_id} found in cache or database")
+  async def get_conversations_by_user(self, user_id: str, limit: int = USER_CONVERSATIONS_PAGE_SIZE, before_updated_at: Optional[datetime] = None, before_id: Optional[str] = None) -> List[Conversation]:
+    """Lists the user's conversations, most recently updated first. Each holds only its first message."""
+    if before_updated_at is not None or limit != USER_CONVERSATIONS_PAGE_SIZE:
+      # only the first page is cached
+      return await self.conversation_dao.get_conversations_by_user_id(user_id, limit, before_updated_at, before_id)
+    async def load_conversations() -> List[Conversation]:
+      logger.debug("Conversations of user %s not cached, getting from database", user_id)
+      return await self.conversation_dao.get_conversations_by_user_id(user_id, limit)
+    return await user_conversations_cache.get_or_load(user_id, load_conversations)
+
+  async def search_conversations(self, user_id: str, query: str, limit: int = settings.SEARCH_RESULTS_LIMIT) -> List[SearchResult]:
+    """Finds the user's conversations whose messages best match the query, best first."""
+    return await search_indexes.search(self.conversation_dao, user_id, query, limit)
+
+  async def get_recent_conversation_by_user(self, user_id: str) -> Optional[Conversation]:
+    conversations = await self.get_conversations_by_user(user_id)
+    if len(conversations) == 0:
+      logger.info("No conversations for user %s found in cache or database", user_id)
       return None
+    return conversations[0]
 
-  def add_message_to_conversation(self, conversation_id: str, message: ChatMessage) -> bool:
+  async def add_message_to_conversation(self, conversation_id: str, message: ChatMessage) -> bool:
+    return await self.add_messages_to_conversation(conversation_id, [message])
+
+  async def add_messages_to_conversation(self, conversation_id: str, messages: List[ChatMessage]) -> bool:
     user_id = conversation_id.split("-")[0]
-    # check if user that started this conversation is in the cache
-    if user_id not in self.user_cache:
-      # if not in cache, get from database
-      logger.info(f"User {user_id} not found in cache, getting from database...")
-      user = self.user_dao.get_user(user_id)
-      if user is None:
-        raise UserNotFoundError(f"User {user_id} not found for conversation {conversation_id}")
+    for message in messages:
+      # stored with the message so it's never tokenized again
+      message_tokens(message)
+    search_indexes.add_messages(conversation_id, messages)
+    # write through so the next turn sees the messages without a database round-trip
+    conversation = conversation_cache.peek(conversation_id)
+    if conversation is not None:
+      if settings.CONTEXT_RELEVANCE_ENABLED:
+        history_relevance.add_messages(conversation_id, len(conversation.messages), messages)
+      was_empty = len(conversation.messages) == 0
+      conversation.messages.extend(messages)
+      conversation_cache.set(conversation_id, conversation)
     else:
-      # if the user is in the cache, check if the conversation is in the cache
-      conversations = self.user_cache[user_id]
-      for user_convo in conversations:
-        if user_convo.conversation_id == conversation_id:
-          logger.info(f"Conversation {conversation_id} found in cache, adding message...")
-          user_convo.messages.append(message)
-          conversation = user_convo
-      logger.info(f"Conversation {conversation_id} not found in cache, getting from database...")
-      if conversation is None:
-        # conversation not in cache, get from database
-        conversation = self.conversation_dao.get_conversation(conversation_id)
-        if conversation is None:
-          raise ConversationNotFoundError(f"Conversation {conversation_id} not found")
-      self.user_cache[user_id] = [conversation]
-      conversation.messages.append(message)
-      return self.conversation_dao.add_message_to_conversation(conversation_id, message)
+      was_empty = False
+    # the listing is most recently updated first and shows each first message; it only stays right if
+    # this conversation already leads it with its first message
+    listing = user_conversations_cache.peek(user_id)
+    if listing is not None:
+      if not was_empty and listing and listing[0].conversation_id == conversation_id and listing[0].messages:
+        listing[0].updated_at = datetime.now(timezone.utc)
+      else:
+        user_conversations_cache.invalidate(user_id)
+    if message_queue.running:
+      await message_queue.enqueue(conversation_id, messages)
+      return True
+    # no background writer (e.g. outside the app lifespan), write straight through
+    try:
+      added = await self.conversation_dao.add_messages_to_conversations({conversation_id: messages})
+    except DatabaseError:
+      # the write may or may not have landed, reload on next read
+      conversation_cache.invalidate(conversation_id)
+      raise
+    if not added:
+      conversation_cache.invalidate(conversation_id)
+      raise ConversationNotFoundError(f"Conversation {conversation_id} not found")
+    return True
 
+  def schedule_summary_update(self, conversation: Conversation) -> None:
+    if not settings.CONTEXT_SUMMARY_ENABLED or conversation.conversation_id in _summarizing:
+      return
+    _summarizing.add(conversation.conversation_id)
+    task = asyncio.create_task(self.update_summary(conversation))
+    _summary_tasks.add(task)
+    task.add_done_callback(_summary_tasks.discard)
+    task.add_done_callback(lambda _: _summarizing.discard(conversation.conversation_id))
+
+  async def update_summary(self, conversation: Conversation) -> None:
+    """Folds the messages that no longer fit in the context budget into the conversation's summary."""
+    summarized = conversation.summary_message_count
+    history = conversation.messages[summarized:]
+    history_budget = settings.CONTEXT_TOKEN_BUDGET - settings.CONTEXT_SUMMARY_MAX_TOKENS - count_tokens(SYSTEM_PROMPT)
+    fold_count = history_window_start(history, max(history_budget, 0))
+    if fold_count < settings.CONTEXT_SUMMARY_MIN_MESSAGES:
+      return
+    transcript = "\n".join(f"{message.role}: {message.content[:2000]}" for message in history[:fold_count])
+    prompt = f"Previous summary:\n{conversation.summary or '(none)'}\n\nNew messages:\n{transcript}"
+    instructions = "Update the summary of a conversation between a user and a chat assistant with the new messages. Keep facts, decisions, names and code identifiers the assistant may need later. Respond with the summary only."
+    estimated_tokens = count_tokens(instructions) + count_tokens(prompt) + settings.CONTEXT_SUMMARY_MAX_TOKENS
+    try:
+      async with llm_scheduler.slot(SUMMARY_SCHEDULER_USER, estimated_tokens):
+        response = await self.openai_client.chat.completions.create(
+          model=settings.CONTEXT_SUMMARY_MODEL,
+          messages=[
+            {"role": "system", "content": instructions},
+            {"role": "user", "content": prompt},
+          ],
+          temperature=0,
+          max_tokens=settings.CONTEXT_SUMMARY_MAX_TOKENS,
+        )
+        if response.usage is not None:
+          llm_scheduler.record_usage(estimated_tokens, response.usage.total_tokens)
+        llm_scheduler.report_success()
+      summary = response.choices[0].message.content
+      if not summary:
+        return
+      conversation.summary = summary
+      conversation.summary_message_count = summarized + fold_count
+      await self.conversation_dao.update_conversation_summary(conversation.conversation_id, summary, conversation.summary_message_count)
+      logger.info("Summarized %s messages of conversation %s", fold_count, conversation.conversation_id)
+    except SchedulerBusyError as e:
+      # the messages stay unsummarized, a later turn tries again
+      logger.info("Skipped summary of conversation %s: %s", conversation.conversation_id, e)
+    except openai.RateLimitError as e:
+      UPSTREAM_ERRORS.inc("RateLimitError")
+      llm_scheduler.report_rate_limited(retry_after_seconds(e))
+      logger.error("Failed to update summary of conversation %s: %s", conversation.conversation_id, e)
+    except (OpenAIError, DatabaseError) as e:
+      logger.error("Failed to update summary of conversation %s: %s", conversation.conversation_id, e)
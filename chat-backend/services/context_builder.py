@@ -0,0 +1,86 @@
+import logging
+from typing import Dict, List, Optional, Tuple
+
+from models.models import ChatMessage
+
+logger = logging.getLogger(__name__)
+
+try:
+  import tiktoken
+  _encoding = tiktoken.get_encoding("o200k_base")
+except Exception:
+  # tiktoken is optional (and needs to download its encodings once); fall back to an estimate
+  _encoding = None
+
+# chat completions add a few tokens of framing to every message
+TOKENS_PER_MESSAGE = 4
+
+SYSTEM_PROMPT = "You are a helpful chat assistant that only responds in markdown. Format the response as markdown. This means coding blocks should be formatted with ``````. Make sure to use the correct syntax for the language, closing all tags. You must respond in proper markdown. The user does not need to know that you are responding in markdown, they only need to read the formatted response. Do not tell them the format is markdown or the answer is formatted in any way. Use the previous conversation history to answer the user's question, as this is a follow up to the conversation."
+
+
+def count_tokens(text: str) -> int:
+  if _encoding is not None:
+    return len(_encoding.encode(text, disallowed_special=()))
+  # roughly four characters per token for english text
+  return (len(text) + 3) // 4
+
+
+def message_tokens(message: ChatMessage) -> int:
+  """Returns the token count of a message, counting it only the first time."""
+  if message.token_count is None:
+    message.token_count = count_tokens(message.content) + TOKENS_PER_MESSAGE
+  return message.token_count
+
+
+def history_window_start(history: List[ChatMessage], budget: int) -> int:
+  """Returns the index of the oldest message in history such that the rest fits in budget tokens."""
+  used = 0
+  start = len(history)
+  while start > 0:
+    cost = message_tokens(history[start - 1])
+    if used + cost > budget:
+      break
+    used += cost
+    start -= 1
+  return start
+
+
+def _summary_content(summary: Optional[str]) -> Optional[str]:
+  return f"Summary of the earlier conversation: {summary}" if summary else None
+
+
+def _fixed_tokens(message: str, summary_content: Optional[str]) -> int:
+  # the system prompt, the summary and the new message go into every prompt
+  fixed_tokens = count_tokens(SYSTEM_PROMPT) + count_tokens(message) + 2 * TOKENS_PER_MESSAGE
+  if summary_content:
+    fixed_tokens += count_tokens(summary_content) + TOKENS_PER_MESSAGE
+  return fixed_tokens
+
+
+def history_token_budget(message: str, token_budget: int, summary: Optional[str] = None) -> int:
+  """Returns the tokens of token_budget left for history."""
+  return max(token_budget - _fixed_tokens(message, _summary_content(summary)), 0)
+
+
+def build_messages(message: str, history: List[ChatMessage], token_budget: int, summary: Optional[str] = None) -> Tuple[List[Dict[str, str]], int]:
+  """Builds the chat completion messages, keeping as much recent history as fits in token_budget.
+
+  history should only hold the messages not already covered by summary. Returns the messages and
+  the number of prompt tokens they use.
+  """
+  summary_content = _summary_content(summary)
+  fixed_tokens = _fixed_tokens(message, summary_content)
+  start = history_window_start(history, max(token_budget - fixed_tokens, 0))
+  prompt_tokens = fixed_tokens + sum(message_tokens(past_message) for past_message in history[start:])
+
+  messages = []
+  if summary_content:
+    messages.append({"role": "system", "content": summary_content})
+  for past_message in history[start:]:
+    if past_message.role == "bot":
+      messages.append({"role": "system", "content": past_message.content})
+    else:
+      messages.append({"role": "user", "content": past_message.content})
+  messages.append({"role": "system", "content": SYSTEM_PROMPT})
+  messages.append({"role": "user", "content": message})
+  return messages, prompt_tokens
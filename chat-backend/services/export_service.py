@@ -0,0 +1,86 @@
+import asyncio
+import json
+import logging
+import zlib
+from datetime import datetime
+from typing import Annotated, Any, AsyncIterator, Callable, Dict, List, Optional
+from fastapi import Depends
+
+from config import settings
+from daos.conversation_dao import ConversationDAO
+from daos.conversation_store import get_conversation_dao
+from daos.user_dao import UserDAO
+from models.models import StoredMessage
+
+logger = logging.getLogger(__name__)
+
+# fields that can be asked for, besides _id which is always included
+CONVERSATION_FIELDS = ("user_id", "updated_at", "summary", "summary_message_count", "messages")
+USER_FIELDS = ("conversations",)
+
+
+def _json_default(value: Any) -> Any:
+  if isinstance(value, datetime):
+    return value.isoformat()
+  raise TypeError(f"Cannot export {type(value).__name__}")
+
+
+def conversation_record(document: Dict[str, Any]) -> Dict[str, Any]:
+  if "messages" not in document:
+    return document
+  record = dict(document)
+  # stored messages may be compressed, export their text
+  record["messages"] = [StoredMessage.from_document(data).to_dict() for data in document["messages"] or []]
+  return record
+
+
+class NDJSONEncoder:
+  """Turns batches of documents into newline delimited JSON, optionally as one gzip stream.
+
+  The gzip stream is flushed after every batch, so a client that is cut off can still decompress
+  every complete batch it received.
+  """
+
+  def __init__(self, to_record: Callable[[Dict[str, Any]], Dict[str, Any]], gzip: bool):
+    self.to_record = to_record
+    self._compressor = zlib.compressobj(settings.EXPORT_GZIP_LEVEL, zlib.DEFLATED, 31) if gzip else None
+
+  def encode(self, batch: List[Dict[str, Any]]) -> bytes:
+    data = "".join(json.dumps(self.to_record(document), default=_json_default, ensure_ascii=False) + "\n" for document in batch).encode()
+    if self._compressor is None:
+      return data
+    return self._compressor.compress(data) + self._compressor.flush(zlib.Z_SYNC_FLUSH)
+
+  def finish(self) -> bytes:
+    return self._compressor.flush() if self._compressor is not None else b""
+
+
+class ExportService:
+  def __init__(self, conversation_dao: Annotated[ConversationDAO, Depends(get_conversation_dao)], user_dao: Annotated[UserDAO, Depends(UserDAO)]):
+    self.conversation_dao = conversation_dao
+    self.user_dao = user_dao
+
+  def export_conversations(self, after_id: Optional[str], batch_size: int, fields: Optional[List[str]], gzip: bool) -> AsyncIterator[bytes]:
+    batches = self.conversation_dao.iter_conversations(after_id, batch_size, fields)
+    return self._stream("conversations", batches, NDJSONEncoder(conversation_record, gzip))
+
+  def export_users(self, after_id: Optional[str], batch_size: int, fields: Optional[List[str]], gzip: bool) -> AsyncIterator[bytes]:
+    batches = self.user_dao.iter_users(after_id, batch_size, fields)
+    return self._stream("users", batches, NDJSONEncoder(lambda document: document, gzip))
+
+  async def _stream(self, kind: str, batches: AsyncIterator[List[Dict[str, Any]]], encoder: NDJSONEncoder) -> AsyncIterator[bytes]:
+    """Yields one chunk per batch; only one batch is held at a time, and the next is read once the client took this one."""
+    exported = 0
+    last_id = None
+    try:
+      async for batch in batches:
+        # encoding a batch of long conversations takes a while, keep it off the event loop
+        yield await asyncio.to_thread(encoder.encode, batch)
+        exported += len(batch)
+        last_id = batch[-1]["_id"]
+      yield encoder.finish()
+      logger.info(f"Exported {exported} {kind}")
+    except Exception:
+      # the response is cut short; the client resumes after the last _id it received
+      logger.exception(f"Export of {kind} failed after {exported}, last _id {last_id}")
+      raise
@@ -0,0 +1,183 @@
+import asyncio
+import logging
+import math
+import zlib
+from collections import Counter
+from typing import Dict, List, Optional, Sequence, Set, Union
+
+from config import settings
+from models.models import ChatMessage, StoredMessage
+from services.cache import LRUTTLCache
+from services.context_builder import history_window_start, message_tokens
+from services.search_index import tokenize
+
+logger = logging.getLogger(__name__)
+
+try:
+  import numpy
+except ImportError:
+  # numpy is in requirements.txt; should it be missing, vectors are kept sparse and compared one by one
+  numpy = None
+
+Message = Union[ChatMessage, StoredMessage]
+
+
+def embed(text: str, dimensions: int) -> Dict[int, float]:
+  """Hashes the words and word pairs of text into a sparse unit vector of the given (power of two) dimensions.
+
+  Deterministic across processes and needs no model: crc32 of each feature picks its dimension and sign.
+  """
+  tokens = tokenize(text)
+  features = Counter(tokens)
+  features.update(f"{first} {second}" for first, second in zip(tokens, tokens[1:]))
+  vector: Dict[int, float] = {}
+  for feature, count in features.items():
+    feature_hash = zlib.crc32(feature.encode())
+    dimension = feature_hash & (dimensions - 1)
+    # the sign keeps colliding features from only ever adding up
+    weight = (1 + math.log(count)) * (1 if feature_hash & 0x80000000 else -1)
+    vector[dimension] = vector.get(dimension, 0.0) + weight
+  norm = math.sqrt(sum(weight * weight for weight in vector.values()))
+  return {dimension: weight / norm for dimension, weight in vector.items()} if norm else {}
+
+
+class ConversationVectors:
+  """Hashed vectors of a conversation's messages, one row per message, compared to a prompt all at once.
+
+  Rows are keyed by the position of their message in the conversation: message ids aren't unique, messages
+  stored before ids were generated per message share the id of every message of their process. With numpy
+  the rows are a float32 matrix grown by doubling, and similarity is one matrix-vector product.
+  """
+  __slots__ = ("dimensions", "rows", "_row_message_ids", "_matrix", "_sparse")
+
+  def __init__(self, dimensions: int):
+    self.dimensions = dimensions
+    # position in the conversation -> row
+    self.rows: Dict[int, int] = {}
+    # to notice a position now holding another message, after one was removed
+    self._row_message_ids: List[Optional[str]] = []
+    self._matrix = numpy.zeros((16, dimensions), dtype=numpy.float32) if numpy is not None else None
+    self._sparse: List[Dict[int, float]] = []
+
+  def __len__(self) -> int:
+    return len(self._row_message_ids)
+
+  def add(self, position: int, message: Message) -> None:
+    row = self.rows.get(position)
+    if row is not None and self._row_message_ids[row] == message.message_id:
+      return
+    vector = embed(message.content, self.dimensions)
+    if row is None:
+      row = self.rows[position] = len(self._row_message_ids)
+      self._row_message_ids.append(message.message_id)
+      if self._matrix is None:
+        self._sparse.append(vector)
+      elif row == len(self._matrix):
+        self._matrix = numpy.concatenate([self._matrix, numpy.zeros_like(self._matrix)])
+    else:
+      self._row_message_ids[row] = message.message_id
+      if self._matrix is None:
+        self._sparse[row] = vector
+      else:
+        self._matrix[row] = 0
+    if self._matrix is not None and vector:
+      self._matrix[row, list(vector)] = list(vector.values())
+
+  def similarities(self, text: str, positions: Sequence[int]) -> List[float]:
+    """Returns the cosine similarity of text to the messages at each of the positions, which must have been added."""
+    query = embed(text, self.dimensions)
+    rows = [self.rows[position] for position in positions]
+    if not query or not rows:
+      return [0.0] * len(rows)
+    if self._matrix is None:
+      return [sum(weight * self._sparse[row].get(dimension, 0.0) for dimension, weight in query.items()) for row in rows]
+    query_vector = numpy.zeros(self.dimensions, dtype=numpy.float32)
+    query_vector[list(query)] = list(query.values())
+    return (self._matrix[:len(self)] @ query_vector)[rows].tolist()
+
+
+class HistoryRelevance:
+  """Picks the past turns of a conversation most similar to the new message, to send along with the recent tail."""
+
+  def __init__(self, dimensions: int, recent_messages: int, top_turns: int, min_similarity: float, max_conversations: int, max_vectors: int):
+    if dimensions & (dimensions - 1):
+      raise ValueError(f"Vector dimensions must be a power of two, got {dimensions}")
+    self.dimensions = dimensions
+    self.recent_messages = recent_messages
+    self.top_turns = top_turns
+    self.min_similarity = min_similarity
+    # conversation_id -> ConversationVectors, weighed by number of rows
+    self._vectors: LRUTTLCache = LRUTTLCache(
+      "conversation_vectors",
+      max_entries=max_conversations,
+      max_weight=max_vectors,
+      ttl_seconds=settings.CACHE_TTL_S,
+      weigher=lambda vectors: len(vectors) + 1,
+    )
+
+  def add_messages(self, conversation_id: str, start: int, messages: List[Message]) -> None:
+    """Embeds new messages, the first at position start, of a conversation whose vectors are loaded; others are embedded on their next prompt."""
+    vectors = self._vectors.peek(conversation_id)
+    if vectors is not None:
+      for position, message in enumerate(messages, start):
+        vectors.add(position, message)
+
+  async def select(self, conversation_id: str, message: str, history: List[Message], budget: int, history_start: int = 0) -> List[Message]:
+    """Returns the recent tail of history plus the earlier turns most similar to message, in order, within budget tokens.
+
+    history_start is the position of the first message of history in the conversation.
+    """
+    window_start = history_window_start(history, budget)
+    if window_start == 0:
+      # everything fits, nothing to choose from
+      return history
+    tail_start = max(len(history) - self.recent_messages, window_start)
+    used = sum(message_tokens(past_message) for past_message in history[tail_start:])
+    earlier = history[:tail_start]
+    vectors = self._vectors.get(conversation_id)
+    if vectors is None:
+      # embedding a long conversation takes a while, keep it off the event loop
+      vectors = await asyncio.to_thread(self._embed_all, history_start, earlier)
+    for position, past_message in enumerate(earlier, history_start):
+      vectors.add(position, past_message)
+    # set again so the weight follows the rows added
+    self._vectors.set(conversation_id, vectors)
+    similarities = vectors.similarities(message, range(history_start, history_start + tail_start))
+
+    chosen: Set[int] = set()
+    turns = 0
+    for index in sorted(range(tail_start), key=similarities.__getitem__, reverse=True):
+      if turns == self.top_turns or similarities[index] < self.min_similarity:
+        break
+      # a question comes with its answer and an answer with its question
+      partner = index - 1 if earlier[index].role == "bot" else index + 1
+      turn = {index, partner} if 0 <= partner < tail_start and earlier[partner].role != earlier[index].role else {index}
+      turn -= chosen
+      if not turn:
+        continue
+      cost = sum(message_tokens(earlier[turn_index]) for turn_index in turn)
+      if used + cost > budget:
+        continue
+      chosen |= turn
+      used += cost
+      turns += 1
+    return [earlier[index] for index in sorted(chosen)] + history[tail_start:]
+
+  def _embed_all(self, start: int, messages: List[Message]) -> ConversationVectors:
+    vectors = ConversationVectors(self.dimensions)
+    for position, message in enumerate(messages, start):
+      vectors.add(position, message)
+    return vectors
+
+  def stats(self) -> Dict[str, object]:
+    return {**self._vectors.stats(), "numpy": numpy is not None}
+
+
+history_relevance = HistoryRelevance(
+  dimensions=settings.CONTEXT_RELEVANCE_DIMENSIONS,
+  recent_messages=settings.CONTEXT_RELEVANCE_RECENT_MESSAGES,
+  top_turns=settings.CONTEXT_RELEVANCE_TOP_TURNS,
+  min_similarity=settings.CONTEXT_RELEVANCE_MIN_SIMILARITY,
+  max_conversations=settings.CONTEXT_RELEVANCE_MAX_CONVERSATIONS,
+  max_vectors=settings.CONTEXT_RELEVANCE_MAX_VECTORS,
+)
@@ -0,0 +1,243 @@
+import asyncio
+import logging
+import time
+from collections import OrderedDict, deque
+from contextlib import asynccontextmanager
+from typing import Any, AsyncIterator, Deque, Dict, Optional
+
+from config import settings
+from exceptions.custom_exceptions import SchedulerBusyError
+
+logger = logging.getLogger(__name__)
+
+
+class TokenBucket:
+  """Refills capacity units per minute, continuously. The level may go negative to record debt."""
+
+  def __init__(self, per_minute: int):
+    self.capacity = float(per_minute)
+    self.refill_per_second = per_minute / 60
+    self.level = self.capacity
+    self._updated_at = time.monotonic()
+
+  def _refill(self) -> None:
+    now = time.monotonic()
+    self.level = min(self.capacity, self.level + (now - self._updated_at) * self.refill_per_second)
+    self._updated_at = now
+
+  def time_until(self, amount: float) -> float:
+    """Seconds until amount can be consumed; requests larger than the bucket only need it full."""
+    self._refill()
+    missing = min(amount, self.capacity) - self.level
+    return max(missing / self.refill_per_second, 0.0)
+
+  def consume(self, amount: float) -> None:
+    self._refill()
+    self.level -= amount
+
+  def refund(self, amount: float) -> None:
+    self._refill()
+    self.level = min(self.capacity, self.level + amount)
+
+
+class _Waiter:
+  __slots__ = ("user_id", "tokens", "future")
+
+  def __init__(self, user_id: str, tokens: int, future: asyncio.Future):
+    self.user_id = user_id
+    self.tokens = tokens
+    self.future = future
+
+
+class LLMScheduler:
+  """Admission control in front of the OpenAI client.
+
+  Requests wait in per-user queues that are served round robin, so one user can't starve the others.
+  A request is admitted when the concurrency limit, the user's own limit and the requests-per-minute
+  and tokens-per-minute buckets all allow it. Rate limit errors from upstream halve the concurrency
+  limit and pause admissions; successes grow it back one at a time.
+  """
+
+  def __init__(self, max_concurrency: int, max_concurrency_per_user: int, max_queue: int, max_queue_per_user: int, queue_timeout: float,
+               requests_per_minute: int, tokens_per_minute: int, backoff_base: float, backoff_max: float):
+    self.max_concurrency = max_concurrency
+    self.max_concurrency_per_user = max_concurrency_per_user
+    self.max_queue = max_queue
+    self.max_queue_per_user = max_queue_per_user
+    self.queue_timeout = queue_timeout
+    self.backoff_base = backoff_base
+    self.backoff_max = backoff_max
+    self.request_bucket = TokenBucket(requests_per_minute)
+    self.token_bucket = TokenBucket(tokens_per_minute)
+    # adaptive limit, between 1 and max_concurrency
+    self.concurrency_limit = max_concurrency
+    self.active = 0
+    self._active_by_user: Dict[str, int] = {}
+    # user_id -> waiting requests; users are served in order and moved to the back after each admission
+    self._queues: "OrderedDict[str, Deque[_Waiter]]" = OrderedDict()
+    self._queued = 0
+    self._paused_until = 0.0
+    self._backoff = 0.0
+    self._timer: Optional[asyncio.TimerHandle] = None
+    self.admitted = 0
+    self.shed = 0
+    self.timed_out = 0
+    self.rate_limited = 0
+
+  @asynccontextmanager
+  async def slot(self, user_id: Optional[str], estimated_tokens: int) -> AsyncIterator[None]:
+    """Holds an upstream slot for the duration of the block, raising SchedulerBusyError if none can be had."""
+    user_id = user_id or "anonymous"
+    await self._acquire(user_id, estimated_tokens)
+    try:
+      yield
+    finally:
+      self._release(user_id)
+
+  def admit_hedge(self, estimated_tokens: int) -> bool:
+    """Charges a hedge of an admitted request to the rate limits if they allow it right now.
+
+    Hedges never queue, and share the slot of the request they duplicate rather than taking one.
+    """
+    if time.monotonic() < self._paused_until:
+      return False
+    if self.request_bucket.time_until(1) > 0 or self.token_bucket.time_until(estimated_tokens) > 0:
+      return False
+    self.request_bucket.consume(1)
+    self.token_bucket.consume(estimated_tokens)
+    return True
+
+  def record_usage(self, estimated_tokens: int, actual_tokens: int) -> None:
+    """Corrects the tokens-per-minute bucket once the real usage of a request is known."""
+    if actual_tokens > estimated_tokens:
+      self.token_bucket.consume(actual_tokens - estimated_tokens)
+    else:
+      self.token_bucket.refund(estimated_tokens - actual_tokens)
+
+  def report_success(self) -> None:
+    self._backoff = 0.0
+    if self.concurrency_limit < self.max_concurrency:
+      self.concurrency_limit += 1
+      self._dispatch()
+
+  def report_rate_limited(self, retry_after: Optional[float] = None) -> None:
+    self.rate_limited += 1
+    self.concurrency_limit = max(1, self.concurrency_limit // 2)
+    self._backoff = min(self.backoff_max, self._backoff * 2 if self._backoff else self.backoff_base)
+    pause = retry_after if retry_after is not None else self._backoff
+    self._paused_until = max(self._paused_until, time.monotonic() + pause)
+    logger.warning(f"Upstream rate limited, concurrency limit now {self.concurrency_limit}, pausing admissions for {pause:.1f}s")
+
+  def stats(self) -> Dict[str, Any]:
+    return {
+      "active": self.active,
+      "queued": self._queued,
+      "concurrency_limit": self.concurrency_limit,
+      "max_concurrency": self.max_concurrency,
+      "admitted": self.admitted,
+      "shed": self.shed,
+      "timed_out": self.timed_out,
+      "rate_limited": self.rate_limited,
+      "request_bucket": round(self.request_bucket.level, 1),
+      "token_bucket": round(self.token_bucket.level, 1),
+    }
+
+  async def _acquire(self, user_id: str, tokens: int) -> None:
+    user_queue = self._queues.get(user_id)
+    if self._queued >= self.max_queue or (user_queue is not None and len(user_queue) >= self.max_queue_per_user):
+      self.shed += 1
+      raise SchedulerBusyError("Too many requests waiting for the language model")
+    waiter = _Waiter(user_id, tokens, asyncio.get_running_loop().create_future())
+    if user_queue is None:
+      user_queue = self._queues[user_id] = deque()
+    user_queue.append(waiter)
+    self._queued += 1
+    self._dispatch()
+    try:
+      await asyncio.wait_for(asyncio.shield(waiter.future), timeout=self.queue_timeout)
+    except asyncio.TimeoutError:
+      if not self._withdraw(waiter):
+        # admitted just as the wait timed out, take it
+        return
+      self.timed_out += 1
+      raise SchedulerBusyError("Timed out waiting for the language model")
+    except asyncio.CancelledError:
+      if not self._withdraw(waiter):
+        self._release(user_id)
+      raise
+
+  def _withdraw(self, waiter: _Waiter) -> bool:
+    """Removes a waiter that is still queued. Returns False if it was already admitted."""
+    if waiter.future.done():
+      return False
+    waiter.future.cancel()
+    user_queue = self._queues.get(waiter.user_id)
+    if user_queue is not None and waiter in user_queue:
+      user_queue.remove(waiter)
+      self._queued -= 1
+      if not user_queue:
+        del self._queues[waiter.user_id]
+    return True
+
+  def _release(self, user_id: str) -> None:
+    self.active -= 1
+    remaining = self._active_by_user.get(user_id, 1) - 1
+    if remaining:
+      self._active_by_user[user_id] = remaining
+    else:
+      self._active_by_user.pop(user_id, None)
+    self._dispatch()
+
+  def _dispatch(self) -> None:
+    if self._timer is not None:
+      self._timer.cancel()
+      self._timer = None
+    wait = self._paused_until - time.monotonic()
+    if wait > 0:
+      self._schedule(wait)
+      return
+    # one pass over the waiting users per admission, skipping those at their own limit
+    while self._queues and self.active < self.concurrency_limit:
+      admitted = False
+      for user_id in list(self._queues):
+        if self._active_by_user.get(user_id, 0) >= self.max_concurrency_per_user:
+          continue
+        user_queue = self._queues[user_id]
+        waiter = user_queue[0]
+        wait = max(self.request_bucket.time_until(1), self.token_bucket.time_until(waiter.tokens))
+        if wait > 0:
+          # pacing applies to everyone, try again once the buckets have refilled
+          self._schedule(wait)
+          return
+        user_queue.popleft()
+        self._queued -= 1
+        if user_queue:
+          self._queues.move_to_end(user_id)
+        else:
+          del self._queues[user_id]
+        self.request_bucket.consume(1)
+        self.token_bucket.consume(waiter.tokens)
+        self.active += 1
+        self._active_by_user[user_id] = self._active_by_user.get(user_id, 0) + 1
+        self.admitted += 1
+        waiter.future.set_result(None)
+        admitted = True
+        break
+      if not admitted:
+        return
+
+  def _schedule(self, delay: float) -> None:
+    self._timer = asyncio.get_running_loop().call_later(delay, self._dispatch)
+
+
+llm_scheduler = LLMScheduler(
+  max_concurrency=settings.LLM_MAX_CONCURRENCY,
+  max_concurrency_per_user=settings.LLM_MAX_CONCURRENCY_PER_USER,
+  max_queue=settings.LLM_MAX_QUEUE,
+  max_queue_per_user=settings.LLM_MAX_QUEUE_PER_USER,
+  queue_timeout=settings.LLM_QUEUE_TIMEOUT_S,
+  requests_per_minute=settings.LLM_REQUESTS_PER_MINUTE,
+  tokens_per_minute=settings.LLM_TOKENS_PER_MINUTE,
+  backoff_base=settings.LLM_BACKOFF_BASE_S,
+  backoff_max=settings.LLM_BACKOFF_MAX_S,
+)
@@ -0,0 +1,126 @@
+import math
+from collections import deque
+from typing import Any, Deque, Dict, List, Optional
+
+from config import settings
+
+# most hedges that can be saved up while latency is good, so a burst of slow requests can all be hedged
+HEDGE_BUDGET_BURST = 10.0
+
+
+class ModelTier:
+  """A model for prompts whose new message and history are both within the tier's limits."""
+  __slots__ = ("model", "max_message_tokens", "max_history_messages")
+
+  def __init__(self, model: str, max_message_tokens: int, max_history_messages: int):
+    self.model = model
+    self.max_message_tokens = max_message_tokens
+    self.max_history_messages = max_history_messages
+
+  def fits(self, message_tokens: int, history_messages: int) -> bool:
+    return message_tokens <= self.max_message_tokens and history_messages <= self.max_history_messages
+
+
+def parse_tiers(spec: str) -> List[ModelTier]:
+  """Parses comma separated "model:max_message_tokens:max_history_messages" tiers, e.g. "gpt-4o-mini:200:4"."""
+  tiers = []
+  for tier in spec.split(","):
+    if not tier.strip():
+      continue
+    try:
+      model, max_message_tokens, max_history_messages = tier.strip().rsplit(":", 2)
+      tiers.append(ModelTier(model, int(max_message_tokens), int(max_history_messages)))
+    except ValueError:
+      raise ValueError(f"Invalid model tier {tier!r}, expected model:max_message_tokens:max_history_messages")
+  return tiers
+
+
+class LatencyWindow:
+  """The times to first token of the last window requests to a model."""
+
+  def __init__(self, window: int):
+    self.samples: Deque[float] = deque(maxlen=window)
+
+  def percentile(self, fraction: float) -> float:
+    ordered = sorted(self.samples)
+    return ordered[min(len(ordered) - 1, math.ceil(fraction * len(ordered)) - 1)]
+
+
+class ModelRouter:
+  """Picks the model of each chat completion, and how long to wait for its first token before hedging.
+
+  Tiers are tried in order and the first that fits the prompt wins; prompts that fit none go to the default
+  model. A hedge is a second, identical request started when the first hasn't produced a token within the
+  model's recent latency percentile. Hedges are limited to max_ratio of requests, saved up as a budget, so a
+  slow upstream isn't sent twice the load.
+  """
+
+  def __init__(self, default_model: str, tiers: List[ModelTier], hedge_enabled: bool, hedge_percentile: float, initial_delay: float,
+               min_delay: float, min_samples: int, window: int, max_ratio: float):
+    self.default_model = default_model
+    self.tiers = tiers
+    self.hedge_enabled = hedge_enabled
+    self.hedge_percentile = hedge_percentile
+    self.initial_delay = initial_delay
+    self.min_delay = min_delay
+    self.min_samples = min_samples
+    self.window = window
+    self.max_ratio = max_ratio
+    self._latencies: Dict[str, LatencyWindow] = {}
+    self._hedge_budget = 1.0
+    self.routed: Dict[str, int] = {}
+    self.hedged = 0
+    self.hedges_won = 0
+
+  def choose(self, message_tokens: int, history_messages: int) -> str:
+    model = next((tier.model for tier in self.tiers if tier.fits(message_tokens, history_messages)), self.default_model)
+    self.routed[model] = self.routed.get(model, 0) + 1
+    return model
+
+  def hedge_delay(self, model: str) -> Optional[float]:
+    """Seconds to wait for the first token of a request before hedging it, or None to not hedge."""
+    if not self.hedge_enabled:
+      return None
+    self._hedge_budget = min(self._hedge_budget + self.max_ratio, HEDGE_BUDGET_BURST)
+    latencies = self._latencies.get(model)
+    if latencies is None or len(latencies.samples) < self.min_samples:
+      return self.initial_delay
+    return max(latencies.percentile(self.hedge_percentile), self.min_delay)
+
+  def take_hedge(self) -> bool:
+    if self._hedge_budget < 1:
+      return False
+    self._hedge_budget -= 1
+    self.hedged += 1
+    return True
+
+  def record_first_token(self, model: str, seconds: float, hedge_won: bool) -> None:
+    """Records how long the first request to model took to its first token; when a hedge won, how long it had run, a lower bound."""
+    latencies = self._latencies.get(model)
+    if latencies is None:
+      latencies = self._latencies[model] = LatencyWindow(self.window)
+    latencies.samples.append(seconds)
+    if hedge_won:
+      self.hedges_won += 1
+
+  def stats(self) -> Dict[str, Any]:
+    stats: Dict[str, Any] = {"hedged": self.hedged, "hedges_won": self.hedges_won, "hedge_budget": round(self._hedge_budget, 2)}
+    for model, count in self.routed.items():
+      stats[f"routed.{model}"] = count
+    for model, latencies in self._latencies.items():
+      if latencies.samples:
+        stats[f"hedge_delay_ms.{model}"] = round(max(latencies.percentile(self.hedge_percentile), self.min_delay) * 1000, 1)
+    return stats
+
+
+model_router = ModelRouter(
+  default_model=settings.CHAT_MODEL,
+  tiers=parse_tiers(settings.CHAT_MODEL_TIERS),
+  hedge_enabled=settings.HEDGE_ENABLED,
+  hedge_percentile=settings.HEDGE_PERCENTILE,
+  initial_delay=settings.HEDGE_INITIAL_DELAY_MS / 1000,
+  min_delay=settings.HEDGE_MIN_DELAY_MS / 1000,
+  min_samples=settings.HEDGE_MIN_SAMPLES,
+  window=settings.HEDGE_WINDOW,
+  max_ratio=settings.HEDGE_MAX_RATIO,
+)
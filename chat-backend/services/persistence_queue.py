@@ -0,0 +1,137 @@
+import asyncio
+import logging
+from typing import Dict, List, Optional
+
+from config import settings
+from daos.conversation_dao import ConversationDAO
+from exceptions.custom_exceptions import DatabaseError, TransientDatabaseError
+from models.models import ChatMessage
+
+logger = logging.getLogger(__name__)
+
+
+class MessagePersistenceQueue:
+  """Write-behind queue that batches message appends across conversations into periodic bulk writes.
+
+  Messages for the same conversation are merged into one $push/$each. The queue is bounded: once
+  max_pending_messages are waiting, enqueue waits for the next flush.
+  """
+
+  def __init__(self, flush_interval: float, max_batch_conversations: int, max_pending_messages: int, max_retries: int, retry_backoff: float):
+    self.flush_interval = flush_interval
+    self.max_batch_conversations = max_batch_conversations
+    self.max_pending_messages = max_pending_messages
+    self.max_retries = max_retries
+    self.retry_backoff = retry_backoff
+    self.conversation_dao: Optional[ConversationDAO] = None
+    # conversation_id -> messages waiting for the next flush, in order
+    self._pending: Dict[str, List[ChatMessage]] = {}
+    # the batch currently being written, still visible to readers until it lands
+    self._writing: Dict[str, List[ChatMessage]] = {}
+    self._pending_count = 0
+    self._wakeup: Optional[asyncio.Event] = None
+    self._space: Optional[asyncio.Condition] = None
+    self._task: Optional[asyncio.Task] = None
+    self._stopping = False
+    self.flushed_messages = 0
+    self.dropped_messages = 0
+
+  @property
+  def running(self) -> bool:
+    return self._task is not None and not self._task.done()
+
+  def start(self, conversation_dao: ConversationDAO) -> None:
+    if self.running:
+      return
+    self.conversation_dao = conversation_dao
+    self._wakeup = asyncio.Event()
+    self._space = asyncio.Condition()
+    self._stopping = False
+    self._task = asyncio.create_task(self._run())
+    logger.info("Started message persistence queue")
+
+  async def stop(self) -> None:
+    if not self.running:
+      return
+    self._stopping = True
+    self._wakeup.set()
+    await self._task
+    self._task = None
+    logger.info(f"Stopped message persistence queue ({self.flushed_messages} flushed, {self.dropped_messages} dropped)")
+
+  async def enqueue(self, conversation_id: str, messages: List[ChatMessage]) -> None:
+    async with self._space:
+      await self._space.wait_for(lambda: self._pending_count < self.max_pending_messages)
+      self._pending.setdefault(conversation_id, []).extend(messages)
+      self._pending_count += len(messages)
+    if len(self._pending) >= self.max_batch_conversations or self._pending_count >= self.max_pending_messages:
+      self._wakeup.set()
+
+  def pending_messages(self, conversation_id: str) -> List[ChatMessage]:
+    """Returns messages for the conversation that may not be in the database yet."""
+    return self._writing.get(conversation_id, []) + self._pending.get(conversation_id, [])
+
+  def pending_conversations(self) -> List[str]:
+    """Returns the ids of conversations with messages that may not be in the database yet."""
+    return [*self._writing, *(conversation_id for conversation_id in self._pending if conversation_id not in self._writing)]
+
+  def stats(self) -> Dict[str, int]:
+    return {
+      "pending_conversations": len(self._pending),
+      "pending_messages": self._pending_count,
+      "flushed_messages": self.flushed_messages,
+      "dropped_messages": self.dropped_messages,
+    }
+
+  async def _run(self) -> None:
+    while True:
+      try:
+        await asyncio.wait_for(self._wakeup.wait(), timeout=self.flush_interval)
+      except asyncio.TimeoutError:
+        pass
+      self._wakeup.clear()
+      while self._pending:
+        try:
+          await self._flush_batch()
+        except Exception as e:
+          logger.exception(f"Unexpected error flushing messages: {e}")
+      if self._stopping:
+        return
+
+  async def _flush_batch(self) -> None:
+    conversation_ids = list(self._pending)[:self.max_batch_conversations]
+    batch = {conversation_id: self._pending.pop(conversation_id) for conversation_id in conversation_ids}
+    batch_count = sum(len(messages) for messages in batch.values())
+    self._writing = batch
+    try:
+      for attempt in range(self.max_retries + 1):
+        try:
+          await self.conversation_dao.add_messages_to_conversations(batch)
+          self.flushed_messages += batch_count
+          return
+        except TransientDatabaseError:
+          if attempt == self.max_retries:
+            raise
+          # appends are skipped when already stored, so retrying the whole batch is safe
+          await asyncio.sleep(self.retry_backoff * 2 ** attempt)
+    except DatabaseError as e:
+      self.dropped_messages += batch_count
+      logger.error(f"Dropped {batch_count} messages for {len(batch)} conversations ({', '.join(batch)}) after failed writes: {e}")
+    except Exception as e:
+      # anything else failing the write loses the batch just the same
+      self.dropped_messages += batch_count
+      logger.exception(f"Dropped {batch_count} messages for {len(batch)} conversations ({', '.join(batch)}) after an unexpected error: {e}")
+    finally:
+      self._writing = {}
+      async with self._space:
+        self._pending_count -= batch_count
+        self._space.notify_all()
+
+
+message_queue = MessagePersistenceQueue(
+  flush_interval=settings.PERSIST_FLUSH_INTERVAL_MS / 1000,
+  max_batch_conversations=settings.PERSIST_MAX_BATCH_CONVERSATIONS,
+  max_pending_messages=settings.PERSIST_MAX_PENDING_MESSAGES,
+  max_retries=settings.PERSIST_MAX_RETRIES,
+  retry_backoff=settings.PERSIST_RETRY_BACKOFF_MS / 1000,
+)
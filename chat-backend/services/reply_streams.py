@@ -0,0 +1,190 @@
+import asyncio
+import bisect
+import logging
+import uuid
+from collections import OrderedDict
+from typing import Any, AsyncIterator, Dict, List, Optional, Tuple
+
+from config import settings
+from exceptions.custom_exceptions import DatabaseError
+from metrics import CANCELLED_REPLIES, RequestTrace
+from models.models import ChatMessage, Conversation
+from structured_logging import log_fields
+
+logger = logging.getLogger(__name__)
+
+
+class ReplyStream:
+  """A bot reply being generated, buffered so any connection of the user can read it from an offset.
+
+  The upstream stream is read by a task of its own, so it outlives the connection that started it:
+  after a disconnect it keeps running for a grace period in case the client comes back. The turn is
+  saved once, by that task, when the reply finishes or is cancelled.
+  """
+
+  def __init__(self, stream_id: str, user_id: str, conversation_id: str, message: str, resumable: bool):
+    self.stream_id = stream_id
+    self.user_id = user_id
+    self.conversation_id = conversation_id
+    self.message = message
+    self.resumable = resumable
+    self.chunks: List[str] = []
+    # offset in the reply of the start of each chunk
+    self._offsets: List[int] = []
+    self.length = 0
+    self.done = False
+    self.cancel_reason: Optional[str] = None
+    self.error: Optional[BaseException] = None
+    self.readers = 0
+    # set once the upstream stream has ended and the turn is being saved, which is no longer cancelled
+    self._finishing = False
+    self._updated = asyncio.Event()
+    self._task: Optional[asyncio.Task] = None
+    self._grace_timer: Optional[asyncio.TimerHandle] = None
+
+  @property
+  def text(self) -> str:
+    return "".join(self.chunks)
+
+  def text_from(self, offset: int) -> str:
+    """Returns the reply after offset characters."""
+    if offset >= self.length:
+      return ""
+    index = bisect.bisect_right(self._offsets, offset) - 1
+    return self.chunks[index][offset - self._offsets[index]:] + "".join(self.chunks[index + 1:])
+
+  async def read(self, offset: int) -> Tuple[str, bool]:
+    """Waits for the reply to go past offset or finish. Returns the text after offset and whether the reply is done."""
+    while self.length <= offset and not self.done:
+      await self._updated.wait()
+    return self.text_from(offset), self.done
+
+  def attach(self) -> None:
+    self.readers += 1
+    if self._grace_timer is not None:
+      self._grace_timer.cancel()
+      self._grace_timer = None
+
+  def detach(self) -> None:
+    """Called when a reader's connection is lost; the reply is cancelled if nobody comes back within the grace period."""
+    self.readers -= 1
+    if self.readers > 0 or self.done:
+      return
+    grace = settings.RESUME_GRACE_S if self.resumable else 0
+    if grace <= 0:
+      self.cancel("disconnect")
+    else:
+      self._grace_timer = asyncio.get_running_loop().call_later(grace, self._grace_expired)
+
+  def cancel(self, reason: str) -> None:
+    if self._finishing or self._task is None or self._task.done():
+      return
+    self.cancel_reason = reason
+    self._task.cancel()
+
+  async def finished(self) -> None:
+    if self._task is not None:
+      await asyncio.shield(self._task)
+
+  def _grace_expired(self) -> None:
+    self._grace_timer = None
+    if self.readers == 0:
+      self.cancel("disconnect")
+
+  def _append(self, chunk: str) -> None:
+    if not chunk:
+      return
+    self._offsets.append(self.length)
+    self.chunks.append(chunk)
+    self.length += len(chunk)
+    self._wake()
+
+  def _wake(self) -> None:
+    updated, self._updated = self._updated, asyncio.Event()
+    updated.set()
+
+  async def _produce(self, chats: AsyncIterator[str], chat_service: Any, conversation: Conversation, trace: RequestTrace) -> None:
+    try:
+      async for chunk in chats:
+        self._append(chunk)
+    except asyncio.CancelledError:
+      # cancel() sets a reason first; anything else cancelling the task (e.g. shutdown) must still see it cancelled
+      requested = self.cancel_reason is not None
+      if not requested:
+        self.cancel_reason = "cancelled"
+      CANCELLED_REPLIES.inc(self.cancel_reason)
+      logger.info("Reply cancelled", extra=log_fields(user_id=self.user_id, conversation_id=self.conversation_id, reason=self.cancel_reason, chars=self.length))
+      if not requested:
+        raise
+    except Exception as e:
+      # handed to the readers; a reply that failed isn't saved
+      self.error = e
+    finally:
+      self._finishing = True
+      if hasattr(chats, "aclose"):
+        await chats.aclose()
+      if self.error is None:
+        await self._save(chat_service, conversation, trace)
+      self.done = True
+      self._wake()
+
+  async def _save(self, chat_service: Any, conversation: Conversation, trace: RequestTrace) -> None:
+    cancelled = self.cancel_reason is not None
+    turn_messages = [ChatMessage(role="user", content=self.message)]
+    if self.length or not cancelled:
+      turn_messages.append(ChatMessage(role="bot", content=self.text, truncated=cancelled))
+    try:
+      # both messages of the turn go out in one write-behind append, END doesn't wait on the database
+      with trace.stage("persist"):
+        await chat_service.add_messages_to_conversation(self.conversation_id, turn_messages)
+      chat_service.schedule_summary_update(conversation)
+    except DatabaseError as e:
+      logger.error("Failed to save reply %s of conversation %s: %s", self.stream_id, self.conversation_id, e)
+
+
+class ReplyStreams:
+  """The replies being generated, and those finished in the last ttl seconds, by stream id."""
+
+  def __init__(self, ttl: float, max_streams: int):
+    self.ttl = ttl
+    self.max_streams = max_streams
+    self._streams: "OrderedDict[str, ReplyStream]" = OrderedDict()
+    self.resumed = 0
+
+  def start(self, user_id: str, conversation_id: str, message: str, chats: AsyncIterator[str], chat_service: Any,
+            conversation: Conversation, trace: RequestTrace, resumable: bool) -> ReplyStream:
+    """Starts reading chats into a new stream, with the caller attached as its first reader."""
+    stream = ReplyStream(str(uuid.uuid4()), user_id, conversation_id, message, resumable)
+    stream.attach()
+    stream._task = asyncio.create_task(stream._produce(chats, chat_service, conversation, trace))
+    if resumable:
+      self._streams[stream.stream_id] = stream
+      stream._task.add_done_callback(lambda _: asyncio.get_running_loop().call_later(self.ttl, self._streams.pop, stream.stream_id, None))
+      self._evict()
+    return stream
+
+  def resume(self, user_id: str, stream_id: str, offset: int) -> Optional[ReplyStream]:
+    """Attaches to the user's stream, or returns None if it's unknown, expired or shorter than offset."""
+    stream = self._streams.get(stream_id)
+    if stream is None or stream.user_id != user_id or offset > stream.length:
+      return None
+    stream.attach()
+    self.resumed += 1
+    return stream
+
+  def stats(self) -> Dict[str, int]:
+    return {
+      "streams": len(self._streams),
+      "running": sum(1 for stream in self._streams.values() if not stream.done),
+      "resumed": self.resumed,
+    }
+
+  def _evict(self) -> None:
+    # drop the oldest finished replies first; running ones are never dropped
+    for stream_id in [stream_id for stream_id, stream in self._streams.items() if stream.done]:
+      if len(self._streams) <= self.max_streams:
+        return
+      del self._streams[stream_id]
+
+
+reply_streams = ReplyStreams(ttl=settings.RESUME_TTL_S, max_streams=settings.RESUME_MAX_STREAMS)
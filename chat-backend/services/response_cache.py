@@ -0,0 +1,107 @@
+import asyncio
+import hashlib
+import json
+import logging
+from typing import Any, Dict, List, Optional, Set
+
+from config import settings
+from daos.response_cache_dao import ResponseCacheDAO
+from exceptions.custom_exceptions import DatabaseError
+from services.cache import LRUTTLCache
+
+logger = logging.getLogger(__name__)
+
+# keeps background mongo writes referenced until they finish
+_write_tasks: Set[asyncio.Task] = set()
+
+
+class ResponseCache:
+  """Two-tier cache of complete, deterministic (temperature 0) chat completions.
+
+  The in-memory LRU tier is always used; the Mongo tier is shared by all workers and is only used
+  once start() is given a DAO.
+  """
+
+  def __init__(self, enabled: bool, bypass_users: set, memory_cache: LRUTTLCache):
+    self.enabled = enabled
+    self.bypass_users = bypass_users
+    self.memory_cache = memory_cache
+    self.response_cache_dao: Optional[ResponseCacheDAO] = None
+    self.hits = 0
+    self.misses = 0
+    self.mongo_hits = 0
+    self.bypassed = 0
+
+  async def start(self, response_cache_dao: ResponseCacheDAO, ttl_seconds: int) -> None:
+    try:
+      await response_cache_dao.ensure_indexes(ttl_seconds)
+      self.response_cache_dao = response_cache_dao
+    except DatabaseError as e:
+      logger.error(f"Response cache running without the mongo tier: {e}")
+
+  @staticmethod
+  def key(messages: List[Dict[str, str]], **params: Any) -> str:
+    canonical = json.dumps({"messages": messages, "params": params}, sort_keys=True, separators=(",", ":"), ensure_ascii=False)
+    return hashlib.sha256(canonical.encode()).hexdigest()
+
+  def should_use(self, user_id: Optional[str]) -> bool:
+    if not self.enabled:
+      return False
+    if user_id is not None and user_id in self.bypass_users:
+      self.bypassed += 1
+      return False
+    return True
+
+  async def get(self, key: str) -> Optional[str]:
+    response = self.memory_cache.get(key)
+    if response is None and self.response_cache_dao is not None:
+      try:
+        response = await self.response_cache_dao.get_response(key)
+      except DatabaseError:
+        response = None
+      if response is not None:
+        self.mongo_hits += 1
+        self.memory_cache.set(key, response)
+    if response is None:
+      self.misses += 1
+    else:
+      self.hits += 1
+    return response
+
+  def put(self, key: str, model: str, response: str) -> None:
+    self.memory_cache.set(key, response)
+    if self.response_cache_dao is not None:
+      # the reply has already been streamed, don't hold up the end of the turn on mongo
+      task = asyncio.create_task(self._put_mongo(key, model, response))
+      _write_tasks.add(task)
+      task.add_done_callback(_write_tasks.discard)
+
+  async def _put_mongo(self, key: str, model: str, response: str) -> None:
+    try:
+      await self.response_cache_dao.put_response(key, model, response)
+    except DatabaseError:
+      pass
+
+  def stats(self) -> Dict[str, Any]:
+    lookups = self.hits + self.misses
+    return {
+      "hits": self.hits,
+      "misses": self.misses,
+      "hit_rate": self.hits / lookups if lookups else 0.0,
+      "mongo_hits": self.mongo_hits,
+      "bypassed": self.bypassed,
+      "memory": self.memory_cache.stats(),
+    }
+
+
+response_cache = ResponseCache(
+  enabled=settings.RESPONSE_CACHE_ENABLED,
+  bypass_users=settings.RESPONSE_CACHE_BYPASS_USERS,
+  memory_cache=LRUTTLCache(
+    "responses",
+    max_entries=settings.RESPONSE_CACHE_MAX_ENTRIES,
+    max_weight=settings.RESPONSE_CACHE_MAX_CHARS,
+    ttl_seconds=settings.RESPONSE_CACHE_TTL_S,
+    weigher=len,
+  ),
+)
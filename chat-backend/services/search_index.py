@@ -0,0 +1,390 @@
+import asyncio
+import bisect
+import hashlib
+import heapq
+import json
+import logging
+import math
+import os
+import re
+import struct
+import tempfile
+import time
+import zlib
+from array import array
+from collections import Counter
+from datetime import datetime, timezone
+from typing import Any, Dict, Iterable, List, Optional, Set, Tuple, Union
+
+from config import settings
+from daos.conversation_dao import ConversationDAO
+from models.models import ChatMessage, SearchResult, StoredMessage
+from services.cache import LRUTTLCache
+from services.persistence_queue import message_queue
+
+logger = logging.getLogger(__name__)
+
+# BM25 term frequency saturation and document length normalization
+BM25_K1 = 1.2
+BM25_B = 0.75
+# tokens longer than this (base64, hashes) are not indexed
+MAX_TOKEN_CHARS = 64
+SNIPPET_CHARS = 160
+SNAPSHOT_VERSION = 1
+# length of the JSON metadata that starts a snapshot, followed by the posting arrays
+SNAPSHOT_HEADER = struct.Struct("<I")
+POSTING_ITEM_SIZE = array("I").itemsize
+# conversations updated this long before a snapshot was taken are indexed again when it's loaded,
+# to cover appends still in flight when it was taken and clock differences between workers
+SYNC_MARGIN_S = 60.0
+# conversations listed per round-trip while building or catching up an index
+CATCH_UP_PAGE_SIZE = 100
+
+_WORD = re.compile(r"\w+")
+
+
+def tokenize(text: str) -> List[str]:
+  return [token for token in _WORD.findall(text.lower()) if len(token) <= MAX_TOKEN_CHARS]
+
+
+def _timestamp(value: Optional[datetime]) -> float:
+  if value is None:
+    return 0.0
+  # mongo returns naive datetimes in UTC
+  return (value if value.tzinfo is not None else value.replace(tzinfo=timezone.utc)).timestamp()
+
+
+def snippet(text: str, terms: Iterable[str]) -> str:
+  """Returns about SNIPPET_CHARS of text around the first occurrence of any of the terms."""
+  pattern = re.compile(r"(?<!\w)(?:" + "|".join(re.escape(term) for term in terms) + r")(?!\w)", re.IGNORECASE)
+  match = pattern.search(text)
+  start = max((match.start() if match else 0) - SNIPPET_CHARS // 3, 0)
+  end = start + SNIPPET_CHARS
+  window = " ".join(text[start:end].split())
+  return f"{'...' if start > 0 else ''}{window}{'...' if end < len(text) else ''}"
+
+
+class UserSearchIndex:
+  """Inverted index over one user's messages, scored with BM25. Each message is a document.
+
+  Documents are only ever appended, so every posting list is sorted by document number and stored as two
+  flat arrays (document numbers and term frequencies) rather than per-posting objects.
+  """
+
+  def __init__(self, user_id: str):
+    self.user_id = user_id
+    self.conversation_ids: List[str] = []
+    self._conversation_numbers: Dict[str, int] = {}
+    # per document: its conversation number, message id, text and number of tokens
+    self.doc_conversations = array("I")
+    self.message_ids: List[str] = []
+    self.texts: List[str] = []
+    self.doc_lengths = array("I")
+    # (conversation number, message id, hash of text) of each document; message ids alone aren't unique,
+    # messages stored before ids were generated per message share the id of every message of their process
+    self._indexed: Set[Tuple[int, str, int]] = set()
+    # term -> (document numbers, term frequencies)
+    self.postings: Dict[str, Tuple[array, array]] = {}
+    self.total_length = 0
+    # the conversation store has been indexed up to this unix time
+    self.synced_at = 0.0
+
+  def __len__(self) -> int:
+    return len(self.message_ids)
+
+  def add(self, conversation_id: str, message_id: str, text: str) -> bool:
+    """Indexes a message unless it already is, returning whether it was added."""
+    if not text:
+      return False
+    conversation_number = self._conversation_numbers.get(conversation_id)
+    if conversation_number is None:
+      conversation_number = self._conversation_numbers[conversation_id] = len(self.conversation_ids)
+      self.conversation_ids.append(conversation_id)
+    key = (conversation_number, message_id, hash(text))
+    if key in self._indexed:
+      return False
+    doc = len(self.message_ids)
+    frequencies = Counter(tokenize(text))
+    for term, frequency in frequencies.items():
+      posting = self.postings.get(term)
+      if posting is None:
+        posting = self.postings[term] = (array("I"), array("I"))
+      posting[0].append(doc)
+      posting[1].append(frequency)
+    length = sum(frequencies.values())
+    self.doc_conversations.append(conversation_number)
+    self.message_ids.append(message_id)
+    self.texts.append(text)
+    self.doc_lengths.append(length)
+    self.total_length += length
+    self._indexed.add(key)
+    return True
+
+  def search(self, query: str, limit: int) -> List[SearchResult]:
+    """Returns the conversations with the best scoring message for the query, best first."""
+    terms = set(tokenize(query))
+    documents = len(self.message_ids)
+    if not terms or not documents:
+      return []
+    lengths = self.doc_lengths
+    length_norm = BM25_K1 * BM25_B / (self.total_length / documents)
+    constant_norm = BM25_K1 * (1 - BM25_B)
+    scores: Dict[int, float] = {}
+    for term in terms:
+      posting = self.postings.get(term)
+      if posting is None:
+        continue
+      docs, frequencies = posting
+      idf = math.log(1 + (documents - len(docs) + 0.5) / (len(docs) + 0.5))
+      weight = idf * (BM25_K1 + 1)
+      for doc, frequency in zip(docs, frequencies):
+        scores[doc] = scores.get(doc, 0.0) + weight * frequency / (frequency + constant_norm + length_norm * lengths[doc])
+    # the best message of each conversation stands for it
+    best: Dict[int, Tuple[float, int]] = {}
+    for doc, score in scores.items():
+      conversation_number = self.doc_conversations[doc]
+      current = best.get(conversation_number)
+      if current is None or score > current[0]:
+        best[conversation_number] = (score, doc)
+    return [
+      SearchResult(
+        conversation_id=self.conversation_ids[self.doc_conversations[doc]],
+        message_id=self.message_ids[doc],
+        score=round(score, 4),
+        snippet=snippet(self.texts[doc], terms),
+      )
+      for score, doc in heapq.nlargest(limit, best.values())
+    ]
+
+  def snapshot(self) -> Dict[str, Any]:
+    """Captures the index as it is now, cheaply, for to_bytes to encode in a thread while the index keeps changing."""
+    return {
+      "user_id": self.user_id,
+      "synced_at": self.synced_at,
+      "conversations": list(self.conversation_ids),
+      "documents": len(self.message_ids),
+      "message_ids": list(self.message_ids),
+      "texts": list(self.texts),
+      "total_length": self.total_length,
+      "doc_conversations": self.doc_conversations,
+      "doc_lengths": self.doc_lengths,
+      # documents are only appended, so the first entries of each posting list stay as they are
+      "postings": list(self.postings.items()),
+    }
+
+  @staticmethod
+  def to_bytes(snapshot: Dict[str, Any]) -> bytes:
+    """Encodes a snapshot as JSON metadata followed by the posting arrays, compressed together."""
+    documents = snapshot["documents"]
+    terms, counts, blobs = [], [], []
+    for term, (docs, frequencies) in snapshot["postings"]:
+      count = bisect.bisect_left(docs, documents)
+      if count:
+        terms.append(term)
+        counts.append(count)
+        blobs.append(docs[:count].tobytes())
+        blobs.append(frequencies[:count].tobytes())
+    metadata = json.dumps({
+      "v": SNAPSHOT_VERSION,
+      "user_id": snapshot["user_id"],
+      "synced_at": snapshot["synced_at"],
+      "conversations": snapshot["conversations"],
+      "doc_conversations": snapshot["doc_conversations"][:documents].tolist(),
+      "doc_lengths": snapshot["doc_lengths"][:documents].tolist(),
+      "total_length": snapshot["total_length"],
+      "message_ids": snapshot["message_ids"][:documents],
+      "texts": snapshot["texts"][:documents],
+      "terms": terms,
+      "counts": counts,
+    }, separators=(",", ":"), ensure_ascii=False).encode()
+    return zlib.compress(b"".join([SNAPSHOT_HEADER.pack(len(metadata)), metadata, *blobs]))
+
+  @classmethod
+  def from_bytes(cls, data: bytes) -> "UserSearchIndex":
+    data = zlib.decompress(data)
+    (metadata_length,) = SNAPSHOT_HEADER.unpack_from(data)
+    offset = SNAPSHOT_HEADER.size + metadata_length
+    metadata = json.loads(data[SNAPSHOT_HEADER.size:offset])
+    if metadata.get("v") != SNAPSHOT_VERSION:
+      raise ValueError(f"Unsupported search index snapshot version {metadata.get('v')}")
+    index = cls(metadata["user_id"])
+    index.synced_at = metadata["synced_at"]
+    index.conversation_ids = metadata["conversations"]
+    index._conversation_numbers = {conversation_id: number for number, conversation_id in enumerate(index.conversation_ids)}
+    index.doc_conversations = array("I", metadata["doc_conversations"])
+    index.doc_lengths = array("I", metadata["doc_lengths"])
+    index.total_length = metadata["total_length"]
+    index.message_ids = metadata["message_ids"]
+    index.texts = metadata["texts"]
+    index._indexed = {(conversation_number, message_id, hash(text)) for conversation_number, message_id, text in zip(index.doc_conversations, index.message_ids, index.texts)}
+    with memoryview(data) as view:
+      for term, count in zip(metadata["terms"], metadata["counts"]):
+        size = count * POSTING_ITEM_SIZE
+        docs, frequencies = array("I"), array("I")
+        docs.frombytes(view[offset:offset + size])
+        frequencies.frombytes(view[offset + size:offset + 2 * size])
+        index.postings[term] = (docs, frequencies)
+        offset += 2 * size
+    return index
+
+
+class SearchIndexes:
+  """Per-user search indexes, loaded on first use and kept up to date as messages are added.
+
+  An index is loaded from its snapshot on disk, then caught up with the conversations updated since
+  the snapshot was taken, or built from the conversation store when there is no snapshot. Changed
+  indexes are written back every flush_interval. Snapshots are only a shortcut: an index evicted or
+  lost before its snapshot was written is caught up again on its next load.
+  """
+
+  def __init__(self, directory: str, max_users: int, max_messages: int, flush_interval: float):
+    self.directory = directory
+    self.flush_interval = flush_interval
+    self._indexes: LRUTTLCache = LRUTTLCache(
+      "search_indexes",
+      max_entries=max_users,
+      max_weight=max_messages,
+      ttl_seconds=settings.CACHE_TTL_S,
+      weigher=lambda index: len(index) + 1,
+    )
+    # indexes changed since their last snapshot, kept here so they are written even if evicted meanwhile
+    self._dirty: Dict[str, UserSearchIndex] = {}
+    # user_id -> messages added while the user's index was loading
+    self._loading: Dict[str, List[Tuple[str, Union[ChatMessage, StoredMessage]]]] = {}
+    self._task: Optional[asyncio.Task] = None
+    self.builds = 0
+    self.snapshot_loads = 0
+    self.snapshot_writes = 0
+    self.queries = 0
+
+  def start(self) -> None:
+    if self._task is None or self._task.done():
+      self._task = asyncio.create_task(self._flush_periodically())
+
+  async def stop(self) -> None:
+    if self._task is not None:
+      self._task.cancel()
+      self._task = None
+    await self.flush()
+
+  def add_messages(self, conversation_id: str, messages: List[Union[ChatMessage, StoredMessage]]) -> None:
+    """Indexes new messages if their user's index is loaded; otherwise they are picked up when it's loaded."""
+    user_id = conversation_id.split("-")[0]
+    loading = self._loading.get(user_id)
+    if loading is not None:
+      loading.extend((conversation_id, message) for message in messages)
+      return
+    index = self._indexes.peek(user_id)
+    if index is None:
+      return
+    if any([index.add(conversation_id, message.message_id, message.content) for message in messages]):
+      self._dirty[user_id] = index
+
+  async def search(self, conversation_dao: ConversationDAO, user_id: str, query: str, limit: int) -> List[SearchResult]:
+    index = await self._indexes.get_or_load(user_id, lambda: self._load(conversation_dao, user_id))
+    self.queries += 1
+    return index.search(query, limit)
+
+  async def flush(self) -> None:
+    dirty, self._dirty = self._dirty, {}
+    for user_id, index in dirty.items():
+      try:
+        await asyncio.to_thread(self._write_snapshot, user_id, index.snapshot())
+        self.snapshot_writes += 1
+      except OSError as e:
+        logger.error(f"Failed to write search index of user {user_id}: {e}")
+
+  def stats(self) -> Dict[str, Any]:
+    return {
+      **self._indexes.stats(),
+      "dirty": len(self._dirty),
+      "builds": self.builds,
+      "snapshot_loads": self.snapshot_loads,
+      "snapshot_writes": self.snapshot_writes,
+      "queries": self.queries,
+    }
+
+  async def _flush_periodically(self) -> None:
+    while True:
+      await asyncio.sleep(self.flush_interval)
+      await self.flush()
+
+  async def _load(self, conversation_dao: ConversationDAO, user_id: str) -> UserSearchIndex:
+    self._loading[user_id] = []
+    try:
+      started = time.time()
+      index = await asyncio.to_thread(self._read_snapshot, user_id)
+      if index is None:
+        index = UserSearchIndex(user_id)
+        self.builds += 1
+        await self._catch_up(conversation_dao, index, None)
+      else:
+        self.snapshot_loads += 1
+        await self._catch_up(conversation_dao, index, index.synced_at - SYNC_MARGIN_S)
+      # appends that haven't reached the database yet, and those made while loading
+      for conversation_id in message_queue.pending_conversations():
+        if conversation_id.startswith(f"{user_id}-"):
+          for message in message_queue.pending_messages(conversation_id):
+            index.add(conversation_id, message.message_id, message.content)
+      for conversation_id, message in self._loading[user_id]:
+        index.add(conversation_id, message.message_id, message.content)
+      index.synced_at = started
+      self._dirty[user_id] = index
+      logger.info("Loaded search index of user %s (%s messages) in %.1fms", user_id, len(index), (time.time() - started) * 1000)
+      return index
+    finally:
+      self._loading.pop(user_id, None)
+
+  async def _catch_up(self, conversation_dao: ConversationDAO, index: UserSearchIndex, since: Optional[float]) -> None:
+    """Indexes the conversations of the user updated since the given unix time, or all of them."""
+    before_updated_at = before_id = None
+    while True:
+      page = await conversation_dao.get_conversations_by_user_id(index.user_id, CATCH_UP_PAGE_SIZE, before_updated_at, before_id)
+      for listed in page:
+        # listed most recently updated first
+        if since is not None and _timestamp(listed.updated_at) < since:
+          return
+        conversation = await conversation_dao.get_conversation(listed.conversation_id)
+        if conversation is not None:
+          for message in conversation.messages:
+            index.add(conversation.conversation_id, message.message_id, message.content)
+      if len(page) < CATCH_UP_PAGE_SIZE:
+        return
+      before_updated_at, before_id = page[-1].updated_at, page[-1].conversation_id
+
+  def _path(self, user_id: str) -> str:
+    # user ids are chosen by clients, so they don't name files directly
+    return os.path.join(self.directory, f"{hashlib.sha1(user_id.encode()).hexdigest()}.idx")
+
+  def _read_snapshot(self, user_id: str) -> Optional[UserSearchIndex]:
+    try:
+      with open(self._path(user_id), "rb") as snapshot_file:
+        index = UserSearchIndex.from_bytes(snapshot_file.read())
+    except FileNotFoundError:
+      return None
+    except (OSError, ValueError, KeyError, struct.error, zlib.error) as e:
+      logger.warning(f"Ignoring unreadable search index of user {user_id}: {e}")
+      return None
+    return index if index.user_id == user_id else None
+
+  def _write_snapshot(self, user_id: str, snapshot: Dict[str, Any]) -> None:
+    os.makedirs(self.directory, exist_ok=True)
+    path = self._path(user_id)
+    # a name of its own, so two writers of the same user (e.g. two workers) never share a temporary file
+    descriptor, temporary_path = tempfile.mkstemp(dir=self.directory, prefix=f"{os.path.basename(path)}.", suffix=".tmp")
+    try:
+      with os.fdopen(descriptor, "wb") as snapshot_file:
+        snapshot_file.write(UserSearchIndex.to_bytes(snapshot))
+      # readers see the old snapshot or the new one, never a partial write
+      os.replace(temporary_path, path)
+    except BaseException:
+      os.remove(temporary_path)
+      raise
+
+
+search_indexes = SearchIndexes(
+  directory=settings.SEARCH_INDEX_DIR,
+  max_users=settings.SEARCH_INDEX_MAX_USERS,
+  max_messages=settings.SEARCH_INDEX_MAX_MESSAGES,
+  flush_interval=settings.SEARCH_INDEX_FLUSH_INTERVAL_S,
+)
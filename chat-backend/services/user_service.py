@@ -1,4 +1,4 @@
-from typing import Annotated, List
+from typing import Annotated, List, Optional
 from fastapi import Depends
 from exceptions.custom_exceptions import UserNotFoundError
 from models.models import User
@@ -12,39 +12,46 @@ class UserService:
     def __init__(self, user_dao: Annotated[UserDAO, Depends(UserDAO)]):
         self.user_dao = user_dao
 
-    def create_user(self, user: User) -> str:
-        logger.info(f"Creating user with ID: {user.user_id}")
-        return self.user_dao.create_user(user)
+    async def create_user(self, user: User) -> str:
+        logger.info("Creating user with ID: %s", user.user_id)
+        return await self.user_dao.create_user(user)
 
-    def get_user(self, user_id: str) -> User:
-        logger.info(f"Getting user with ID: {user_id}")
-        return self.user_dao.get_user(user_id)
+    async def ensure_user(self, user_id: str) -> bool:
+        """Creates the user unless it exists. Returns whether it was created."""
+        created = await self.user_dao.ensure_user(user_id)
+        if created:
+            logger.info("Created user %s", user_id)
+        return created
 
-    def update_user(self, user_id: str, user: User) -> User:
-        logger.info(f"Updating user with ID: {user_id}")
-        user = self.user_dao.update_user(user_id)
+    async def get_user(self, user_id: str) -> User:
+        logger.debug("Getting user with ID: %s", user_id)
+        return await self.user_dao.get_user(user_id)
+
+    async def update_user(self, user_id: str, user: User) -> User:
+        logger.info("Updating user with ID: %s", user_id)
+        user = await self.user_dao.update_user(user_id)
         if user is None:
             raise UserNotFoundError(f"User {user_id} not found")
         return user
 
-    def delete_user(self, user_id: str) -> bool:
-        logger.info(f"Deleting user with ID: {user_id}")
-        return self.user_dao.delete_user(user_id)
+    async def delete_user(self, user_id: str) -> bool:
+        logger.info("Deleting user with ID: %s", user_id)
+        return await self.user_dao.delete_user(user_id)
 
-    def list_users(self, skip: int = 0, limit: int = 10) -> List[User]:
-        logger.info(f"Listing users with skip: {skip} and limit: {limit}")
-        return self.user_dao.list_users(skip, limit)
+    async def list_users(self, after_id: Optional[str] = None, limit: int = 10) -> List[User]:
+        logger.info("Listing users after: %s with limit: %s", after_id, limit)
+        return await self.user_dao.list_users(after_id, limit)
 
-    def add_conversation_to_user(self, user_id: str, conversation_id: str) -> bool:
-        logger.info(f"Adding conversation with ID: {conversation_id} to user with ID: {user_id}")
-        user = self.user_dao.add_conversation_to_user(user_id, conversation_id)
+    async def add_conversation_to_user(self, user_id: str, conversation_id: str) -> bool:
+        logger.info("Adding conversation with ID: %s to user with ID: %s", conversation_id, user_id)
+        user = await self.user_dao.add_conversation_to_user(user_id, conversation_id)
         if user is None:
             raise UserNotFoundError(f"User {user_id} not found")
         return user
 
-    def remove_conversation_from_user(self, user_id: str, conversation_id: str) -> User:
-        logger.info(f"Removing conversation with ID: {conversation_id} from user with ID: {user_id}")
-        user = self.user_dao.remove_conversation_from_user(user_id, conversation_id)
+    async def remove_conversation_from_user(self, user_id: str, conversation_id: str) -> User:
+        logger.info("Removing conversation with ID: %s from user with ID: %s", conversation_id, user_id)
+        user = await self.user_dao.remove_conversation_from_user(user_id, conversation_id)
         if user is None:
             raise UserNotFoundError(f"User {user_id} not found")
         return user
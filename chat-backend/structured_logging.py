@@ -0,0 +1,154 @@
+"""Logging setup for the app: records are queued on the event loop and formatted and written by a background thread.
+
+Log a constant message with %-style arguments so nothing is formatted unless the record is kept, and put
+structured data in fields:
+
+    logger.info("Chat turn finished", extra=log_fields(user_id=user_id, prompt_tokens=prompt_tokens))
+
+Fields named like user content (REDACTED_FIELDS) are redacted unless LOG_REDACT_CONTENT is off, and
+every field is capped at LOG_MAX_FIELD_CHARS.
+"""
+import atexit
+import json
+import logging
+import logging.handlers
+import queue
+import random
+from datetime import datetime, timezone
+from typing import Any, Dict, Optional
+
+from config import settings
+
+# fields that may hold what users wrote or were sent
+REDACTED_FIELDS = {"content", "message", "messages", "prompt", "reply", "summary"}
+
+# record attribute that log_fields() stores the fields under
+_FIELDS_ATTRIBUTE = "fields"
+
+_listener: Optional[logging.handlers.QueueListener] = None
+_handler: Optional["NonBlockingQueueHandler"] = None
+
+
+def log_fields(**fields: Any) -> Dict[str, Dict[str, Any]]:
+    """Wraps fields for the extra argument of a logging call."""
+    return {_FIELDS_ATTRIBUTE: fields}
+
+
+def _cap(value: Any, max_chars: int) -> Any:
+    if isinstance(value, (int, float, bool)) or value is None:
+        return value
+    text = value if isinstance(value, str) else repr(value)
+    if len(text) > max_chars:
+        return f"{text[:max_chars]}...(+{len(text) - max_chars} chars)"
+    return text
+
+
+def _redact(value: Any) -> str:
+    size = len(value) if isinstance(value, (str, list, tuple, dict)) else None
+    return "<redacted>" if size is None else f"<redacted {size}>"
+
+
+class StructuredFormatter(logging.Formatter):
+    """Formats records as JSON lines, or as text with key=value fields."""
+
+    def __init__(self, json_lines: bool, max_field_chars: int, redact_content: bool):
+        super().__init__("%(asctime)s %(levelname)s %(name)s: %(message)s")
+        self.json_lines = json_lines
+        self.max_field_chars = max_field_chars
+        self.redact_content = redact_content
+
+    def fields(self, record: logging.LogRecord) -> Dict[str, Any]:
+        fields = {}
+        for name, value in (getattr(record, _FIELDS_ATTRIBUTE, None) or {}).items():
+            if self.redact_content and name in REDACTED_FIELDS:
+                fields[name] = _redact(value)
+            else:
+                fields[name] = _cap(value, self.max_field_chars)
+        return fields
+
+    def format(self, record: logging.LogRecord) -> str:
+        fields = self.fields(record)
+        if not self.json_lines:
+            text = super().format(record)
+            return " ".join([text, *(f"{name}={value}" for name, value in fields.items())])
+        entry = {
+            "ts": datetime.fromtimestamp(record.created, timezone.utc).isoformat(),
+            "level": record.levelname,
+            "logger": record.name,
+            "msg": record.getMessage(),
+            **fields,
+        }
+        if record.exc_info:
+            entry["exc"] = self.formatException(record.exc_info)
+        return json.dumps(entry, ensure_ascii=False, default=str)
+
+
+class SamplingFilter(logging.Filter):
+    """Keeps sample_rate of the records below WARNING, and every record at WARNING or above."""
+
+    def __init__(self, sample_rate: float):
+        super().__init__()
+        self.sample_rate = sample_rate
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        return record.levelno >= logging.WARNING or self.sample_rate >= 1 or random.random() < self.sample_rate
+
+
+class NonBlockingQueueHandler(logging.handlers.QueueHandler):
+    """Hands records to the writer thread as they are, so formatting happens there, and drops them when the queue is full."""
+
+    def __init__(self, log_queue: queue.Queue):
+        super().__init__(log_queue)
+        self.dropped = 0
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        # the record never leaves the process, so there is nothing to pickle; formatting is left to the writer
+        return record
+
+    def enqueue(self, record: logging.LogRecord) -> None:
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+
+def configure_logging() -> None:
+    """Routes the root logger through a bounded queue to a stderr writer thread. Safe to call more than once.
+
+    Handlers already on the root logger (e.g. from uvicorn --log-config) are replaced, so records aren't also
+    written synchronously on the event loop. Calling it again puts the queue handler back if a logging config
+    applied since has removed it.
+    """
+    global _listener, _handler
+    if _listener is None:
+        writer = logging.StreamHandler()
+        writer.setFormatter(StructuredFormatter(settings.LOG_FORMAT == "json", settings.LOG_MAX_FIELD_CHARS, settings.LOG_REDACT_CONTENT))
+        log_queue: queue.Queue = queue.Queue(maxsize=settings.LOG_QUEUE_SIZE)
+        _handler = NonBlockingQueueHandler(log_queue)
+        _handler.addFilter(SamplingFilter(settings.LOG_SAMPLE_RATE))
+        _listener = logging.handlers.QueueListener(log_queue, writer, respect_handler_level=True)
+        _listener.start()
+        # write out whatever is still queued when the process exits
+        atexit.register(stop_logging)
+    root = logging.getLogger()
+    for existing in list(root.handlers):
+        if existing is not _handler:
+            root.removeHandler(existing)
+    if _handler not in root.handlers:
+        root.addHandler(_handler)
+    root.setLevel(settings.LOG_LEVEL)
+
+
+def stop_logging() -> None:
+    global _listener, _handler
+    if _listener is not None:
+        logging.getLogger().removeHandler(_handler)
+        _listener.stop()
+        _listener = None
+        _handler = None
+
+
+def logging_stats() -> Dict[str, int]:
+    if _handler is None:
+        return {}
+    return {"queued": _handler.queue.qsize(), "dropped": _handler.dropped}
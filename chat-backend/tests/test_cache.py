@@ -0,0 +1,46 @@
+import asyncio
+
+import pytest
+
+from services.cache import LRUTTLCache
+
+
+def test_cancelling_the_first_caller_leaves_the_load_to_the_others():
+  async def run():
+    cache = LRUTTLCache("test", max_entries=10, max_weight=10, ttl_seconds=60)
+    release = asyncio.Event()
+    calls = []
+
+    async def loader():
+      calls.append(1)
+      await release.wait()
+      return "value"
+
+    first = asyncio.create_task(cache.get_or_load("key", loader))
+    await asyncio.sleep(0)
+    second = asyncio.create_task(cache.get_or_load("key", loader))
+    await asyncio.sleep(0)
+    first.cancel()
+    await asyncio.sleep(0)
+    release.set()
+    with pytest.raises(asyncio.CancelledError):
+      await first
+    return await second, cache.peek("key"), len(calls)
+
+  assert asyncio.run(run()) == ("value", "value", 1)
+
+
+def test_loader_errors_reach_every_caller():
+  async def run():
+    cache = LRUTTLCache("test", max_entries=10, max_weight=10, ttl_seconds=60)
+
+    async def loader():
+      await asyncio.sleep(0)
+      raise ValueError("down")
+
+    results = await asyncio.gather(cache.get_or_load("key", loader), cache.get_or_load("key", loader), return_exceptions=True)
+    return results, cache.stats()["loads"]
+
+  results, loads = asyncio.run(run())
+  assert [type(result) for result in results] == [ValueError, ValueError]
+  assert loads == 1
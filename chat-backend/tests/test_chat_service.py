@@ -0,0 +1,64 @@
+import asyncio
+from types import SimpleNamespace
+
+import pytest
+
+import services.chat_service as chat_service_module
+from benchmarks.memory_daos import InMemoryConversationDAO, InMemoryUserDAO
+from models.models import ChatMessage
+from config import settings
+from services.chat_service import ChatService
+from services.llm_scheduler import LLMScheduler
+
+
+def test_listing_follows_appends_to_older_conversations():
+  async def run():
+    chat_service = ChatService(InMemoryConversationDAO(), InMemoryUserDAO(), None)
+    older = await chat_service.create_conversation("dave", verify_user=False)
+    await chat_service.add_messages_to_conversation(older.conversation_id, [ChatMessage(content="first")])
+    newer = await chat_service.create_conversation("dave", verify_user=False)
+    await chat_service.add_messages_to_conversation(newer.conversation_id, [ChatMessage(content="second")])
+    before = await chat_service.get_conversations_by_user("dave")
+    await chat_service.add_messages_to_conversation(older.conversation_id, [ChatMessage(role="bot", content="reply")])
+    after = await chat_service.get_conversations_by_user("dave")
+    return [conversation.conversation_id for conversation in before], [conversation.conversation_id for conversation in after], older, newer
+
+  before, after, older, newer = asyncio.run(run())
+  assert before == [newer.conversation_id, older.conversation_id]
+  assert after == [older.conversation_id, newer.conversation_id]
+
+
+class FakeCompletions:
+  def __init__(self, scheduler):
+    self.scheduler = scheduler
+    self.active_during_call = None
+
+  async def create(self, **params):
+    self.active_during_call = self.scheduler.stats()["active"]
+    usage = SimpleNamespace(prompt_tokens=40, completion_tokens=10, total_tokens=50)
+    return SimpleNamespace(choices=[SimpleNamespace(message=SimpleNamespace(content="they like tomatoes"))], usage=usage)
+
+
+def test_summaries_are_admitted_by_the_scheduler(monkeypatch):
+  monkeypatch.setattr(settings, "CONTEXT_TOKEN_BUDGET", 200)
+  monkeypatch.setattr(settings, "CONTEXT_SUMMARY_MAX_TOKENS", 50)
+  monkeypatch.setattr(settings, "CONTEXT_SUMMARY_MIN_MESSAGES", 1)
+
+  async def run():
+    scheduler = LLMScheduler(max_concurrency=4, max_concurrency_per_user=1, max_queue=10, max_queue_per_user=10, queue_timeout=5,
+                             requests_per_minute=600, tokens_per_minute=100000, backoff_base=1, backoff_max=10)
+    monkeypatch.setattr(chat_service_module, "llm_scheduler", scheduler)
+    completions = FakeCompletions(scheduler)
+    chat_service = ChatService(InMemoryConversationDAO(), InMemoryUserDAO(), SimpleNamespace(chat=SimpleNamespace(completions=completions)))
+    conversation = await chat_service.create_conversation("erin", verify_user=False)
+    await chat_service.add_messages_to_conversation(conversation.conversation_id, [ChatMessage(content="tomato " * 100) for _ in range(4)])
+    conversation = await chat_service.get_conversation_by_id(conversation.conversation_id)
+    await chat_service.update_summary(conversation)
+    return completions.active_during_call, scheduler.stats(), conversation
+
+  active_during_call, stats, conversation = asyncio.run(run())
+  assert active_during_call == 1
+  assert stats["admitted"] == 1 and stats["active"] == 0
+  # the estimate was corrected to the 50 tokens reported
+  assert stats["token_bucket"] == pytest.approx(100000 - 50, abs=5)
+  assert conversation.summary == "they like tomatoes"
@@ -0,0 +1,23 @@
+import asyncio
+
+from models.models import ChatMessage
+from services.context_builder import message_tokens
+from services.history_relevance import HistoryRelevance
+
+
+def test_messages_sharing_an_id_keep_their_own_vectors():
+  history = [
+    ChatMessage(message_id="legacy", role="user", content="why does my car engine make a knocking noise"),
+    ChatMessage(message_id="legacy", role="bot", content="engine knock usually comes from low octane fuel"),
+    ChatMessage(message_id="legacy", role="user", content="how often should I water tomatoes in the garden"),
+    ChatMessage(message_id="legacy", role="bot", content="water tomatoes deeply twice a week"),
+    ChatMessage(message_id="legacy", role="user", content="thanks"),
+    ChatMessage(message_id="legacy", role="bot", content="you're welcome"),
+  ]
+  relevance = HistoryRelevance(dimensions=512, recent_messages=2, top_turns=1, min_similarity=0.1, max_conversations=10, max_vectors=1000)
+  # room for the recent tail and one earlier turn
+  budget = sum(message_tokens(message) for message in history[2:])
+
+  selected = asyncio.run(relevance.select("carol-1", "should I water my tomatoes more often", history, budget, history_start=4))
+
+  assert [message.content for message in selected] == [message.content for message in history[2:]]
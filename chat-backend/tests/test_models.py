@@ -0,0 +1,15 @@
+import warnings
+
+from models.models import Conversation
+
+
+def test_loaded_conversations_dump_like_validated_ones():
+  conversation = Conversation.from_document({"_id": "erin-1", "messages": [{"role": "bot", "message_id": "m1", "content": "hello"}]})
+
+  with warnings.catch_warnings():
+    warnings.simplefilter("error")
+    dumped = conversation.model_dump(by_alias=True)
+    conversation.model_dump_json()
+
+  assert dumped["messages"] == [{"role": "bot", "message_id": "m1", "content": "hello", "token_count": None, "truncated": False}]
+  assert Conversation.model_validate(dumped).messages[0].content == "hello"
@@ -0,0 +1,22 @@
+import asyncio
+
+from models.models import ChatMessage
+from services.persistence_queue import MessagePersistenceQueue
+
+
+class BrokenConversationDAO:
+  async def add_messages_to_conversations(self, messages_by_conversation):
+    raise RuntimeError("unexpected")
+
+
+def test_unexpected_write_errors_count_the_batch_as_dropped():
+  async def run():
+    queue = MessagePersistenceQueue(flush_interval=60, max_batch_conversations=10, max_pending_messages=100, max_retries=2, retry_backoff=0)
+    queue.start(BrokenConversationDAO())
+    await queue.enqueue("hank-1", [ChatMessage(content="one"), ChatMessage(role="bot", content="two")])
+    await queue.stop()
+    return queue.stats()
+
+  stats = asyncio.run(run())
+  assert stats["dropped_messages"] == 2
+  assert stats["flushed_messages"] == 0 and stats["pending_messages"] == 0
@@ -0,0 +1,57 @@
+import asyncio
+
+import pytest
+
+from metrics import RequestTrace
+from models.models import Conversation
+from services.reply_streams import ReplyStreams
+
+
+class FakeChatService:
+  def __init__(self):
+    self.saved = []
+
+  async def add_messages_to_conversation(self, conversation_id, messages):
+    self.saved.extend(messages)
+
+  def schedule_summary_update(self, conversation):
+    pass
+
+
+async def endless_reply():
+  yield "partial "
+  await asyncio.Event().wait()
+
+
+def start_stream(chat_service):
+  conversation = Conversation(_id="frank-1", user_id="frank")
+  return ReplyStreams(ttl=60, max_streams=10).start("frank", "frank-1", "hello", endless_reply(), chat_service, conversation, RequestTrace(), resumable=False)
+
+
+def test_stopped_reply_is_saved_truncated():
+  async def run():
+    chat_service = FakeChatService()
+    stream = start_stream(chat_service)
+    await stream.read(0)
+    stream.cancel("stop")
+    await stream.finished()
+    return stream, chat_service.saved
+
+  stream, saved = asyncio.run(run())
+  assert stream.cancel_reason == "stop"
+  assert [(message.role, message.content, message.truncated) for message in saved] == [("user", "hello", False), ("bot", "partial ", True)]
+
+
+def test_reply_cancelled_from_outside_is_saved_truncated_and_stays_cancelled():
+  async def run():
+    chat_service = FakeChatService()
+    stream = start_stream(chat_service)
+    await stream.read(0)
+    stream._task.cancel()
+    with pytest.raises(asyncio.CancelledError):
+      await stream._task
+    return stream, chat_service.saved
+
+  stream, saved = asyncio.run(run())
+  assert stream.done and stream.cancel_reason == "cancelled"
+  assert saved[-1].truncated
@@ -0,0 +1,56 @@
+import asyncio
+import os
+import zlib
+
+from benchmarks.memory_daos import InMemoryConversationDAO
+from models.models import ChatMessage, Conversation
+from services.search_index import SearchIndexes, UserSearchIndex
+
+
+def test_messages_sharing_an_id_are_all_searchable():
+  index = UserSearchIndex("alice")
+  index.add("alice-1", "legacy", "the quick brown fox")
+  index.add("alice-1", "legacy", "a lazy sleeping dog")
+  index.add("alice-2", "legacy", "another lazy afternoon")
+
+  assert [result.conversation_id for result in index.search("fox", 10)] == ["alice-1"]
+  assert {result.conversation_id for result in index.search("lazy", 10)} == {"alice-1", "alice-2"}
+  # the same message isn't indexed twice
+  assert not index.add("alice-1", "legacy", "a lazy sleeping dog")
+
+  restored = UserSearchIndex.from_bytes(UserSearchIndex.to_bytes(index.snapshot()))
+  assert len(restored) == 3
+  assert [result.conversation_id for result in restored.search("dog", 10)] == ["alice-1"]
+  assert not restored.add("alice-1", "legacy", "the quick brown fox")
+
+
+def test_catch_up_indexes_stored_messages_sharing_an_id(tmp_path):
+  async def run():
+    conversation_dao = InMemoryConversationDAO()
+    await conversation_dao.create_conversation(Conversation(_id="bob-1", user_id="bob", messages=[
+      ChatMessage(message_id="legacy", content="first question about tomatoes"),
+      ChatMessage(message_id="legacy", role="bot", content="an answer about cucumbers"),
+    ]))
+    indexes = SearchIndexes(str(tmp_path), max_users=10, max_messages=1000, flush_interval=60)
+    tomatoes = await indexes.search(conversation_dao, "bob", "tomatoes", 10)
+    cucumbers = await indexes.search(conversation_dao, "bob", "cucumbers", 10)
+    return tomatoes, cucumbers
+
+  tomatoes, cucumbers = asyncio.run(run())
+  assert [result.conversation_id for result in tomatoes] == ["bob-1"]
+  assert [result.conversation_id for result in cucumbers] == ["bob-1"]
+
+
+def test_snapshots_round_trip_and_truncated_ones_are_ignored(tmp_path):
+  indexes = SearchIndexes(str(tmp_path), max_users=10, max_messages=1000, flush_interval=60)
+  index = UserSearchIndex("carol")
+  index.add("carol-1", "m1", "snapshots survive restarts")
+  indexes._write_snapshot("carol", index.snapshot())
+  indexes._write_snapshot("carol", index.snapshot())
+
+  assert [path.name for path in tmp_path.iterdir()] == [os.path.basename(indexes._path("carol"))]
+  assert len(indexes._read_snapshot("carol")) == 1
+
+  with open(indexes._path("carol"), "wb") as snapshot_file:
+    snapshot_file.write(zlib.compress(b"\x01"))
+  assert indexes._read_snapshot("carol") is None
@@ -0,0 +1,31 @@
+import asyncio
+
+from daos.segment_log_dao import SegmentLogConversationDAO
+from models.models import ChatMessage, Conversation
+
+
+def test_replay_restores_the_index_and_reads_messages_back(tmp_path):
+  async def write():
+    dao = SegmentLogConversationDAO(str(tmp_path), 4096)
+    conversation = Conversation(_id="gina-1", user_id="gina", messages=[ChatMessage(content="first")])
+    await dao.create_conversation(conversation)
+    # small segments, so the appends roll over while writes are in flight
+    await asyncio.gather(*(dao.add_messages_to_conversations({"gina-1": [ChatMessage(content=f"message {i} " * 20)]}) for i in range(20)))
+    await dao.update_conversation_summary("gina-1", "a long chat", 5)
+    stored = await dao.get_conversation("gina-1")
+    await dao.remove_message_from_conversation("gina-1", stored.messages[1].message_id)
+    await dao.close()
+    return [message.content for message in stored.messages]
+
+  async def reopen():
+    dao = SegmentLogConversationDAO(str(tmp_path), 4096)
+    conversation = await dao.get_conversation("gina-1")
+    stats = dao.stats()
+    await dao.close()
+    return conversation, stats
+
+  written = asyncio.run(write())
+  conversation, stats = asyncio.run(reopen())
+  assert stats["segments"] > 1
+  assert [message.content for message in conversation.messages] == written[:1] + written[2:]
+  assert (conversation.summary, conversation.summary_message_count) == ("a long chat", 5)
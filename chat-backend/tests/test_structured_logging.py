@@ -0,0 +1,23 @@
+import logging
+import logging.config
+import os
+
+import yaml
+
+from structured_logging import NonBlockingQueueHandler, configure_logging, stop_logging
+
+
+def test_queue_handler_survives_a_later_log_config():
+  app_logger = logging.getLogger("services.some_module")
+  try:
+    configure_logging()
+    with open(os.path.join(os.path.dirname(__file__), "..", "config", "log_config.yaml")) as config_file:
+      logging.config.dictConfig(yaml.safe_load(config_file))
+    assert not any(isinstance(handler, NonBlockingQueueHandler) for handler in logging.getLogger().handlers)
+    assert not app_logger.disabled
+
+    configure_logging()
+    handlers = logging.getLogger().handlers
+    assert len(handlers) == 1 and isinstance(handlers[0], NonBlockingQueueHandler)
+  finally:
+    stop_logging()
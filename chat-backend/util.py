@@ -1,4 +1,5 @@
-from typing import Dict
+import asyncio
+from typing import AsyncGenerator, AsyncIterator, Dict, List
 
 from pydantic import ValidationError
 
@@ -13,4 +14,53 @@ def value_from_validation_error(d: Dict, ex: ValidationError):
                 break
             value = value[field]
         values[".".join([str(location) for location in loc])] = value
-    return values
\ No newline at end of file
+    return values
+
+
+async def coalesce_deltas(deltas: AsyncIterator[str], flush_interval: float, flush_bytes: int) -> AsyncGenerator[str, None]:
+    """Merges small text deltas into larger ones, flushing every flush_interval seconds or flush_bytes bytes.
+
+    The first delta is passed through immediately so coalescing never delays the first token.
+    """
+    loop = asyncio.get_running_loop()
+    iterator = deltas.__aiter__()
+    buffer: List[str] = []
+    buffered_bytes = 0
+    deadline = None
+    first = True
+    # the next read is always in flight so upstream keeps streaming while the caller sends a frame
+    next_delta = asyncio.ensure_future(iterator.__anext__())
+    try:
+        while True:
+            timeout = None if deadline is None else max(deadline - loop.time(), 0)
+            done, _ = await asyncio.wait({next_delta}, timeout=timeout)
+            if not done:
+                # upstream is slow, don't hold on to what we already have
+                yield "".join(buffer)
+                buffer, buffered_bytes, deadline = [], 0, None
+                continue
+            try:
+                delta = next_delta.result()
+            except StopAsyncIteration:
+                break
+            next_delta = asyncio.ensure_future(iterator.__anext__())
+            if first:
+                first = False
+                yield delta
+                continue
+            buffer.append(delta)
+            buffered_bytes += len(delta.encode())
+            if deadline is None:
+                deadline = loop.time() + flush_interval
+            if buffered_bytes >= flush_bytes or loop.time() >= deadline:
+                yield "".join(buffer)
+                buffer, buffered_bytes, deadline = [], 0, None
+        if buffer:
+            yield "".join(buffer)
+    finally:
+        # the caller stopped early: stop the pending read, then close deltas so it can clean up (e.g. close its stream)
+        if not next_delta.done():
+            next_delta.cancel()
+            await asyncio.wait({next_delta})
+        if hasattr(iterator, "aclose"):
+            await iterator.aclose()
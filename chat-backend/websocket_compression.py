@@ -0,0 +1,29 @@
+"""Websocket protocol for uvicorn with tunable permessage-deflate.
+
+uvicorn's websockets protocol offers permessage-deflate with the library defaults (a 32KB window per direction
+and connection, level 6) and no way to tune them. Pass this class as uvicorn's ws protocol, as `python main.py`
+does, to negotiate it with WS_DEFLATE_LEVEL and WS_DEFLATE_WINDOW_BITS, or not at all when WS_DEFLATE_ENABLED is off.
+"""
+from typing import Any
+
+from uvicorn.protocols.websockets.websockets_impl import WebSocketProtocol
+from websockets.extensions.permessage_deflate import ServerPerMessageDeflateFactory
+
+from config import settings
+
+
+def deflate_extensions() -> list:
+    if not settings.WS_DEFLATE_ENABLED:
+        return []
+    return [ServerPerMessageDeflateFactory(
+        server_max_window_bits=settings.WS_DEFLATE_WINDOW_BITS,
+        # memLevel 5 rather than zlib's 8 keeps the compressor state of idle connections small
+        compress_settings={"level": settings.WS_DEFLATE_LEVEL, "memLevel": 5},
+    )]
+
+
+class DeflateWebSocketProtocol(WebSocketProtocol):
+    def __init__(self, *args: Any, **kwargs: Any):
+        super().__init__(*args, **kwargs)
+        # read when the handshake is negotiated, so replacing it after construction is enough
+        self.available_extensions = deflate_extensions()